@@ -0,0 +1,114 @@
+import BaseHTTPServer
+import SocketServer
+import collections
+import os
+import re
+import threading
+import time
+import urlparse
+
+import idem
+import idem_settings
+import pageparser
+import tea_core
+
+# Local document service: serves VFC documents from the blob store, fetching each from ECM the first time it is read
+
+doc_path_pattern = re.compile("^/doc/(\d+)$")
+ecm_path_pattern = re.compile("^/cs/[^?#]+\.pdf$")  # only ever proxy ECM document paths
+fetch_locks = collections.defaultdict(threading.Lock)
+
+
+def build_ecm_url(path, docid):
+    """
+    :return: str, or None unless path is an ECM document path for docid itself
+    """
+    if not ecm_path_pattern.match(path) or pageparser.get_pdf_id(path) != docid:
+        return None
+    return idem_settings.ecm_domain + path
+
+
+def get_stored_path(docid, url=None):
+    """
+    Return path of stored copy of a document, fetching it from ECM first if necessary.
+    :param docid: str
+    :param url: str
+    :return: str or None
+    """
+    store = idem.get_blob_store()
+    with fetch_locks[docid]:  # concurrent requests for a new document fetch it only once
+        digest = store.lookup(docid)
+        if digest is None:
+            if url is None:
+                return None
+            digest = tea_core.do_patiently(idem.fetch_into_store, docid, url)
+            if not digest:
+                return None
+    return store.path_for(digest)
+
+
+class DocumentHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        parsed = urlparse.urlparse(self.path)
+        matched = doc_path_pattern.match(parsed.path)
+        if not matched:
+            self.send_error(404)
+            return
+        docid = matched.group(1)
+        query = urlparse.parse_qs(parsed.query)
+        url = None
+        if "path" in query:
+            url = build_ecm_url(query["path"][0], docid)
+            if url is None:
+                self.send_error(400, "Not the ECM path of this document")
+                return
+        filepath = get_stored_path(docid, url)
+        if filepath is None:
+            self.send_error(404)
+            return
+        self.send_file(filepath)
+
+    def send_file(self, filepath):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/pdf")
+        self.send_header("Content-Length", str(os.path.getsize(filepath)))
+        self.send_header("Cache-Control", "max-age=31536000")  # stored documents never change
+        self.end_headers()
+        handle = open(filepath, "rb")
+        with handle:
+            self.wfile.write(handle.read())
+
+
+class DocumentServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def prefetch_fresh_docs(collection, cutoff=1):
+    """
+    Pull newly posted documents into the store ahead of time, since these are the ones likely to be read.
+    :param collection: ZipCollection
+    :param cutoff: int (days)
+    :return: int (number of documents fetched)
+    """
+    store = idem.get_blob_store()
+    count = 0
+    for facility in idem.get_sites_with_activity(collection.facilities, idem.get_reference_date(cutoff)):
+        for doc in facility.docs:
+            if not idem.is_doc_fresh(doc, cutoff=cutoff) or store.lookup(doc.id):
+                continue
+            print doc.filename
+            get_stored_path(doc.id, doc.url)
+            count += 1
+            time.sleep(tea_core.DEFAULT_SHORT_WAIT)
+    return count
+
+
+def serve(port=idem_settings.docserver_port, host="localhost"):
+    server = DocumentServer((host, port), DocumentHandler)
+    print "Serving documents on %s:%d" % (host, port)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    serve()
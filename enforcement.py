@@ -190,7 +190,7 @@ class EnforcementQuerySession:
         filepath = self.build_filepath()
         page = urllib2.urlopen(url, timeout=tea_core.TIMEOUT).read()
         self.page = page
-        open(filepath, "w").write(page)
+        tea_core.save_snapshot(page, filepath)
         self.page2rows()
         self.rows2objects()
         self.download_files()
@@ -9,21 +9,34 @@
 # inserting links for CAA & NPDES permits
 # fix recurrent log glitches
 
+import bisect
 import collections
 import datetime
 import geojson
+import hashlib
 from hurry.filesize import size as convert_size
+import heapq
+import math
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import os
 import re
 import requests
 import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
 import time
 import urllib
 import urllib2
+import urlparse
 import xml.parsers.expat
 
 import idem_settings
+import pageparser
 import tea_core
+import workqueue
 from tea_core import TIMEOUT
 
 lakezips = idem_settings.lake_zips
@@ -33,6 +46,20 @@ permitdir = idem_settings.permitdir
 enforcementdir = idem_settings.enforcementdir
 latlong_filepath = os.path.join(idem_settings.maindir, "facilitydump.txt")
 latest_json_path = os.path.join(idem_settings.websitedir, "latest_vfc.json")
+docserver_url = idem_settings.docserver_url  # if set, popups link to docserver.py instead of ECM
+on_demand = bool(docserver_url)  # fetch documents when read rather than downloading in bulk
+blobdir = os.path.join(idem_settings.maindir, "Blobs")
+queue_path = os.path.join(idem_settings.maindir, "queue.sqlite")
+_blob_store = None
+_scheduler = None
+_cost_model = None
+_manifests = {}
+store_path = os.path.join(idem_settings.maindir, "facilities.sqlite")
+use_store = idem_settings.use_sqlite_store  # keep facilities and documents in a SQLite store instead of TSVs
+_store = None
+known_docs_path = os.path.join(idem_settings.maindir, "known_docs.sqlite")
+use_known_docs = idem_settings.use_known_doc_index  # check crawled rows against a statewide index of document ids
+_known_docs = None
 
 
 class Document(tea_core.Thing):
@@ -106,9 +133,21 @@ class Document(tea_core.Thing):
         self.url = domain + relative_url
 
     def retrieve_binary_file(self):
-        response = self.session.get(self.url, stream=True)
-        with open(self.path, 'wb') as out_file:
-            shutil.copyfileobj(response.raw, out_file)
+        if self.link_from_store():
+            return
+        digest = fetch_into_store(self.id, self.url, session=self.session)
+        get_blob_store().link(digest, self.path)
+
+    def link_from_store(self):
+        """
+        Link document into place from the blob store if it has already been fetched, e.g. for another facility.
+        :return: bool
+        """
+        if not self.id:
+            return False
+        store = get_blob_store()
+        whether_linked = store.link_key(self.id, self.path)
+        return whether_linked
 
     def retrieve_file_patiently(self):
         tea_core.do_patiently(self.retrieve_binary_file)
@@ -138,9 +177,14 @@ class Facility(tea_core.Thing):  # data structure
     last_check = None
     latlong = False
     latlong_address = ""
-    page = ""
+    lazy = False  # stub: docs, page and file listing are loaded on first use
     parent = None
     real_name = ""  # placeholder for potential manual alterationsim
+    incremental_resultcount = 5  # enough to reach a known document at most quiet facilities
+    page_fingerprint = ""  # of the first page fetched at the last check
+    page_unchanged = False
+    max_log_segments = 20  # out-of-order appended batches tolerated before the docs TSV is rewritten
+    max_resultcount = 500
     resultcount = 20
     row = ""
     state = ""
@@ -151,11 +195,18 @@ class Facility(tea_core.Thing):  # data structure
     zip = ""
 
     def __init__(self, row=None, parent=None, directory=None, date=None, vfc_id=None, retrieve=False, tsv=None,
-                 **arguments):
+                 lazy=False, **arguments):
         self.updated_docs = set()
-        self.downloaded_filenames = set()
-        self.session = requests.Session()
-        self.docs = DocumentCollection()
+        self.lazy = lazy
+        self.docs_in_tsv = tsv is not None
+        self.docs_in_store = False  # stub loaded from the store, whose docs come from there too
+        self._downloaded_filenames = None if lazy else set()
+        self._snapshot = None
+        self._session = None
+        self._docs = None if lazy else DocumentCollection()
+        self._page = None if lazy and tsv is None else ""
+        self.logged_rows = None  # filename -> TSV line as last saved (docs TSV or store); None forces a full write
+        self.log_needs_compaction = False
         if vfc_id:
             self.vfc_id = vfc_id
         if row:  # overrides vfc_id if set
@@ -168,22 +219,18 @@ class Facility(tea_core.Thing):  # data structure
             self.date = date
         else:
             self.date = datetime.date.today()
-        self.set_directory(directory=directory)
+        self.set_directory(directory=directory, create=not lazy)
         super(Facility, self).__init__(tsv=tsv)
         if arguments:
             tea_core.assign_values(self, arguments, tolerant=True, cautious=True)
+        if lazy:
+            return
         self.downloaded_filenames = self.get_downloaded_docs()
         if retrieve:
             self.retrieve_page_if_missing()
-        if not self.downloaded_filenames:
-            self.downloaded_filenames = self.get_downloaded_docs()
         if not tsv:
             self.docs_from_directory()
             self.get_latest_page()
-        if retrieve:
-            self.retrieve_page_if_missing()
-        if not self.downloaded_filenames:
-            self.downloaded_filenames = self.get_downloaded_docs()
 
     def __eq__(self, other):
         return hash(self) == hash(other)
@@ -194,12 +241,83 @@ class Facility(tea_core.Thing):  # data structure
     def __hash__(self):
         return hash(self.identity)
 
+    @property
+    def docs(self):
+        if self._docs is None:  # stub being touched for the first time
+            self._docs = DocumentCollection()
+            self.load_docs()
+        return self._docs
+
+    @docs.setter
+    def docs(self, value):
+        previous = self._docs
+        self._docs = value
+        if previous is not None and value is not None and previous is not value:
+            for index, facility in previous.indexes:  # re-register with any index that was following the old docs
+                index.remove_facility(self)
+                index.add_facility(self)
+
+    @property
+    def page(self):
+        if self._page is None:
+            self._page = ""
+            self.get_latest_page()
+        return self._page
+
+    @page.setter
+    def page(self, value):
+        self._page = value
+
+    @property
+    def downloaded_filenames(self):
+        if self._downloaded_filenames is None:
+            self._downloaded_filenames = self.get_downloaded_docs()
+        return self._downloaded_filenames
+
+    @downloaded_filenames.setter
+    def downloaded_filenames(self, value):
+        self._downloaded_filenames = value
+
+    @property
+    def session(self):
+        if self._session is None:
+            self._session = requests.Session()
+        return self._session
+
+    @session.setter
+    def session(self, value):
+        self._session = value
+
+    def load_docs(self):
+        if self.docs_in_store:
+            self._docs.extend(get_store().load_docs(self.vfc_id))
+            self.logged_rows = self.get_doc_rows()
+        elif self.docs_in_tsv:
+            if os.path.exists(self.docs_path):
+                self.load_docs_from_tsv()
+        else:
+            self.docs_from_directory()
+
+    def make_directory(self):
+        if self.directory and not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    @property
+    def snapshot(self):
+        """
+        Listing of the facility directory, taken on first use and kept current by the methods that write to it.
+        :return: tea_core.DirectorySnapshot
+        """
+        if self._snapshot is None or self._snapshot.directory != self.directory:
+            self._snapshot = tea_core.DirectorySnapshot(self.directory, prefix=self.vfc_id)
+        return self._snapshot
+
     @property
     def since_last_scan(self):
         if self.last_check:
             days_since_scan = (datetime.date.today() - self.last_check).days
         else:
-            days_since_scan = since_last_scan(self.directory)
+            days_since_scan = since_last_scan(self.directory, snapshot=self.snapshot)
         return days_since_scan
 
     @property
@@ -271,8 +389,7 @@ class Facility(tea_core.Thing):  # data structure
     def get_downloaded_docs(self):
         docs = set()
         if self.directory:
-            docs = set(os.listdir(self.directory))
-            docs = set(filter(lambda x: x.endswith(".pdf"), docs))
+            docs = set(self.snapshot.pdfs)
             self.downloaded_filenames = docs
         return docs
 
@@ -307,91 +424,166 @@ class Facility(tea_core.Thing):  # data structure
     def docs_from_directory(self):
         if not self.directory:
             return
-        filenames = os.listdir(self.directory)
+        filenames = list(self.snapshot.log_pages)
         if self.worry_about_crawl_date:
             self.docs = self.docs_from_pages(filenames)
         else:
             self.get_latest_page()
             self.docs = self.docs_from_page(self.page)
 
-    def docs_from_page(self, page, crawl_date=None):
+    def docs_from_page(self, page, crawl_date=None, known_ids=None):
+        if known_ids is None:
+            known_ids = self.docs.ids
         # pattern for older (pre-Aug 2018) pages
         docs = DocumentCollection()
         old_style_rows = self.get_info_from_old_style_rows(page)
         if old_style_rows:
             for rowdata in old_style_rows:
                 docid = rowdata[1]
-                if docid in self.docs.ids:
+                if docid in known_ids:
                     continue
                 else:
-                    newdoc = Document(row=rowdata, facility=self, crawl_date=crawl_date, session=self.session)
+                    newdoc = Document(row=rowdata, build=True, facility=self, crawl_date=crawl_date,
+                                      session=self.session)
                     docs.append(newdoc)
         # newer pattern
         else:
-            rows = page.split("<tr")[1:]
-            rows = [x for x in rows if "xuiListContentCell" in x]
-            for rowtext in rows:
-                linkcatcher = re.search('(\d+)\.pdf"', rowtext)
-                if not linkcatcher:
+            for row in pageparser.iter_doc_rows(page):
+                if row.fileid in known_ids:
                     continue
-                fileid = linkcatcher.group(1)
-                if fileid in self.docs.ids:
-                    continue
-                else:
-                    newdoc = build_document_from_row(rowtext, self, crawl_date=crawl_date)
+                rowdata = row.to_rowdata()
+                if rowdata:
+                    newdoc = build_document_from_rowdata(rowdata, self, crawl_date=crawl_date)
                     docs.append(newdoc)
         docs.sort()
         return docs
 
-    def filename_to_docs(self, filename):
-        datecatcher = re.search("\d\d\d\d-\d\d-\d\d", filename)
+    def filename_to_docs(self, filename, known_ids=None):
+        datecatcher = tea_core.DirectorySnapshot.date_pattern.search(filename)
         if datecatcher is None:
             return []
         crawl_date_iso = datecatcher.group(0)
-        filepath = os.path.join(self.directory, filename)
-        page = open(filepath).read()
+        page = self.snapshot.read(filename)
         crawl_date = date_from_iso(crawl_date_iso)
-        page_docs = self.docs_from_page(page, crawl_date=crawl_date)
+        page_docs = self.docs_from_page(page, crawl_date=crawl_date, known_ids=known_ids)
         return page_docs
 
     def docs_from_pages(self, filenames):
         all_docs = DocumentCollection()
+        for doc in self.get_first_seen_docs(filenames):
+            if doc.id in self.docs.ids:  # already crawled on previous date
+                continue
+            else:
+                all_docs.append(doc)
+        return all_docs
+
+    def get_first_seen_docs(self, filenames):
+        """
+        Every document in the first-seen record or on the given log pages, dated by the first page that listed it.
+        :param filenames: list of log page filenames
+        :return: DocumentCollection
+        """
+        first_seen = DocumentCollection()
+        if os.path.exists(self.first_seen_path):
+            for doc in DocumentCollection(tsv=open(self.first_seen_path).read()):
+                doc.facility = self
+                doc.session = self.session
+                first_seen.append(doc)
+        cache = PageCache(self.page_cache_path)
         filenames.sort()  # put in chronological order
+        basis = ""
+        seen = set()
         for filename in filenames:
             if not filename:
                 continue
-            page_docs = self.filename_to_docs(filename)
+            basis = cache.chain(basis, filename, self.snapshot.stamp(filename))
+            for doc in self.cached_filename_to_docs(filename, cache, basis, seen):
+                first_seen.append(doc)
+        cache.retain(filenames)
+        if cache.changed:
+            cache.save()
+            self.snapshot.add(os.path.basename(cache.path))
+        return first_seen
+
+    @property
+    def first_seen_path(self):
+        filename = self.vfc_id + "_firstseen.tsv"
+        first_seen_path = os.path.join(self.directory, filename)
+        return first_seen_path
+
+    def compact_history(self, cutoff, period="month"):
+        """
+        Fold all log pages into the first-seen record, then drop those before cutoff other than checkpoints.
+        :param cutoff: str (ISO date)
+        :param period: "week" or "month"
+        :return: dict of snapshot source -> set of dates kept, for SnapshotStore.prune()
+        """
+        filenames = list(self.snapshot.log_pages)
+        first_seen = self.get_first_seen_docs(filenames)
+        tea_core.write_text_atomically(first_seen.to_tsv(), self.first_seen_path)  # before any page goes
+        self.snapshot.add(os.path.basename(self.first_seen_path))
+        dated = dict([(self.snapshot.dates[x], x) for x in filenames if x in self.snapshot.dates])
+        keep = tea_core.choose_checkpoints(dated.keys(), cutoff, period)
+        self.snapshot.discard([x for date, x in dated.items() if date not in keep])
+        source = os.path.join(os.path.abspath(self.directory), self.vfc_id + "_*")
+        return {source: keep}
+
+    def cached_filename_to_docs(self, filename, cache, basis, seen):
+        """
+        Documents a saved log page lists that no earlier page did, parsed only if this page or an earlier one is new
+        or has changed since it was cached.
+        :param filename: str
+        :param cache: PageCache
+        :param basis: str (PageCache.chain() of this page and every earlier one)
+        :param seen: set of filenames of documents on earlier pages; updated with this page's
+        :return: list of Document
+        """
+        page_docs = cache.get(filename, basis)
+        if page_docs is None:
+            page_docs = [x for x in self.filename_to_docs(filename, known_ids=set()) if x.filename not in seen]
+            cache.put(filename, basis, page_docs)
+        else:
             for doc in page_docs:
-                if doc.id in self.docs.ids:  # already crawled on previous date
-                    continue
-                else:
-                    all_docs.append(doc)
-        return all_docs
+                doc.facility = self
+                doc.session = self.session
+        seen.update([x.filename for x in page_docs])
+        return page_docs
+
+    @property
+    def page_cache_path(self):
+        filename = self.vfc_id + "_pages.tsv"
+        page_cache_path = os.path.join(self.directory, filename)
+        return page_cache_path
 
     @staticmethod
     def get_info_from_old_style_rows(page):
-        pattern = '<tr>.+?<a.+?href="(/cs/.+?[^\d](\d{7, 9})\.pdf)"[\s\S]+?>(\d+)/(\d+)' \
-            '/(\d\d\d\d)<[\s\S]+?nowrap="nowrap">(.+?)<[\s\S]+?nowrap="nowrap">(\d+)</div>[\s\S]+?' \
-            'nowrap="nowrap">(.+?)</div>'
-        old_style_rows = re.findall(pattern, page)
+        old_style_rows = pageparser.get_old_style_rows(page)
         return old_style_rows
 
-    def download(self, filenames=None):
+    def download(self, filenames=None, plan=None, journal=None):
         allfiles = set()
         if filenames is None:
             filenames = set(self.docs.namedic.keys()) - self.downloaded_filenames
             filenames = sorted(list(filenames))
         for filename in filenames:
+            if plan is not None and not plan.has_room():
+                plan.defer(self.vfc_id, "downloads")
+                break
             print filename, "%d/%d" % (1 + filenames.index(filename), len(filenames))
             doc = self.download_filename(filename)
             allfiles.add(doc)
             self.downloaded_filenames.add(filename)
+            if journal is not None:
+                journal.record("download", os.path.join(self.vfc_id, filename), doc.id)
         return allfiles
 
     def download_filename(self, filename):
         doc = self.docs.namedic[filename]
+        self.make_directory()
         doc.path = os.path.join(self.directory, filename)
-        doc.retrieve_file_patiently()
+        if not doc.link_from_store():
+            doc.retrieve_file_patiently()
+        self.snapshot.add(filename)
         return doc
 
     def is_log_page(self, filename):
@@ -411,8 +603,7 @@ class Facility(tea_core.Thing):  # data structure
         Provide an unfiltered set of all filenames in the facility directory.
         :return: set
         """
-        filenames = os.listdir(self.directory)
-        filenames = set(filenames)
+        filenames = set(self.snapshot.names)
         return filenames
 
     def get_latest_page(self):
@@ -420,18 +611,98 @@ class Facility(tea_core.Thing):  # data structure
         Provide content of latest downloaded log page in facility directory.
         :return: str
         """
-        logpages = filter(self.is_log_page, self.get_all_filenames())
-        if not logpages:
+        newest = self.snapshot.latest_log_page()
+        if newest is None:
             return ""
-        logpages.sort()
-        newest = logpages[-1]
-        path_to_newest = os.path.join(self.directory, newest)
-        self.page = open(path_to_newest).read()
+        self.page = self.snapshot.read(newest)
         return self.page
 
+    def pack_pages(self):
+        """
+        Move this facility's loose log pages into its packfile; they stay readable through the snapshot.
+        :return: int (number of pages packed)
+        """
+        packed = pack_log_pages(self.directory, prefix=self.vfc_id)
+        self.snapshot.refresh()
+        return packed
+
+    def read_new_docs_from_page(self, page, crawl_date=None):
+        """
+        Parse rows from the top of a page sorted newest first, stopping at the first document already known.
+        :param page: str
+        :param crawl_date: datetime.date
+        :return: tuple (DocumentCollection, bool whether a known document was reached)
+        """
+        if self.get_info_from_old_style_rows(page):  # pre-Aug 2018 layout; no early exit
+            return self.docs_from_page(page, crawl_date=crawl_date), True
+        docs = DocumentCollection()
+        for row in pageparser.iter_doc_rows(page):
+            if self.is_known_doc(row.fileid):
+                return docs, True
+            rowdata = row.to_rowdata()
+            if rowdata:
+                docs.append(build_document_from_rowdata(rowdata, self, crawl_date=crawl_date))
+        return docs, False
+
+    def check_for_new_docs_incrementally(self):
+        """
+        Fetch only as much of the facility's newest-first listing as needed to reach an already-known document,
+        growing the page size only while every row returned is new.
+        :return: list
+        """
+        if not self.has_docs():
+            return self.check_for_new_docs()
+        resultcount = self.incremental_resultcount
+        first_fingerprint = None
+        while True:
+            page = self.retrieve_page(resultcount=resultcount)
+            if first_fingerprint is None:
+                first_fingerprint = self.page_fingerprint
+                if self.page_unchanged:
+                    return []
+            new_docs, reached_known = self.read_new_docs_from_page(page, crawl_date=datetime.date.today())
+            if reached_known or not page:
+                break
+            if resultcount >= get_total_from_page(page) or resultcount >= self.max_resultcount:
+                break
+            resultcount = min(resultcount * 5, self.max_resultcount)
+        self.page_fingerprint = first_fingerprint  # so that tomorrow's first page is compared with today's
+        if not new_docs:  # a stub with nothing new stays unloaded
+            return []
+        new_docs = [x for x in new_docs if x not in self.docs]
+        self.docs.extend(new_docs)
+        new_docs.sort()
+        return new_docs
+
+    def has_docs(self):
+        """
+        Whether any documents are on record for this facility, without loading a stub's docs if the index knows.
+        """
+        if self._docs is None and use_known_docs and get_known_docs().has_facility(self.vfc_id):
+            return True
+        return bool(self.docs)
+
+    def is_known_doc(self, docid):
+        """
+        Whether a document id is already on record for this facility. For a stub this asks the statewide index
+        rather than loading the facility's docs.
+        """
+        if self._docs is None and use_known_docs:
+            return get_known_docs().is_known(docid, self.vfc_id)
+        return docid in self.docs.ids
+
+    def record_known_docs(self, docs):
+        if use_known_docs:
+            get_known_docs().add_docs(self.vfc_id, [x.id for x in docs])
+
     def check_for_new_docs(self, page=None):
         if not page:
-            page = self.retrieve_page()
+            if self.docs:
+                page = self.retrieve_page()
+                if self.page_unchanged:
+                    return []
+            else:  # first sight: harvest every page of results, not just the first 500
+                page = self.retrieve_all_pages()
         docs = self.docs_from_page(page, crawl_date=datetime.date.today())
         new_docs = list(set(docs) - set(self.docs))
         self.docs.extend(new_docs)
@@ -452,7 +723,7 @@ class Facility(tea_core.Thing):  # data structure
                     if filename in docdic.keys():
                         whether_local_pdf = True
             return whether_local_pdf
-        localfiles = filter(is_local_pdf, os.listdir(self.directory))
+        localfiles = filter(is_local_pdf, self.snapshot.pdfs)
         updated = set()
         for localfile in localfiles:
             doc = docdic[localfile]
@@ -467,20 +738,53 @@ class Facility(tea_core.Thing):  # data structure
             updated.add(doc)
         return updated
 
-    def retrieve_page(self, firsttime=True):
-        if firsttime is False and len(self.downloaded_filenames) > 0:
+    def retrieve_page(self, firsttime=True, resultcount=None):
+        if resultcount is not None:
+            self.resultcount = resultcount
+        elif firsttime is False and len(self.downloaded_filenames) > 0:
             self.resultcount = 20
         else:
-            self.resultcount = 500
+            self.resultcount = self.max_resultcount
         starturl = self.ecm_url
         self.page = self.retrieve_page_patiently(starturl)
         self.last_check = datetime.date.today()
-        pagefilename = self.vfc_id + "_" + self.date.isoformat()
-        pagepath = os.path.join(self.directory, pagefilename)
-        open(pagepath, "w").write(self.page)
+        fingerprint = get_page_fingerprint(self.page)
+        self.page_unchanged = bool(fingerprint) and fingerprint == self.page_fingerprint
+        self.page_fingerprint = fingerprint
+        if not self.page_unchanged and not self.page_truncated:  # an identical page is already on disk
+            self.save_page()
         time.sleep(tea_core.DEFAULT_WAIT)
         return self.page
 
+    def retrieve_all_pages(self):
+        self.resultcount = self.max_resultcount
+        pager = ResultPager(self.ecm_url, page_size=self.resultcount, session=self.session)
+        self.page = "".join(pager.fetch_all())
+        self.last_check = datetime.date.today()
+        self.save_page()
+        return self.page
+
+    @property
+    def page_truncated(self):
+        """
+        Whether the current page lists only some of the documents, e.g. an incremental probe. Such pages are not
+        saved, since readers take the latest saved page as the full listing.
+        """
+        if self.resultcount >= self.max_resultcount:
+            return False
+        return get_total_from_page(self.page) > self.resultcount
+
+    def save_page(self):
+        self.make_directory()
+        tea_core.write_text_atomically(self.page, self.page_path)  # packed later, so not a snapshot
+        self.snapshot.add(os.path.basename(self.page_path))
+
+    @property
+    def page_path(self):
+        pagefilename = self.vfc_id + "_" + self.date.isoformat()
+        pagepath = os.path.join(self.directory, pagefilename)
+        return pagepath
+
     @property
     def ecm_url(self):
         starturl = idem_settings.ecm_domain \
@@ -530,15 +834,8 @@ class Facility(tea_core.Thing):  # data structure
 
     @property
     def whether_to_update(self):
-        magic_ratio = 4
-        sincecheck = self.since_last_scan
-        sincenewfile = self.since_new_file
-        if sincecheck < 1:
-            should_update = False
-        elif sincenewfile / sincecheck > magic_ratio:
-            should_update = False
-        else:
-            should_update = True
+        entry = ScheduleEntry(facility=self)
+        should_update = entry.is_due()
         return should_update
 
     @property
@@ -548,8 +845,43 @@ class Facility(tea_core.Thing):  # data structure
         return docs_path
 
     def load_docs_from_tsv(self):
-        path = self.docs_path
-        self.docs.from_tsv(path=path)
+        """
+        Read the docs TSV, which is a log: a compacted, sorted body followed by lines appended since. A later line
+        for a filename replaces an earlier one.
+        """
+        tsv = open(self.docs_path).read()
+        if tsv and not tsv.endswith("\n"):  # torn append; keep only complete lines
+            tsv = tsv[:tsv.rfind("\n") + 1]
+            self.log_needs_compaction = True
+        lines = [x for x in tsv.split("\n")[1:] if x.strip()]
+        latest = collections.OrderedDict()
+        for line in lines:
+            doc = Document(tsv=line)
+            latest[doc.filename or line] = doc
+        self.docs.extend(latest.values())
+        segments = 1 + len([1 for x, y in zip(self.docs, self.docs[1:]) if y < x])
+        if len(lines) != len(self.docs) or segments > self.max_log_segments:
+            self.log_needs_compaction = True
+        self.logged_rows = self.get_doc_rows()
+
+    def get_doc_rows(self):
+        """
+        :return: dict of filename -> docs TSV line
+        """
+        return dict([(name, doc.to_tsv()) for name, doc in self.docs.namedic.items()])
+
+    @property
+    def docs_dirty(self):
+        """
+        Whether the docs TSV is missing or out of date on anything, or needs compacting. Untouched stubs are never
+        dirty.
+        """
+        if self._docs is None:
+            return False
+        if self.logged_rows is None or self.log_needs_compaction:
+            return True
+        return len(self._docs.namedic) != len(self.logged_rows) or \
+            any(self.logged_rows.get(name) != doc.to_tsv() for name, doc in self._docs.namedic.items())
 
     def to_tsv(self, callback=None):
         tsv = super(Facility, self).to_tsv(callback=callback)
@@ -561,16 +893,66 @@ class Facility(tea_core.Thing):  # data structure
             self.latlong = destring_latlong_pair(self.latlong)
         if self.last_check:
             self.last_check = date_from_iso(self.last_check)
-        if load_docs:
+        if load_docs and not self.lazy:
             self.load_docs_from_tsv()
 
-    def save_docs_to_tsv(self, path=None):
+    def save_docs(self, compact=False):
+        """
+        Save new and changed docs where docs are kept: the store if it is in use, else the docs TSV.
+        :param compact: bool (rewrite the docs TSV in full)
+        :return: list (docs written)
+        """
+        if not use_store:
+            return self.save_docs_to_tsv(compact=compact)
+        rows = self.get_doc_rows()
+        logged = self.logged_rows or {}
+        changed = sorted([self.docs.namedic[x] for x, line in rows.items() if logged.get(x) != line])
+        if changed:
+            get_store().save_docs(self, changed)
+            self.record_known_docs([x for x in changed if x.filename not in logged])
+        self.logged_rows = rows
+        return changed
+
+    def save_docs_to_tsv(self, path=None, compact=False):
+        """
+        Bring the docs TSV up to date, by appending the docs that are new or changed where possible.
+        :param path: str (if given, write a complete TSV there instead)
+        :param compact: bool (rewrite the log in full, sorted)
+        :return: list (docs written)
+        """
         if path is None:
             path = self.docs_path
+            rows = self.get_doc_rows()
+            logged = self.logged_rows
+            can_append = logged is not None and all(x in rows for x in logged)
+            if can_append and not compact and not self.log_needs_compaction and os.path.exists(path):
+                return self.append_docs_to_tsv(path, rows)
+            self.logged_rows = rows
+            self.log_needs_compaction = False
+            if logged is None:
+                self.record_known_docs(self.docs)
+            else:
+                self.record_known_docs([y for x, y in self.docs.namedic.items() if x not in logged])
         docs_tsv = self.docs.to_tsv()
+        self.make_directory()
         handle = open(path, "w")
         with handle:
             handle.write(docs_tsv)
+        if os.path.dirname(path) == self.directory:
+            self.snapshot.add(os.path.basename(path))
+        return list(self.docs)
+
+    def append_docs_to_tsv(self, path, rows):
+        changed = sorted([self.docs.namedic[x] for x, line in rows.items() if self.logged_rows.get(x) != line])
+        if not changed:
+            return []
+        handle = open(path, "a")
+        with handle:
+            handle.write("".join([rows[x.filename] for x in changed]))
+        new_docs = [x for x in changed if x.filename not in self.logged_rows]
+        self.logged_rows.update(rows)
+        self.record_known_docs(new_docs)
+        return changed
 
 
 class ZipUpdater:
@@ -589,6 +971,10 @@ class ZipUpdater:
         self.worry_about_crawl_date = True
         self.firsttime = True
         self.offline = False
+        self.plan = None
+        self.journal = None
+        self.lazy = False  # build facilities as stubs
+        self.saved_lines = None  # facility TSV lines as last loaded or saved, to tell which facilities changed
         self.directory = os.path.join(maindir, zipcode)
         self.date = datetime.date.today()
         self.zipurl = build_zip_url(zipcode)
@@ -613,11 +999,16 @@ class ZipUpdater:
         if self.whether_update_zip_info is True:
             self.update_info()
         self.get_updated_facilities()
+        save_manifests()
         self.log_updates_ecm()
 
     def update_info(self):
         print "Updating ZIP info"
+        costs = get_cost_model()
+        costs.start(costs.zip_key(self.zip))
         self.retrieve_zip_page()
+        costs.stop()
+        get_scheduler().record_zip_refresh(self.zip, self.date)
         self.get_facilities_from_page(self.page)
 
     def get_active_sites(self, lookback=7):
@@ -627,43 +1018,30 @@ class ZipUpdater:
         return active_sites
 
     def retrieve_zip_page(self):
-        zippage = get_page_patiently(self.zipurl, session=self.session)
-        if self.need_to_get_second_page(zippage):
-            nextpage = self.retrieve_second_page()
-            zippage += nextpage
+        pager = ResultPager(self.zipurl, get_total=get_zip_total_from_page, row_params=False, session=self.session,
+                            get_page_size=get_zip_page_size_from_page)
+        zippage = "".join(pager.fetch_all())
         self.save_zip_page(zippage)
         return zippage
 
-    @staticmethod
-    def need_to_get_second_page(zippage):
-        matchme = "Displaying Facilities 1 - (\d+) of (\d+)"
-        matched = re.search(matchme, zippage)
-        if matched:
-            thispagecount, totalcount = matched.group(1), matched.group(2)
-            if int(thispagecount) < int(totalcount):
-                return True
-        return False
-
     def save_zip_page(self, zippage):
         zipfilename = str(self.zip) + "_" + self.date.isoformat() + ".html"
         zippagepath = os.path.join(self.directory, zipfilename)
-        open(zippagepath, "w").write(zippage)
+        tea_core.save_snapshot(zippage, zippagepath)
         self.page = zippage
         return zippage
 
-    def retrieve_second_page(self):
-        print "fetching page 2..."  # nothing currently gets close to page 3
-        nexturl = self.zipurl + "&PageNumber=2"
-        nextpage = get_page_patiently(nexturl, session=self.session)
-        return nextpage
-
     def show_progress(self):
         progress = "%d/%d" % (self.count, len(self.facilities.ids))
         print self.current_facility.vfc_name, self.current_facility.vfc_id, progress
 
     def update_facility(self, facility):
         self.show_progress()
+        costs = get_cost_model()
+        costs.start(facility.vfc_id)
         self.fetch_facility_docs()
+        costs.stop()
+        get_scheduler().update(facility)
         time.sleep(tea_core.DEFAULT_SHORT_WAIT)
         if facility.updated_docs:
             print len(facility.updated_docs)
@@ -674,37 +1052,45 @@ class ZipUpdater:
     def handle_facility(self, site_id):
         facility = self.facilities.iddic[site_id]
         self.current_facility = facility
+        if self.plan is not None:
+            if not self.plan.allows(self.zip, site_id):
+                return
+            if not self.plan.has_room():
+                self.plan.defer(site_id, "out of budget")
+                return
+        if self.journal is not None and self.journal.is_done("facility", site_id):
+            return  # completed before an interruption
         if self.whether_update_facility(facility):
             self.update_facility(facility)
+            get_manifest(self.directory).record(facility, get_cost_model())
+            if self.journal is not None:
+                facility.save_docs()
+                self.journal.record("facility", site_id, len(facility.updated_docs))
+
+    def schedule_new_facilities(self):
+        """
+        Add facilities the scheduler hasn't seen to the schedule, due now, and to the plan if there is room.
+        :return: list of ScheduleEntry added
+        """
+        added = get_scheduler().add_new(self.facilities)
+        if self.plan is not None:
+            for entry in added:
+                self.plan.admit(self.zip, entry.vfc_id)
+        return added
 
     def get_updated_facilities(self):
         self.updated_facilities = []
         self.count = 0
+        self.schedule_new_facilities()
         for site_id in self.facilities.ids:
             self.count += 1
             self.handle_facility(site_id)
         return self.updated_facilities
 
-    def whether_update_facility(self, facility):  # todo: harmonize with facility.whether_to_update()
+    def whether_update_facility(self, facility):
         should_update = True
-        sincecheck = since_last_scan(facility.directory)
-        sincenewfile = since_last_file(facility.directory, download=self.whether_download)
         if self.firsttime is False and self.whether_update_facility_info is True:  # if no updating no need to skimp
-            should_update = self.whether_updatable_by_dates(sincecheck, sincenewfile)
-        return should_update
-
-    @staticmethod
-    def whether_updatable_by_dates(sincecheck, sincenewfile):
-        if sincecheck < 1:
-            should_update = False
-        elif sincenewfile > 60 and sincecheck < 3:  # somewhat arbitrary numbers here
-            should_update = False
-        elif sincenewfile > 365 and sincecheck < 10:
-            should_update = False
-        elif sincenewfile > 1500 and sincecheck < 30:
-            should_update = False
-        else:
-            should_update = True
+            should_update = facility.whether_to_update
         return should_update
 
     def log_updates_ecm(self):
@@ -740,7 +1126,12 @@ class ZipUpdater:
         return already
 
     def fetch_facility_docs(self):
-        if self.whether_update_facility_info is True:
+        resumed_path = None
+        if self.journal is not None:
+            resumed_path = self.journal.get("page", self.current_facility.vfc_id)
+        if resumed_path and os.path.exists(resumed_path):  # fetched before an interruption
+            page = open(resumed_path).read()
+        elif self.whether_update_facility_info is True:
             page = self.retrieve_facility_page()
         else:
             page = self.current_facility.get_latest_page()
@@ -752,9 +1143,14 @@ class ZipUpdater:
         starturl = self.current_facility.ecm_url
         page = get_page_patiently(starturl, session=self.session)
         self.current_facility.page = page
+        self.current_facility.last_check = self.date
         pagefilename = self.current_facility.vfc_id + "_" + self.date.isoformat()
         pagepath = os.path.join(self.current_facility.directory, pagefilename)
-        open(pagepath, "w").write(page)
+        self.current_facility.make_directory()
+        tea_core.write_text_atomically(page, pagepath)
+        self.current_facility.snapshot.add(pagefilename)
+        if self.journal is not None:
+            self.journal.record("page", self.current_facility.vfc_id, pagepath)
         return page
 
     def build_start_url(self, resultcount=20):
@@ -796,30 +1192,17 @@ class ZipUpdater:
         return updated
 
     def fetch_all_files_for_facility(self):
-        allfiles = set()
-        if not self.current_facility.page:
-            self.current_facility.page = self.retrieve_facility_page()
-        needle = "javascript:addQueryFilter\('xIDEMDocumentType', '([\w\s]+)'\)"
-        rawtypes = re.findall(needle, self.current_facility.page)
-        types = map(lambda x: x.replace(" ", "%20"), rawtypes)
-        print str(types)
-        for t in types:
-            morefiles = self.fetch_type_files(t)
-            allfiles |= morefiles
-            print len(morefiles), len(allfiles)
-            time.sleep(tea_core.DEFAULT_WAIT)
+        facility = self.current_facility
+        facility.resultcount = facility.max_resultcount
+        pager = ResultPager(facility.ecm_url, page_size=facility.resultcount, session=self.session)
+        facility.page = "".join(pager.fetch_all())
+        facility.check_for_new_docs(page=facility.page)
+        allfiles = self.fetch_files_for_current_facility()
+        print len(allfiles)
         return allfiles
 
-    def fetch_type_files(self, filetype):
-        print "***%s***" % filetype
-        url = generate_type_url(self.current_facility.vfc_id, filetype)
-        page = get_page_patiently(url, session=self.session)
-        self.current_facility.page += page
-        morefiles = self.fetch_files_for_current_facility()
-        return morefiles
-
     def fetch_files_for_current_facility(self):
-        newfiles = self.current_facility.download()
+        newfiles = self.current_facility.download(plan=self.plan, journal=self.journal)
         return newfiles
 
     def scan_zip_for_premature(self):
@@ -854,22 +1237,16 @@ class ZipUpdater:
             else:
                 self.fetch_files_for_current_facility()
 
-    def get_facility_from_row(self, row):
-        facility = Facility(row=row, parent=self, worry_about_crawl_date=self.worry_about_crawl_date)
+    def get_facility_from_info(self, info):
+        vfc_id, name, address, city = info
+        facility = Facility(vfc_id=vfc_id, parent=self, vfc_name=name, vfc_address=address, city=city,
+                            worry_about_crawl_date=self.worry_about_crawl_date, lazy=self.lazy)
         return facility
 
-    @staticmethod
-    def get_valid_rows_from_page(page):
-        rows = page.split("<tr>")[1:]
-        rows = [x for x in rows if "span class=idemfs" in x]
-        rows = [x for x in rows if "xAIID<matches>" in x]
-        return rows
-
     def get_facilities_from_page(self, page=None):
         if page is None:
             page = self.page
-        rows = self.get_valid_rows_from_page(page)
-        facility_list = map(self.get_facility_from_row, rows)
+        facility_list = map(self.get_facility_from_info, pageparser.iter_facility_rows(page))
         facilities = FacilityCollection(facility_list)
         self.facilities.extend(facilities)
 
@@ -886,27 +1263,146 @@ class ZipUpdater:
         path = os.path.join(directory, filename)
         return path
 
-    def load_tsv(self, path=None, load_docs=True):
+    def load_tsv(self, path=None, load_docs=True, from_store=None):
+        if from_store is None:
+            from_store = use_store and path is None
+        if from_store and get_store().has_zip(self.zip):
+            load_docs = load_docs and not self.lazy
+            self.facilities.extend(get_store().load_zip(self.zip, parent=self, load_docs=load_docs))
+            self.mark_saved()
+            return
         if path is None:
             path = self.tsv_path
         tsv = open(path).read()
-        facilities = FacilityCollection(tsv=tsv)
+        if self.lazy:
+            lines = [x for x in tsv.split("\n")[1:] if x.strip()]
+            facilities = FacilityCollection([Facility(tsv=x, lazy=True) for x in lines])
+        else:
+            facilities = FacilityCollection(tsv=tsv)
         for f in facilities:
             f.parent = self
         self.facilities.extend(facilities)
-        if load_docs:
+        if load_docs and not self.lazy:
             for f in facilities:
                 f.load_docs_from_tsv()
+        if path == self.tsv_path:
+            self.mark_saved()
+
+    def mark_saved(self):
+        self.saved_lines = dict([(x.vfc_id, x.to_tsv()) for x in self.facilities])
+
+    def get_changed_facilities(self):
+        """
+        :return: list of facilities that are new or whose TSV line differs from the one last loaded or saved
+        """
+        if self.saved_lines is None:
+            return list(self.facilities)
+        return [x for x in self.facilities if self.saved_lines.get(x.vfc_id) != x.to_tsv()]
 
     def save_tsv(self, path=None, savedocs=True):
-        if path is None:
-            path = self.tsv_path
-        tsv = self.facilities.to_tsv()
-        handle = open(path, "w")
-        with handle:
-            handle.write(tsv)
+        """
+        Write the ZIP TSV if any facility changed, and, if savedocs, append new docs to the facilities' docs TSVs.
+        With the store in use, write the changes there instead, unless a path is given.
+        """
+        changed = self.get_changed_facilities()
+        if use_store and path is None:
+            self.save_to_store(changed, savedocs)
+            return
+        removed = self.saved_lines is not None and set(self.saved_lines.keys()) != self.facilities.ids
+        if path is not None or changed or removed:
+            tsv = self.facilities.to_tsv()
+            handle = open(path or self.tsv_path, "w")
+            with handle:
+                handle.write(tsv)
+            if path is None or path == self.tsv_path:
+                self.mark_saved()
+        if savedocs:
+            self.facilities.save_docs()
+        if use_known_docs:
+            get_known_docs().save()
+
+    def save_to_store(self, changed, savedocs=True):
+        """
+        Write changed facilities and, if savedocs, new and changed docs to the store, and delete facilities that
+        have left the ZIP.
+        """
+        store = get_store()
+        store.save_facilities(changed, savedocs=False)
+        if self.saved_lines is None or set(self.saved_lines.keys()) != self.facilities.ids:
+            store.delete_missing(self.zip, self.facilities.ids)
         if savedocs:
             self.facilities.save_docs()
+        self.mark_saved()
+        if use_known_docs:
+            get_known_docs().save()
+
+
+class ResultPager:
+    """
+    Fetch every page of a paginated ECM result set. The first page supplies the total, and, if get_page_size is
+    given, the number of rows the server actually puts on a page; the remaining pages are fetched concurrently, with
+    request starts spaced out by a shared rate limiter.
+    """
+    max_pages = 100
+
+    def __init__(self, url, page_size=500, get_total=None, row_params=True, session=None, workers=3,
+                 min_interval=tea_core.DEFAULT_WAIT, get_page_size=None):
+        self.url = url
+        self.page_size = page_size
+        self.get_total = get_total or get_total_from_page
+        self.get_page_size = get_page_size
+        self.row_params = row_params  # ECM document searches also take StartRow/EndRow; facility searches don't
+        self.session = session
+        self.workers = workers
+        self.limiter = tea_core.RateLimiter(min_interval)
+        self.local = threading.local()
+        self.total = 0
+
+    def build_page_url(self, number):
+        url = self.url + "&PageNumber=%d" % number
+        if self.row_params:
+            start_row = (number - 1) * self.page_size + 1
+            end_row = number * self.page_size
+            url += "&StartRow=%d&EndRow=%d" % (start_row, end_row)
+        return url
+
+    def get_session(self):
+        if not hasattr(self.local, "session"):  # requests sessions are not shared between threads
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def fetch_page(self, number):
+        self.limiter.wait()
+        if number == 1 and self.session is not None:
+            session = self.session
+        else:
+            session = self.get_session()
+        return get_page_patiently(self.build_page_url(number), session=session)
+
+    def count_pages(self):
+        if not self.total:
+            return 1
+        page_count = int(math.ceil(float(self.total) / self.page_size))
+        return min(page_count, self.max_pages)
+
+    def fetch_all(self):
+        """
+        :return: list of page texts, in page order
+        """
+        first_page = self.fetch_page(1)
+        self.total = self.get_total(first_page)
+        if self.get_page_size is not None:
+            self.page_size = self.get_page_size(first_page) or self.page_size
+        page_count = self.count_pages()
+        if page_count < 2:
+            return [first_page]
+        print "fetching %d more pages..." % (page_count - 1)
+        pool = ThreadPool(min(self.workers, page_count - 1))
+        try:
+            more_pages = pool.map(self.fetch_page, range(2, page_count + 1))
+        finally:
+            pool.close()
+        return [first_page] + more_pages
 
 
 class DocumentCollection(tea_core.ThingCollection):
@@ -923,6 +1419,7 @@ class DocumentCollection(tea_core.ThingCollection):
         self.namedic = {}
         self.latest_file_date = None
         self.latest_crawl_date = None
+        self.indexes = []  # (DocumentIndex, Facility) pairs to tell about additions
         super(DocumentCollection, self).__init__(iterator, tsv=tsv)
 
     def recalculate(self):
@@ -951,6 +1448,8 @@ class DocumentCollection(tea_core.ThingCollection):
         self.items.add(document)
         self.namedic[document.filename] = document
         self.update_dates(document)
+        for index, facility in self.indexes:
+            index.add(facility, document)
 
     @property
     def latest_date(self):
@@ -966,6 +1465,114 @@ class DocumentCollection(tea_core.ThingCollection):
             return None
 
 
+class DocumentIndex:
+    """
+    The documents of many facilities, sorted by file date and by latest (file or crawl) date, so that range and
+    "since" queries are bisections. Facilities' document collections report additions as they happen.
+    """
+
+    def __init__(self, facilities=()):
+        self.facilities = set()
+        self.docs = {}  # (vfc_id, filename) -> (facility, document)
+        self.by_file_date = []  # (file date, vfc_id, filename)
+        self.by_latest_date = []  # (latest date, vfc_id, filename)
+        self.facility_dates = {}  # facility -> sorted list of (latest date, filename)
+        self.facility_entries = {}  # facility -> list of (key, file date entry, latest date entry) it added
+        for facility in facilities:
+            self.add_facility(facility, sort=False)
+        self.by_file_date.sort()
+        self.by_latest_date.sort()
+        for dates in self.facility_dates.values():
+            dates.sort()
+
+    def add_facility(self, facility, sort=True):
+        if facility in self.facilities:
+            return
+        self.facilities.add(facility)
+        self.facility_dates[facility] = []
+        self.facility_entries[facility] = []
+        docs = facility.docs
+        docs.indexes.append((self, facility))
+        for doc in docs:
+            self.add(facility, doc, sort=sort)
+
+    def remove_facility(self, facility):
+        if facility not in self.facilities:
+            return
+        self.facilities.discard(facility)
+        del self.facility_dates[facility]
+        if facility._docs is not None:
+            facility._docs.indexes = [x for x in facility._docs.indexes if x[0] is not self]
+        for key, file_entry, latest_entry in self.facility_entries.pop(facility):
+            del self.docs[key]
+            self.discard(self.by_file_date, file_entry)
+            self.discard(self.by_latest_date, latest_entry)
+
+    @staticmethod
+    def discard(entries, entry):
+        if entry is None:
+            return
+        i = bisect.bisect_left(entries, entry)
+        if i < len(entries) and entries[i] == entry:
+            del entries[i]
+
+    def add(self, facility, doc, sort=True):
+        key = (facility.vfc_id, doc.filename)
+        if key in self.docs:
+            return
+        self.docs[key] = (facility, doc)
+        insert = bisect.insort if sort else list.append
+        file_entry = (doc.file_date,) + key if doc.file_date else None
+        latest_entry = (doc.latest_date,) + key if doc.latest_date else None
+        if file_entry:
+            insert(self.by_file_date, file_entry)
+        if latest_entry:
+            insert(self.by_latest_date, latest_entry)
+            insert(self.facility_dates.setdefault(facility, []), (doc.latest_date, doc.filename))
+        self.facility_entries.setdefault(facility, []).append((key, file_entry, latest_entry))
+
+    def get_docs(self, start_date=None, end_date=None, field="file_date"):
+        """
+        :param start_date: datetime.date (inclusive)
+        :param end_date: datetime.date (inclusive)
+        :param field: "file_date" or "latest_date"
+        :return: list of (facility, document), in date order
+        """
+        entries = self.by_file_date if field == "file_date" else self.by_latest_date
+        start = 0 if start_date is None else bisect.bisect_left(entries, (start_date,))
+        end = len(entries)
+        if end_date is not None:
+            end = bisect.bisect_left(entries, (end_date + datetime.timedelta(1),))
+        return [self.docs[x[1:]] for x in entries[start:end]]
+
+    def get_active_since(self, cutoff_date):
+        """
+        :return: set of facilities with a document filed or first seen on or after cutoff_date
+        """
+        return set([x[0] for x in self.get_docs(start_date=cutoff_date, field="latest_date")])
+
+    def tally_since(self, facility, sincedate):
+        """
+        :return: int (number of the facility's documents filed or first seen after sincedate)
+        """
+        dates = self.facility_dates.get(facility, [])
+        return len(dates) - bisect.bisect_left(dates, (sincedate + datetime.timedelta(1),))
+
+    def get_facility_docs_since(self, facility, reference_date):
+        dates = self.facility_dates.get(facility, [])
+        start = bisect.bisect_left(dates, (reference_date,))
+        return [self.docs[(facility.vfc_id, x[1])][1] for x in dates[start:]]
+
+
+def get_doc_index(facility):
+    """
+    :return: DocumentIndex that the facility's documents report to, or None
+    """
+    if facility._docs is None or not facility._docs.indexes:
+        return None
+    return facility._docs.indexes[0][0]
+
+
 class FacilityCollection(tea_core.ThingCollection):
     type_of_thing = Facility
 
@@ -973,6 +1580,7 @@ class FacilityCollection(tea_core.ThingCollection):
         self.iddic = {}
         self.ids = set()
         self.namedic = collections.defaultdict(list)
+        self._doc_index = None
         super(FacilityCollection, self).__init__(iterator, tsv=tsv)
         if tsv is not None:
             self.from_tsv(tsv)
@@ -990,10 +1598,25 @@ class FacilityCollection(tea_core.ThingCollection):
         self.iddic[facility.vfc_id] = facility
         self.namedic[facility.vfc_name].append(facility)
         self.ids.add(facility.vfc_id)
+        if self._doc_index is not None:
+            self._doc_index.add_facility(facility)
+
+    @property
+    def doc_index(self):
+        """
+        DocumentIndex over these facilities, built on first use (loading any stubs) and kept current after that.
+        """
+        if self._doc_index is None:
+            self._doc_index = DocumentIndex(self)
+        return self._doc_index
 
-    def save_docs(self):
+    def save_docs(self, compact=False):
+        """
+        Write only the docs TSVs with something to add, unless compacting them all.
+        """
         for facility in self:
-            facility.save_docs_to_tsv()
+            if compact or facility.docs_dirty:
+                facility.save_docs(compact=compact)
 
     def save_tsv(self, path=None, savedocs=True, directory=None):
         if path is None:
@@ -1028,11 +1651,15 @@ class ZipCollection(list):
 
     def setup_updater(self, zipcode, kwargs):
         updater = ZipUpdater(zipcode, **kwargs)
+        self.add_updater(updater)
+
+    def add_updater(self, updater):
+        zipcode = updater.zip
         if self.offline:
             updater.go_offline()
         else:
-            updater.whether_update_zip_info = (self.date.day % 7 == int(zipcode) % 7)  # to prevent bunching up
-            updater.whether_download = zipcode in downloadzips
+            updater.whether_update_zip_info = get_scheduler().is_zip_due(zipcode, self.date)
+            updater.whether_download = zipcode in downloadzips and not on_demand
         for facility in updater.facilities:
             self.add_facility(facility)
         self.append(updater)
@@ -1040,11 +1667,37 @@ class ZipCollection(list):
     def add_facility(self, facility):
         self.facilities.append(facility)
 
-    def go(self, restart=False):
+    def go(self, restart=False, plan=None):
         if restart:
             self.restart = restart
+        journal = tea_core.Journal(os.path.join(self.directory, "journal_collection.tsv"), run_date=self.date)
+        if len(journal):
+            print "Resuming interrupted run (%d steps recorded)" % len(journal)
         for updater in self:
+            if journal.is_done("zip", updater.zip):
+                continue
+            if plan is not None:
+                if not plan.allows(updater.zip):
+                    continue
+                updater.plan = plan
+                updater.whether_update_zip_info = updater.zip in plan.zip_refreshes
+            updater.journal = journal
             self.run_updater(updater)
+            get_scheduler().save()
+            get_cost_model().save()
+            if not self.restart:
+                journal.record("zip", updater.zip)
+        journal.finish()
+        if plan is not None:
+            print plan.report()
+
+    def make_plan(self, max_requests=None, max_seconds=None):
+        planner = CrawlPlanner(max_requests=max_requests, max_seconds=max_seconds)
+        for updater in self:
+            if updater.whether_update_zip_info:
+                planner.add_zip_refresh(updater.zip)
+        plan = planner.plan(zips=[x.zip for x in self])
+        return plan
 
     def run_updater(self, updater):
         if self.restart:
@@ -1085,11 +1738,12 @@ class ZipCollection(list):
             output += line + "\n"
         open(filepath, "w").write(output)
 
-    def generate_facility_line(self, facility):
+    @staticmethod
+    def generate_facility_line(facility):
         facility_id = facility.vfc_id
         name = facility.vfc_name
         address = facility.latlong_address
-        lat, lon = self.stringify_latlong(facility.latlong)
+        lat, lon = ZipCollection.stringify_latlong(facility.latlong)
         data = [facility_id, name, lat, lon, address]
         line = "\t".join(data)
         return line
@@ -1130,11 +1784,10 @@ class ZipCollection(list):
         :param end_date: datetime.date
         :return: dict
         """
-        docs_in_range = {}
-        for facility in self.facilities:
-            in_range = [x for x in facility.docs if end_date >= x.file_date >= start_date]
-            if in_range:
-                docs_in_range[facility] = DocumentCollection(in_range)
+        in_range = collections.defaultdict(list)
+        for facility, doc in self.facilities.doc_index.get_docs(start_date, end_date):
+            in_range[facility].append(doc)
+        docs_in_range = dict([(x, DocumentCollection(y)) for x, y in in_range.items()])
         return docs_in_range
 
     def get_active_facilities(self, lookback_days=7):
@@ -1143,10 +1796,8 @@ class ZipCollection(list):
         return active_facilities
 
     def get_active_since(self, cutoff_date):
-        active_facilities = []
-        for facility in self.facilities:
-            if facility.is_active_since(cutoff_date):
-                active_facilities.append(facility)
+        active = self.facilities.doc_index.get_active_since(cutoff_date)
+        active_facilities = [x for x in self.facilities if x in active]
         return active_facilities
 
     def get_facilities_due_for_look(self):
@@ -1161,41 +1812,129 @@ class ZipCollection(list):
             if not facility.latlong:
                 facility.latlongify()
 
-    def catchup_downloads(self):
+    def catchup_downloads(self, plan=None):
         for facility in self.facilities:
-            self.catchup_facility(facility)
+            if plan is not None and not plan.has_room():
+                plan.defer(facility.vfc_id, "downloads")
+                continue
+            self.catchup_facility(facility, plan=plan)
+        get_cost_model().save()
 
     @staticmethod
-    def catchup_facility(facility):
+    def catchup_facility(facility, plan=None):
         facility.get_downloaded_docs()
         if facility.due_for_download is True:
             print facility.vfc_name, facility.directory, facility.full_address
-            facility.download()
+            costs = get_cost_model()
+            costs.start(facility.vfc_id)
+            facility.download(plan=plan)
+            costs.stop()
             time.sleep(tea_core.DEFAULT_SHORT_WAIT)
             
 
 class ZipCycler:
 
-    def __init__(self, zips=lakezips):
+    def __init__(self, zips=lakezips, directory=maindir):
         self.zips = zips
         self.new = []
         self.updated = []
         self.iddic = {}
         self.ids = set()
         self.use_tsv = True
+        self.incremental = True
+        self.budget = None  # maximum facilities to check per cycle; None checks everything due
+        self.max_requests = None
+        self.max_seconds = None
+        self.plan = None
+        self.stop_event = None  # threading.Event; once set, cycle() gives up before the next facility
+        self.scheduler = get_scheduler()
+        self.costs = get_cost_model()
+        self.journal = tea_core.Journal(os.path.join(directory, "journal_cycle.tsv"), run_date=datetime.date.today())
 
     def cycle(self, do_all=False):
+        if len(self.journal):
+            print "Resuming interrupted cycle (%d steps recorded)" % len(self.journal)
+        self.seed_schedule()
+        if do_all:
+            chosen = None
+        elif self.max_requests is not None or self.max_seconds is not None:
+            planner = CrawlPlanner(max_requests=self.max_requests, max_seconds=self.max_seconds)
+            self.plan = planner.plan(zips=self.zips)
+            print self.plan.report()
+            chosen = self.plan.chosen
+        else:
+            chosen = self.scheduler.pick(self.budget)
         for current_zip in self.zips:  # avoid holding multiple updaters in memory
+            if chosen is not None and not chosen[current_zip]:
+                continue
+            if self.journal.is_done("zip", current_zip):
+                continue
             print current_zip
             updater = ZipUpdater(current_zip, load_tsv=self.use_tsv)
+            for entry in self.scheduler.add_new(updater.facilities):
+                if self.plan is not None:
+                    self.plan.admit(current_zip, entry.vfc_id)
+                elif chosen is not None:
+                    chosen[current_zip].add(entry.vfc_id)
             for facility in updater.facilities:
-                if do_all or facility.whether_to_update:
+                if self.stop_event is not None and self.stop_event.is_set():
+                    print "Stopping cycle at %s; journal kept" % current_zip
+                    save_manifests()
+                    return self.new
+                if chosen is None or facility.vfc_id in chosen[current_zip]:
+                    if self.journal.is_done("facility", facility.vfc_id):
+                        facility.last_check = self.date_done(facility.vfc_id)
+                        continue
+                    if self.plan is not None and not self.plan.has_room():
+                        self.plan.defer(facility.vfc_id, "out of budget")
+                        continue
                     self.update_facility(facility)
             updater.save_tsv(savedocs=True)
+            save_manifests()
+            self.scheduler.save()
+            self.costs.save()
+            self.journal.record("zip", current_zip)
+        self.journal.finish()
+        if self.plan is not None:
+            print self.plan.report()
         return self.new
 
+    def date_done(self, vfc_id):
+        isodate = self.journal.get("facility", vfc_id)
+        return date_from_iso(isodate)
+
+    def seed_schedule(self):
+        """
+        Add facilities from ZIPs that the scheduler has never seen, without fetching anything.
+        """
+        for current_zip in self.zips:
+            if current_zip in self.scheduler.zips:
+                continue
+            updater = ZipUpdater(current_zip, load_tsv=self.use_tsv)
+            for facility in updater.facilities:
+                self.scheduler.add(facility)
+        self.scheduler.save()
+
     def update_facility(self, facility):
-        new_files = facility.check_for_new_docs()
+        manifest = get_manifest(os.path.dirname(facility.directory))
+        entry = manifest.get(facility.vfc_id)
+        if entry is not None:
+            facility.page_fingerprint = entry.fingerprint
+        self.costs.start(facility.vfc_id)
+        resumed_path = self.journal.get("page", facility.vfc_id)
+        if resumed_path and os.path.exists(resumed_path):  # fetched before an interruption
+            new_files = facility.check_for_new_docs(page=open(resumed_path).read())
+        elif self.incremental:
+            new_files = facility.check_for_new_docs_incrementally()
+        else:
+            new_files = facility.check_for_new_docs()
+        self.costs.stop()
+        self.journal.record("page", facility.vfc_id, facility.page_path)
+        self.scheduler.update(facility)
+        if new_files:
+            facility.save_docs()  # durable before the facility is marked complete
+        manifest.record(facility, self.costs)
+        self.journal.record("facility", facility.vfc_id, facility.last_check.isoformat())
         file_count = len(new_files)
         print "*" * file_count, facility.vfc_name, file_count
         if new_files:
@@ -1223,44 +1962,1136 @@ class ZipCycler:
             facility.latlong_address = address
 
 
-def process_location_line(line):
-    idcol = 0
-    namecol = 1
-    latcol = 2
-    loncol = 3
-    addcol = 4
-    if not line.strip() or "\t" not in line:
-        return
-    pieces = line.split("\t")
-    facility_id = pieces[idcol]
-    latstring = pieces[latcol]
-    lonstring = pieces[loncol]
-    name = pieces[namecol]
-    address = pieces[addcol].strip()  # avoid trailing newline
-    latlong = destring_latlong(latstring, lonstring)
-    return facility_id, name, latlong, address
+class ScheduleEntry(tea_core.Thing):
+    """
+    Revisit estimate for one facility: how often it gains documents, and when it was last checked.
+    """
+    attribute_sequence = ("vfc_id", "zip", "rate", "last_check")
+    due_probability = 0.5  # revisit once new documents are at least this likely
+    vfc_id = ""
+    zip = ""
+    rate = 0.0
+    last_check = None
 
+    def __init__(self, facility=None, tsv=None, today=None):
+        super(ScheduleEntry, self).__init__(tsv=tsv)
+        if tsv is not None:
+            self.rate = float(self.rate or 0)
+            if self.last_check:
+                self.last_check = date_from_iso(self.last_check)
+            else:
+                self.last_check = None
+        if facility is not None:
+            self.vfc_id = facility.vfc_id
+            self.zip = facility.zip
+            self.rate = estimate_change_rate(facility.docs, today=today)
+            self.last_check = facility.last_check
 
-def get_location_data(filepath=latlong_filepath):
-    data = []
-    for line in open(filepath):
-        linedata = process_location_line(line)
-        data.append(linedata)
-    return data
+    def __lt__(self, other):
+        return self.next_due < other.next_due
 
+    def probability(self, today=None):
+        """
+        Probability, assuming documents arrive at a steady rate, that the facility has new documents by today.
+        :param today: datetime.date
+        :return: float
+        """
+        if self.last_check is None:
+            return 1.0
+        if today is None:
+            today = datetime.date.today()
+        days = max((today - self.last_check).days, 0)
+        return 1 - math.exp(-self.rate * days)
 
-def destring_latlong(latstring, lonstring):
-    if not latstring or not lonstring:
-        latlong = False
-    else:
-        lat = float(latstring)
-        lon = float(lonstring)
-        latlong = (lat, lon)
-    return latlong
+    @property
+    def next_due(self):
+        if self.last_check is None:
+            return datetime.date.min
+        if self.rate > 0:
+            days = -math.log(1 - self.due_probability) / self.rate
+        else:
+            days = 3650
+        days = int(math.ceil(min(days, 3650)))
+        return self.last_check + datetime.timedelta(max(days, 1))
 
+    def is_due(self, today=None):
+        if today is None:
+            today = datetime.date.today()
+        return self.next_due <= today
 
-def destring_latlong_pair(latlongstring):
-    latlong = tuple(latlongstring[1:-1].split(", "))
+
+class RevisitScheduler:
+    """
+    Single source of truth for when facilities (and ZIP listings) should be revisited. Estimates are kept in a small
+    TSV, so choosing what to check does not require loading or listing the archive.
+    """
+    zip_interval = 7
+    zip_prefix = "zip_"
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(maindir, "schedule.tsv")
+        self.path = path
+        self.entries = {}
+        self.zips = set()
+        self.zip_refreshes = {}
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        for line in open(self.path).read().split("\n")[1:]:
+            if not line.strip():
+                continue
+            entry = ScheduleEntry(tsv=line)
+            if entry.vfc_id.startswith(self.zip_prefix):
+                self.zip_refreshes[entry.zip] = entry.last_check
+            else:
+                self.entries[entry.vfc_id] = entry
+            self.zips.add(entry.zip)
+
+    def save(self):
+        lines = ["\t".join(ScheduleEntry.attribute_sequence) + "\n"]
+        for vfc_id in sorted(self.entries.keys()):
+            lines.append(self.entries[vfc_id].to_tsv())
+        for zipcode in sorted(self.zip_refreshes.keys()):
+            entry = ScheduleEntry()
+            entry.vfc_id = self.zip_prefix + zipcode
+            entry.zip = zipcode
+            entry.last_check = self.zip_refreshes[zipcode]
+            lines.append(entry.to_tsv())
+        tea_core.write_text_to_file("".join(lines), self.path)
+
+    def add(self, facility):
+        entry = ScheduleEntry(facility=facility)
+        self.entries[entry.vfc_id] = entry
+        self.zips.add(entry.zip)
+        return entry
+
+    def add_new(self, facilities):
+        """
+        Give facilities the schedule has no entry for, e.g. ones a ZIP listing has just turned up, an entry that is
+        due now.
+        :param facilities: iterable of Facility
+        :return: list of ScheduleEntry added
+        """
+        added = []
+        for facility in facilities:
+            if facility.vfc_id in self.entries:
+                continue
+            entry = ScheduleEntry()
+            entry.vfc_id = facility.vfc_id
+            entry.zip = facility.zip
+            self.entries[entry.vfc_id] = entry
+            self.zips.add(entry.zip)
+            added.append(entry)
+        return added
+
+    def update(self, facility):
+        if not facility.last_check:
+            facility.last_check = datetime.date.today()
+        return self.add(facility)
+
+    def pick(self, budget=None, today=None):
+        """
+        Choose facilities to check this run: everything due, or if a budget is given, the budget's worth of
+        facilities in order of how soon they fall due.
+        :param budget: int
+        :param today: datetime.date
+        :return: dict of ZIP -> set of facility IDs
+        """
+        if today is None:
+            today = datetime.date.today()
+        chosen = collections.defaultdict(set)
+        count = 0
+        for entry in self.ranked():
+            if budget is not None and count >= budget:
+                break
+            if budget is None and not entry.is_due(today):
+                break
+            chosen[entry.zip].add(entry.vfc_id)
+            count += 1
+        return chosen
+
+    def ranked(self, zips=None):
+        """
+        Yield schedule entries in order of next-due date.
+        :param zips: list (optional restriction)
+        :return: generator
+        """
+        queue = [x for x in self.entries.values() if zips is None or x.zip in zips]
+        heapq.heapify(queue)
+        while queue:
+            yield heapq.heappop(queue)
+
+    def is_zip_due(self, zipcode, today=None):
+        if today is None:
+            today = datetime.date.today()
+        last_refresh = self.zip_refreshes.get(zipcode)
+        if last_refresh is None:
+            return int(zipcode) % self.zip_interval == today.toordinal() % self.zip_interval  # stagger first refresh
+        return (today - last_refresh).days >= self.zip_interval
+
+    def record_zip_refresh(self, zipcode, date=None):
+        if date is None:
+            date = datetime.date.today()
+        self.zip_refreshes[zipcode] = date
+        self.zips.add(zipcode)
+
+
+class CostEntry(tea_core.Thing):
+    """
+    Observed cost of visiting one facility (or ZIP listing), accumulated over all visits.
+    """
+    attribute_sequence = ("key", "visits", "requests", "bytes", "seconds", "download_bytes", "request_seconds")
+    key = ""
+    visits = 0
+    requests = 0
+    bytes = 0
+    seconds = 0.0
+    download_bytes = 0
+    request_seconds = 0.0  # time spent waiting on responses, part of seconds
+
+    def __init__(self, key="", tsv=None):
+        super(CostEntry, self).__init__(tsv=tsv)
+        if tsv is not None:
+            for int_field in ["visits", "requests", "bytes", "download_bytes"]:
+                setattr(self, int_field, int(getattr(self, int_field) or 0))
+            self.seconds = float(self.seconds or 0)
+            self.request_seconds = float(self.request_seconds or 0)
+        else:
+            self.key = key
+
+    def per_visit(self, attribute):
+        if not self.visits:
+            return None
+        return float(getattr(self, attribute)) / self.visits
+
+
+class PageCache:
+    """
+    The documents each of a facility's saved log pages adds to the pages before it, so that each document is kept
+    once, under the page that first listed it. Entries are keyed by page filename and a hash chained through the
+    stamps of that page and every earlier one, so a change to any page invalidates it and the pages after it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.pages = {}  # filename -> (basis, list of document TSV lines)
+        self.changed = False
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        for line in open(self.path):
+            if not line.endswith("\n"):
+                continue
+            pieces = line[:-1].split("\t", 2)
+            if len(pieces) != 3:
+                continue
+            filename, basis, doc_tsv = pieces
+            entry = self.pages.setdefault(filename, (basis, []))
+            if doc_tsv:
+                entry[1].append(doc_tsv)
+
+    @staticmethod
+    def chain(basis, filename, stamp):
+        """
+        :param basis: str (chain value of the previous page, or "" for the first)
+        :return: str
+        """
+        return hashlib.sha1("\t".join([basis, filename, stamp])).hexdigest()[:16]
+
+    def get(self, filename, basis):
+        entry = self.pages.get(filename)
+        if entry is None or entry[0] != basis:
+            return None
+        return [Document(tsv=x) for x in entry[1]]
+
+    def put(self, filename, basis, docs):
+        self.pages[filename] = (basis, [x.to_tsv().rstrip("\n") for x in docs])
+        self.changed = True
+
+    def retain(self, filenames):
+        for filename in set(self.pages.keys()) - set(filenames):
+            del self.pages[filename]
+            self.changed = True
+
+    def save(self):
+        if not self.changed:
+            return
+        lines = []
+        for filename in sorted(self.pages.keys()):
+            basis, doc_lines = self.pages[filename]
+            if not doc_lines:  # page adding no documents still needs a line, to show it was parsed
+                doc_lines = [""]
+            for doc_tsv in doc_lines:
+                lines.append("\t".join([filename, basis, doc_tsv]) + "\n")
+        tea_core.write_text_atomically("".join(lines), self.path)
+        self.changed = False
+
+
+class ManifestEntry(tea_core.Thing):
+    """
+    Crawl metadata for one facility, maintained as the crawler runs so it need not be re-derived from the archive.
+    """
+    attribute_sequence = ("vfc_id", "last_check", "last_new_file", "reported_total", "downloaded", "visits",
+                          "requests", "seconds", "fingerprint")
+    vfc_id = ""
+    last_check = None
+    last_new_file = None
+    reported_total = None
+    downloaded = 0
+    visits = 0
+    requests = 0
+    seconds = 0.0
+    fingerprint = ""
+
+    def __init__(self, vfc_id="", tsv=None):
+        super(ManifestEntry, self).__init__(tsv=tsv)
+        if tsv is not None:
+            for date_field in ["last_check", "last_new_file"]:
+                value = getattr(self, date_field)
+                setattr(self, date_field, date_from_iso(value) if value else None)
+            self.reported_total = int(self.reported_total) if self.reported_total else None
+            for int_field in ["downloaded", "visits", "requests"]:
+                setattr(self, int_field, int(getattr(self, int_field) or 0))
+            self.seconds = float(self.seconds or 0)
+        else:
+            self.vfc_id = vfc_id
+
+    def to_tsv(self, callback=None):  # unlike Thing.to_tsv, keep zeros, so a reported total of 0 isn't lost
+        values = [getattr(self, x) for x in self.attribute_sequence]
+        tsv = "\t".join(["" if x is None else str(x) for x in values]) + "\t\n"
+        return tsv
+
+
+class Manifest:
+    """
+    Per-ZIP table of ManifestEntry rows, kept in the ZIP directory. Updates are held in memory and the file is
+    replaced atomically when saved, once per ZIP pass (see save_manifests).
+    """
+    filename = "manifest.tsv"
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, self.filename)
+        self.entries = {}
+        self.changed = False
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        for line in open(self.path).read().split("\n")[1:]:
+            if not line.strip():
+                continue
+            entry = ManifestEntry(tsv=line)
+            self.entries[entry.vfc_id] = entry
+
+    def save(self):
+        lines = ["\t".join(ManifestEntry.attribute_sequence) + "\n"]
+        for vfc_id in sorted(self.entries.keys()):
+            lines.append(self.entries[vfc_id].to_tsv())
+        tea_core.write_text_atomically("".join(lines), self.path)
+        self.changed = False
+
+    def get(self, vfc_id):
+        return self.entries.get(vfc_id)
+
+    def record(self, facility, costs=None, save=False):
+        """
+        Bring a facility's entry up to date after it has been checked or its files downloaded.
+        :param facility: Facility
+        :param costs: CostModel
+        :param save: bool (write the file now rather than with the rest of the ZIP)
+        :return: ManifestEntry
+        """
+        entry = self.entries.setdefault(facility.vfc_id, ManifestEntry(facility.vfc_id))
+        if facility.last_check:
+            entry.last_check = facility.last_check
+        if facility.latest_file_date:
+            entry.last_new_file = facility.latest_file_date
+        if facility.page:
+            entry.reported_total = get_total_from_page(facility.page)
+        entry.downloaded = len(facility.downloaded_filenames)
+        entry.fingerprint = facility.page_fingerprint
+        if costs is not None and facility.vfc_id in costs.entries:
+            cost = costs.entries[facility.vfc_id]
+            entry.visits, entry.requests, entry.seconds = cost.visits, cost.requests, cost.seconds
+        self.changed = True
+        if save:
+            self.save()
+        return entry
+
+
+def get_manifest(zipdir):
+    zipdir = os.path.abspath(zipdir)
+    if zipdir not in _manifests:
+        _manifests[zipdir] = Manifest(zipdir)
+    return _manifests[zipdir]
+
+
+def save_manifests():
+    """
+    Write out every manifest with unsaved updates.
+    """
+    for manifest in _manifests.values():
+        if manifest.changed:
+            manifest.save()
+
+
+def get_manifest_entry(sitedir):
+    """
+    :param sitedir: str (facility directory, within its ZIP directory)
+    :return: ManifestEntry or None
+    """
+    sitedir = os.path.abspath(sitedir)
+    return get_manifest(os.path.dirname(sitedir)).get(os.path.basename(sitedir))
+
+
+store_schema = """
+CREATE TABLE IF NOT EXISTS facilities (
+    vfc_id TEXT PRIMARY KEY,
+    vfc_name TEXT,
+    real_name TEXT,
+    vfc_address TEXT,
+    city TEXT,
+    county TEXT,
+    state TEXT,
+    zip TEXT,
+    latitude REAL,
+    longitude REAL,
+    latlong_address TEXT,
+    directory TEXT,
+    last_check TEXT,
+    page_fingerprint TEXT
+);
+CREATE INDEX IF NOT EXISTS facilities_by_zip ON facilities (zip);
+CREATE TABLE IF NOT EXISTS documents (
+    facility_id TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    id TEXT,
+    url TEXT,
+    crawl_date TEXT,
+    file_date TEXT,
+    type TEXT,
+    program TEXT,
+    size INTEGER,
+    path TEXT,
+    PRIMARY KEY (facility_id, filename)
+);
+CREATE INDEX IF NOT EXISTS documents_by_file_date ON documents (file_date);
+CREATE INDEX IF NOT EXISTS documents_by_crawl_date ON documents (crawl_date);
+CREATE INDEX IF NOT EXISTS documents_by_program ON documents (program, file_date);
+CREATE INDEX IF NOT EXISTS documents_by_id ON documents (id);
+"""
+facility_columns = ("vfc_id", "vfc_name", "real_name", "vfc_address", "city", "county", "state", "zip", "latitude",
+                    "longitude", "latlong_address", "directory", "last_check", "page_fingerprint")
+document_columns = ("facility_id", "filename", "id", "url", "crawl_date", "file_date", "type", "program", "size",
+                    "path")
+
+
+class FacilityStore:
+    """
+    SQLite copy of facilities, their documents and crawl state, indexed by facility, ZIP, date and program, so that
+    questions like "documents filed since a date in these ZIPs" are answered without loading every TSV.
+    Writes are batched, one transaction per call.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.connection.text_factory = str  # bytes in and out, as in the TSVs
+        self.connection.executescript(store_schema)
+
+    def run_batch(self, statements):
+        """
+        :param statements: iterable of (sql, list of parameter tuples), executed in a single transaction
+        """
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            for sql, parameters in statements:
+                self.connection.executemany(sql, parameters)
+        except Exception:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
+
+    @staticmethod
+    def facility_to_row(facility):
+        latitude, longitude = facility.latlong if facility.latlong else (None, None)
+        last_check = facility.last_check.isoformat() if facility.last_check else None
+        return (facility.vfc_id, facility.vfc_name, facility.real_name, facility.vfc_address, facility.city,
+                facility.county, facility.state, facility.zip, latitude, longitude, facility.latlong_address,
+                facility.directory, last_check, facility.page_fingerprint)
+
+    @staticmethod
+    def document_to_row(document, facility_id):
+        dates = [x.isoformat() if x else None for x in (document.crawl_date, document.file_date)]
+        return (facility_id, document.filename, document.id, document.url, dates[0], dates[1], document.type,
+                document.program, document.size or 0, document.path)
+
+    @staticmethod
+    def facility_from_row(row, parent=None, doc_rows=None):
+        values = dict(zip(facility_columns, row))
+        values["latlong"] = False
+        if values["latitude"] is not None:
+            values["latlong"] = (values["latitude"], values["longitude"])
+        values["last_check"] = date_from_iso(values["last_check"]) if values["last_check"] else None
+        record = [values[x] for x in Facility.attribute_sequence]
+        doc_records = [FacilityStore.document_record_from_row(x) for x in doc_rows or ()]
+        facility = facility_from_record((record, doc_records), parent)
+        facility.page_fingerprint = values["page_fingerprint"] or ""
+        if doc_rows is None:  # stub; docs are read from the store when first touched
+            facility._docs = None
+            facility.logged_rows = None
+            facility.docs_in_store = True
+        return facility
+
+    @staticmethod
+    def document_record_from_row(row):
+        values = dict(zip(document_columns, row))
+        for date_field in ["crawl_date", "file_date"]:
+            values[date_field] = date_from_iso(values[date_field]) if values[date_field] else None
+        values["_filename"] = values["filename"]
+        return tuple([values[x] for x in Document.attribute_sequence])
+
+    def document_from_row(self, row):
+        document = Document()
+        document.from_record(self.document_record_from_row(row))
+        return document
+
+    def save_facilities(self, facilities, savedocs=True):
+        """
+        Insert or replace facilities, and if savedocs, each one's full set of documents, in one transaction.
+        :param facilities: iterable of Facility
+        """
+        facilities = list(facilities)
+        facility_sql = "INSERT OR REPLACE INTO facilities (%s) VALUES (%s)" % (
+            ", ".join(facility_columns), ", ".join("?" * len(facility_columns)))
+        statements = [(facility_sql, [self.facility_to_row(x) for x in facilities])]
+        if savedocs:
+            document_sql = "INSERT OR REPLACE INTO documents (%s) VALUES (%s)" % (
+                ", ".join(document_columns), ", ".join("?" * len(document_columns)))
+            statements.append(("DELETE FROM documents WHERE facility_id = ?", [(x.vfc_id,) for x in facilities]))
+            doc_rows = [self.document_to_row(doc, x.vfc_id) for x in facilities for doc in x.docs]
+            statements.append((document_sql, doc_rows))
+        self.run_batch(statements)
+
+    def save_docs(self, facility, docs):
+        """
+        Add or update some of a facility's documents without touching the rest.
+        """
+        document_sql = "INSERT OR REPLACE INTO documents (%s) VALUES (%s)" % (
+            ", ".join(document_columns), ", ".join("?" * len(document_columns)))
+        self.run_batch([(document_sql, [self.document_to_row(x, facility.vfc_id) for x in docs])])
+
+    def get_zip(self, vfc_id):
+        """
+        :return: str (ZIP of the facility, or None if the store doesn't have it)
+        """
+        row = self.connection.execute("SELECT zip FROM facilities WHERE vfc_id = ?", (vfc_id,)).fetchone()
+        return row[0] if row else None
+
+    def has_zip(self, zipcode):
+        row = self.connection.execute("SELECT 1 FROM facilities WHERE zip = ? LIMIT 1", (zipcode,)).fetchone()
+        return row is not None
+
+    def load_zip(self, zipcode, parent=None, load_docs=True):
+        """
+        :param zipcode: str
+        :param parent: ZipUpdater
+        :return: list of Facility, with their documents unless load_docs is False, in which case they are stubs
+        that read their documents when first touched
+        """
+        query = "SELECT %s FROM facilities WHERE zip = ? ORDER BY vfc_id" % ", ".join(facility_columns)
+        rows = self.connection.execute(query, (zipcode,)).fetchall()
+        if not load_docs:
+            return [self.facility_from_row(x, parent) for x in rows]
+        doc_rows = collections.defaultdict(list)
+        query = "SELECT %s FROM documents WHERE facility_id IN " \
+                "(SELECT vfc_id FROM facilities WHERE zip = ?)" % ", ".join(document_columns)
+        for row in self.connection.execute(query, (zipcode,)):
+            doc_rows[row[0]].append(row)
+        return [self.facility_from_row(x, parent, doc_rows[x[0]]) for x in rows]
+
+    def load_docs(self, vfc_id):
+        query = "SELECT %s FROM documents WHERE facility_id = ?" % ", ".join(document_columns)
+        return [self.document_from_row(x) for x in self.connection.execute(query, (vfc_id,))]
+
+    def delete_missing(self, zipcode, vfc_ids):
+        """
+        Delete the facilities of a ZIP, and their documents, other than the given ones.
+        :return: list of ids deleted
+        """
+        rows = self.connection.execute("SELECT vfc_id FROM facilities WHERE zip = ?", (zipcode,))
+        missing = [(x[0],) for x in rows if x[0] not in vfc_ids]
+        if missing:
+            self.run_batch([("DELETE FROM documents WHERE facility_id = ?", missing),
+                            ("DELETE FROM facilities WHERE vfc_id = ?", missing)])
+        return [x[0] for x in missing]
+
+    def get_docs(self, start_date=None, end_date=None, zips=None, programs=None, field="file_date"):
+        """
+        Documents whose file (or crawl) date lies in a range, optionally only in some ZIPs or programs.
+        :param start_date: datetime.date
+        :param end_date: datetime.date
+        :param zips: list of str
+        :param programs: list of str
+        :param field: "file_date" or "crawl_date"
+        :return: list of Document, with facility_id set, in date order
+        """
+        if field not in ("file_date", "crawl_date"):
+            raise ValueError(field)
+        columns = ", ".join(["d." + x for x in document_columns])
+        query = "SELECT %s FROM documents d" % columns
+        conditions = []
+        parameters = []
+        if zips is not None:
+            query += " JOIN facilities f ON f.vfc_id = d.facility_id"
+            conditions.append("f.zip IN (%s)" % ", ".join("?" * len(zips)))
+            parameters.extend(zips)
+        if start_date is not None:
+            conditions.append("d.%s >= ?" % field)
+            parameters.append(start_date.isoformat())
+        if end_date is not None:
+            conditions.append("d.%s <= ?" % field)
+            parameters.append(end_date.isoformat())
+        if programs is not None:
+            conditions.append("d.program IN (%s)" % ", ".join("?" * len(programs)))
+            parameters.extend(programs)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY d.%s, d.facility_id" % field
+        return [self.document_from_row(x) for x in self.connection.execute(query, parameters)]
+
+    def get_docs_since(self, reference_date, zips=None, field="file_date"):
+        return self.get_docs(start_date=reference_date, zips=zips, field=field)
+
+    def get_facility_ids_for_doc(self, docid):
+        rows = self.connection.execute("SELECT DISTINCT facility_id FROM documents WHERE id = ?", (docid,))
+        return [x[0] for x in rows]
+
+    def import_zips(self, zips):
+        """
+        Fill the store from the facility and document TSVs of the given ZIPs.
+        :return: int (number of facilities imported)
+        """
+        count = 0
+        for zipcode in zips:
+            path = os.path.join(maindir, zipcode, zipcode + ".tsv")
+            if not os.path.exists(path):
+                continue
+            updater = ZipUpdater(zipcode, load_facilities=False, create=False)
+            updater.load_tsv(path=path, from_store=False)
+            self.save_facilities(updater.facilities)
+            self.delete_missing(zipcode, updater.facilities.ids)
+            count += len(updater.facilities)
+        return count
+
+    def export_zips(self, zips):
+        """
+        Write the facility and document TSVs of the given ZIPs from the store, for readers of the files.
+        :return: int (number of facilities exported)
+        """
+        count = 0
+        for zipcode in zips:
+            updater = ZipUpdater(zipcode, load_facilities=False)
+            updater.facilities.extend(self.load_zip(zipcode, parent=updater))
+            handle = open(updater.tsv_path, "w")
+            with handle:
+                handle.write(updater.facilities.to_tsv())
+            for facility in updater.facilities:
+                facility.save_docs_to_tsv(compact=True)
+            count += len(updater.facilities)
+        return count
+
+    def close(self):
+        self.connection.close()
+
+
+known_docs_schema = """
+CREATE TABLE IF NOT EXISTS known_docs (
+    id TEXT NOT NULL,
+    facility_id TEXT NOT NULL,
+    PRIMARY KEY (id, facility_id)
+);
+CREATE INDEX IF NOT EXISTS known_docs_by_facility ON known_docs (facility_id);
+"""
+
+
+class KnownDocIndex:
+    """
+    Every ECM document id seen anywhere in the state, with the facilities it was listed under, fronted by a Bloom
+    filter saved beside the database. A filter miss means the id is new, with no query; a hit is confirmed in SQLite.
+    Ids are only recorded after the facility's docs TSV is written, so the index never claims a doc the TSV lacks.
+    Rows are never deleted, so rowids only grow: the filter is labelled with the highest rowid it has absorbed, and
+    rows other processes add later are read in whenever SQLite reports the database has changed.
+    """
+    bloom_capacity = 1000000
+    query_chunk = 500  # stay under SQLite's limit on bound parameters
+
+    def __init__(self, path):
+        self.path = path
+        self.bloom_path = path + ".bloom"
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.connection.executescript(known_docs_schema)
+        self.bloom_dirty = False
+        self.absorbed = 0  # highest rowid whose id is in the filter
+        self.data_version = None
+        self.bloom, label = tea_core.BloomFilter.load(self.bloom_path)
+        if self.bloom is None or not label.isdigit():
+            self.rebuild_filter()
+        else:
+            self.absorbed = int(label)
+            self.catch_up(force=True)
+
+    def count(self):
+        return self.connection.execute("SELECT COUNT(*) FROM known_docs").fetchone()[0]
+
+    def rebuild_filter(self):
+        capacity = self.bloom_capacity
+        rows = self.count()
+        while capacity < rows * 2:
+            capacity *= 2
+        self.bloom = tea_core.BloomFilter(capacity=capacity)
+        self.absorbed = 0
+        self.catch_up(force=True)
+        self.bloom_dirty = True
+
+    def catch_up(self, force=False):
+        """
+        Add to the filter any rows written since it last looked, by this process or another.
+        :param force: bool (look even if SQLite says nothing has changed)
+        """
+        data_version = self.connection.execute("PRAGMA data_version").fetchone()[0]
+        if not force and data_version == self.data_version:
+            return
+        self.data_version = data_version
+        rows = self.connection.execute("SELECT rowid, id FROM known_docs WHERE rowid > ? ORDER BY rowid",
+                                       (self.absorbed,))
+        for rowid, docid in rows:
+            docid = str(docid)
+            if docid not in self.bloom:
+                self.bloom.add(docid)
+            self.absorbed = rowid
+            self.bloom_dirty = True
+        if self.bloom.is_full():
+            self.rebuild_filter()
+
+    def add_rows(self, rows):
+        """
+        :param rows: iterable of (docid, facility_id), recorded in a single transaction
+        :return: int (number of pairs not already known)
+        """
+        rows = [(x, y) for x, y in rows if x]
+        if not rows:
+            return 0
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            before = self.connection.total_changes
+            self.connection.executemany("INSERT OR IGNORE INTO known_docs (id, facility_id) VALUES (?, ?)", rows)
+            added = self.connection.total_changes - before
+        except Exception:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
+        if added:
+            self.catch_up(force=True)  # data_version ignores this connection's own writes
+        return added
+
+    def add_docs(self, facility_id, docids):
+        return self.add_rows([(x, facility_id) for x in docids])
+
+    def add_facilities(self, facilities):
+        return self.add_rows([(x, facility.vfc_id) for facility in facilities for x in facility.docs.ids])
+
+    def is_known(self, docid, facility_id=None):
+        """
+        :param docid: str
+        :param facility_id: str (if given, only count the doc as known if listed under this facility)
+        :return: bool
+        """
+        if not docid:
+            return False
+        self.catch_up()
+        if docid not in self.bloom:
+            return False
+        if facility_id is None:
+            row = self.connection.execute("SELECT 1 FROM known_docs WHERE id = ? LIMIT 1", (docid,))
+        else:
+            row = self.connection.execute("SELECT 1 FROM known_docs WHERE id = ? AND facility_id = ?",
+                                          (docid, facility_id))
+        return row.fetchone() is not None
+
+    def get_known_ids(self, docids, facility_id=None):
+        """
+        :param docids: iterable of str
+        :return: set of the given ids already known (under facility_id, if given)
+        """
+        self.catch_up()
+        candidates = sorted(set([x for x in docids if x and x in self.bloom]))
+        known = set()
+        for start in range(0, len(candidates), self.query_chunk):
+            chunk = candidates[start:start + self.query_chunk]
+            query = "SELECT id FROM known_docs WHERE id IN (%s)" % ", ".join(["?"] * len(chunk))
+            if facility_id is not None:
+                query += " AND facility_id = ?"
+                chunk = chunk + [facility_id]
+            known.update([str(x[0]) for x in self.connection.execute(query, chunk)])
+        return known
+
+    def has_facility(self, facility_id):
+        row = self.connection.execute("SELECT 1 FROM known_docs WHERE facility_id = ? LIMIT 1", (facility_id,))
+        return row.fetchone() is not None
+
+    def get_facility_ids(self, docid):
+        rows = self.connection.execute("SELECT facility_id FROM known_docs WHERE id = ? ORDER BY facility_id",
+                                       (docid,))
+        return [str(x[0]) for x in rows]
+
+    def get_duplicates(self):
+        """
+        :return: dict of docid -> list of the facility ids it is listed under, for ids under more than one facility
+        """
+        rows = self.connection.execute("SELECT id, facility_id FROM known_docs WHERE id IN "
+                                       "(SELECT id FROM known_docs GROUP BY id HAVING COUNT(*) > 1) "
+                                       "ORDER BY id, facility_id")
+        duplicates = {}
+        for docid, facility_id in rows:
+            duplicates.setdefault(str(docid), []).append(str(facility_id))
+        return duplicates
+
+    def import_zips(self, zips):
+        """
+        Fill the index from the facility and document TSVs of the given ZIPs.
+        :return: int (number of new id, facility pairs)
+        """
+        added = 0
+        for zipcode in zips:
+            path = os.path.join(maindir, zipcode, zipcode + ".tsv")
+            if not os.path.exists(path):
+                continue
+            updater = ZipUpdater(zipcode, load_facilities=False, create=False)
+            updater.load_tsv(path=path, from_store=False)
+            added += self.add_facilities(updater.facilities)
+        self.save()
+        return added
+
+    def save(self):
+        self.catch_up()
+        if self.bloom_dirty:
+            self.bloom.save(self.bloom_path, label=str(self.absorbed))
+            self.bloom_dirty = False
+
+    def close(self):
+        self.save()
+        self.connection.close()
+
+
+class CostModel:
+    """
+    Records requests, bytes and wall-clock time spent on each facility and ZIP, as a basis for planning runs.
+    """
+    default_requests = 1
+    default_seconds = tea_core.DEFAULT_WAIT + tea_core.DEFAULT_SHORT_WAIT + 2
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(maindir, "costs.tsv")
+        self.path = path
+        self.entries = {}
+        self.current = None
+        self.started = None
+        self.total_requests = 0  # this process only
+        self.lock = threading.Lock()
+        self.load()
+
+    @staticmethod
+    def zip_key(zipcode):
+        return RevisitScheduler.zip_prefix + zipcode
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        for line in open(self.path).read().split("\n")[1:]:
+            if line.strip():
+                entry = CostEntry(tsv=line)
+                self.entries[entry.key] = entry
+
+    def save(self):
+        lines = ["\t".join(CostEntry.attribute_sequence) + "\n"]
+        for key in sorted(self.entries.keys()):
+            lines.append(self.entries[key].to_tsv())
+        tea_core.write_text_to_file("".join(lines), self.path)
+
+    def get_entry(self, key):
+        if key not in self.entries:
+            self.entries[key] = CostEntry(key)
+        return self.entries[key]
+
+    def start(self, key):
+        self.current = self.get_entry(key)
+        self.current.visits += 1
+        self.started = time.time()
+
+    def stop(self):
+        if self.current is not None:
+            self.current.seconds += time.time() - self.started
+        self.current = None
+
+    def record_request(self, size, seconds=0.0):
+        with self.lock:  # pages may arrive from several pager threads at once
+            self.total_requests += 1
+            if self.current is not None:
+                self.current.requests += 1
+                self.current.bytes += size
+                self.current.request_seconds += seconds
+
+    def record_download(self, size, seconds=0.0):
+        with self.lock:
+            self.total_requests += 1
+            if self.current is not None:
+                self.current.requests += 1
+                self.current.download_bytes += size
+                self.current.request_seconds += seconds
+
+    def estimate(self, key):
+        """
+        :param key: str
+        :return: tuple (requests per visit, seconds per visit)
+        """
+        entry = self.entries.get(key)
+        if entry is None or not entry.visits:
+            return self.default_requests, self.default_seconds
+        return entry.per_visit("requests"), entry.per_visit("seconds")
+
+
+class CrawlPlan:
+    """
+    What a run will do: the ZIPs and facilities chosen, in order, plus whatever was deferred. Also tracks actual
+    usage against the limits, so work can be cut short if estimates turn out optimistic.
+    """
+
+    def __init__(self, max_requests=None, max_seconds=None, costs=None):
+        self.max_requests = max_requests
+        self.max_seconds = max_seconds
+        self.costs = costs or get_cost_model()
+        self.zips = []
+        self.zip_refreshes = set()
+        self.chosen = collections.defaultdict(set)
+        self.deferred = []
+        self.estimated_requests = 0
+        self.estimated_seconds = 0
+        self.started = time.time()
+        self.requests_at_start = self.costs.total_requests
+
+    def fits(self, requests_needed, seconds_needed):
+        if self.max_requests is not None and self.estimated_requests + requests_needed > self.max_requests:
+            return False
+        if self.max_seconds is not None and self.estimated_seconds + seconds_needed > self.max_seconds:
+            return False
+        return True
+
+    def add(self, zipcode, vfc_id, requests_needed, seconds_needed):
+        if zipcode not in self.zips:
+            self.zips.append(zipcode)
+        if vfc_id is None:
+            self.zip_refreshes.add(zipcode)
+        else:
+            self.chosen[zipcode].add(vfc_id)
+        self.estimated_requests += requests_needed
+        self.estimated_seconds += seconds_needed
+
+    def defer(self, key, reason="over budget"):
+        self.deferred.append((key, reason))
+
+    def admit(self, zipcode, vfc_id):
+        """
+        Take on a facility that was not scheduled when the plan was made, if it still fits.
+        :return: bool
+        """
+        requests_needed, seconds_needed = self.costs.estimate(vfc_id)
+        if not self.fits(requests_needed, seconds_needed):
+            self.defer(vfc_id)
+            return False
+        self.add(zipcode, vfc_id, requests_needed, seconds_needed)
+        return True
+
+    def allows(self, zipcode, vfc_id=None):
+        if vfc_id is None:
+            return zipcode in self.zips
+        return vfc_id in self.chosen[zipcode]
+
+    def has_room(self):
+        if self.max_requests is not None:
+            if self.costs.total_requests - self.requests_at_start >= self.max_requests:
+                return False
+        if self.max_seconds is not None:
+            if time.time() - self.started >= self.max_seconds:
+                return False
+        return True
+
+    def report(self):
+        facility_count = sum([len(x) for x in self.chosen.values()])
+        lines = ["Planned %d facilities in %d ZIPs (%d ZIP refreshes): ~%d requests, ~%d minutes" % (
+            facility_count, len(self.zips), len(self.zip_refreshes), self.estimated_requests,
+            self.estimated_seconds / 60)]
+        if self.deferred:
+            lines.append("Deferred %d:" % len(self.deferred))
+            for key, reason in self.deferred:
+                lines.append("\t%s\t%s" % (key, reason))
+        return "\n".join(lines)
+
+
+class CrawlPlanner:
+    """
+    Pick and order the work for a run so that its estimated cost fits a request and/or time budget.
+    """
+
+    def __init__(self, max_requests=None, max_seconds=None, scheduler=None, costs=None):
+        self.max_requests = max_requests
+        self.max_seconds = max_seconds
+        self.scheduler = scheduler or get_scheduler()
+        self.costs = costs or get_cost_model()
+        self.zip_refreshes = []
+
+    def add_zip_refresh(self, zipcode):
+        self.zip_refreshes.append(zipcode)
+
+    def plan(self, zips=None, today=None):
+        """
+        ZIP listing refreshes come first, then due facilities in order of next-due date while they fit.
+        :param zips: list
+        :param today: datetime.date
+        :return: CrawlPlan
+        """
+        if today is None:
+            today = datetime.date.today()
+        plan = CrawlPlan(max_requests=self.max_requests, max_seconds=self.max_seconds, costs=self.costs)
+        for zipcode in self.zip_refreshes:
+            requests_needed, seconds_needed = self.costs.estimate(self.costs.zip_key(zipcode))
+            if plan.fits(requests_needed, seconds_needed):
+                plan.add(zipcode, None, requests_needed, seconds_needed)
+            else:
+                plan.defer(self.costs.zip_key(zipcode))
+        for entry in self.scheduler.ranked(zips):
+            if not entry.is_due(today):
+                break
+            requests_needed, seconds_needed = self.costs.estimate(entry.vfc_id)
+            if plan.fits(requests_needed, seconds_needed):
+                plan.add(entry.zip, entry.vfc_id, requests_needed, seconds_needed)
+            else:
+                plan.defer(entry.vfc_id)
+        if zips is not None:
+            plan.zips.sort(key=lambda x: list(zips).index(x))  # keep the caller's ZIP order
+        return plan
+
+
+def estimate_change_rate(docs, today=None, lookback_days=730, prior_events=1.0, prior_days=180.0):
+    """
+    Estimate how often (events per day) a facility gains new documents, counting distinct arrival dates so that a
+    batch of documents posted together counts once. A weak prior keeps facilities with little history in rotation.
+    :param docs: DocumentCollection
+    :param today: datetime.date
+    :return: float
+    """
+    if today is None:
+        today = datetime.date.today()
+    cutoff = today - datetime.timedelta(lookback_days)
+    arrival_dates = set()
+    earliest = today
+    for doc in docs:
+        arrival = doc.crawl_date or doc.file_date
+        if not arrival:
+            continue
+        earliest = min(earliest, arrival)
+        if arrival >= cutoff:
+            arrival_dates.add(arrival)
+    observed_days = min((today - earliest).days, lookback_days)
+    rate = (len(arrival_dates) + prior_events) / (observed_days + prior_days)
+    return rate
+
+
+def get_store():
+    global _store
+    if _store is None:
+        _store = FacilityStore(store_path)
+    return _store
+
+
+def get_known_docs():
+    global _known_docs
+    if _known_docs is None:
+        _known_docs = KnownDocIndex(known_docs_path)
+    return _known_docs
+
+
+def report_duplicate_docs():
+    """
+    Print each document id listed under more than one facility, with those facilities.
+    :return: dict of docid -> list of facility ids
+    """
+    duplicates = get_known_docs().get_duplicates()
+    for docid in sorted(duplicates.keys()):
+        print "%s\t%s" % (docid, ", ".join(duplicates[docid]))
+    return duplicates
+
+
+def get_cost_model():
+    global _cost_model
+    if _cost_model is None:
+        _cost_model = CostModel()
+    return _cost_model
+
+
+def get_scheduler():
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = RevisitScheduler()
+    return _scheduler
+
+
+def process_location_line(line):
+    idcol = 0
+    namecol = 1
+    latcol = 2
+    loncol = 3
+    addcol = 4
+    if not line.strip() or "\t" not in line:
+        return
+    pieces = line.split("\t")
+    facility_id = pieces[idcol]
+    latstring = pieces[latcol]
+    lonstring = pieces[loncol]
+    name = pieces[namecol]
+    address = pieces[addcol].strip()  # avoid trailing newline
+    latlong = destring_latlong(latstring, lonstring)
+    return facility_id, name, latlong, address
+
+
+def get_location_data(filepath=latlong_filepath):
+    data = []
+    for line in open(filepath):
+        linedata = process_location_line(line)
+        data.append(linedata)
+    return data
+
+
+def destring_latlong(latstring, lonstring):
+    if not latstring or not lonstring:
+        latlong = False
+    else:
+        lat = float(latstring)
+        lon = float(lonstring)
+        latlong = (lat, lon)
+    return latlong
+
+
+def destring_latlong_pair(latlongstring):
+    latlong = tuple(latlongstring[1:-1].split(", "))
     latlong = destring_latlong(latlong[0], latlong[1])
     return latlong
 
@@ -1274,27 +3105,23 @@ def build_zip_url(zipcode):
     return zipurl
 
 
-def get_last_scan_date(directory):
-    files = os.listdir(directory)
+def get_last_scan_date(directory, snapshot=None):
+    entry = get_manifest_entry(directory)
+    if entry is not None and entry.last_check:
+        return entry.last_check
+    if snapshot is None:
+        snapshot = tea_core.DirectorySnapshot(directory)
     siteid = os.path.split(directory)[-1]
-    files = filter(lambda x: x.startswith(siteid + "_"), files)
-    latest = None
-    for filename in files:
-        isodate_match = re.search("\d\d\d\d-\d\d-\d\d", filename)
-        if not isodate_match:
-            continue
-        else:
-            isodate = isodate_match.group(0)
-            if not latest:
-                latest = isodate
-            elif isodate > latest:
-                latest = isodate
+    files = filter(lambda x: x.startswith(siteid + "_"), snapshot.names)
+    latest = snapshot.latest_date(files)
+    if latest is None:
+        return None
     date = date_from_iso(latest)
     return date
 
 
-def since_last_scan(sitedir):
-    date = get_last_scan_date(sitedir)
+def since_last_scan(sitedir, snapshot=None):
+    date = get_last_scan_date(sitedir, snapshot=snapshot)
     if date is None:
         return 1000  # arbitrary large number
     delta = datetime.date.today() - date
@@ -1308,16 +3135,18 @@ def date_from_iso(isodate):
     return date
 
 
-def since_last_file(sitedir, download=False):
+def since_last_file(sitedir, download=False, snapshot=None):
     default = 10000
-    files = os.listdir(sitedir)
+    entry = get_manifest_entry(sitedir)
+    if entry is not None and entry.last_new_file:
+        return (datetime.date.today() - entry.last_new_file).days
+    if snapshot is None:
+        snapshot = tea_core.DirectorySnapshot(sitedir)
     siteid = os.path.split(sitedir)[-1]
-    regfiles = [x for x in files if x.endswith("pdf")]
-    regfiles.sort()
-    regfiles = [x for x in regfiles if re.match("\d\d\d\d-\d\d-\d\d", x)]
+    regfiles = sorted([x for x in snapshot.pdfs if snapshot.dates.get(x) and x.startswith(snapshot.dates[x])])
     if regfiles:
         last = regfiles[-1]
-        isodate = re.search("\d\d\d\d-\d\d-\d\d", last).group(0)
+        isodate = snapshot.dates[last]
         date = datetime.datetime.strptime(isodate, "%Y-%m-%d").date()
     else:
         if download:  # download on, no files present
@@ -1329,11 +3158,11 @@ def since_last_file(sitedir, download=False):
                     return True
                 else:
                     return False
-            previous = sorted(filter(filter_previous, files))
+            previous = sorted(filter(filter_previous, snapshot.log_pages))
             if not previous:
                 return default
             latestcheck = previous[-1]
-            page = open(os.path.join(sitedir, latestcheck)).read()
+            page = snapshot.read(latestcheck)
             dates = re.findall("(\d{1, 2})/(\d{1, 2})/(\d{4})", page)
             if not dates:
                 return default
@@ -1347,10 +3176,8 @@ def since_last_file(sitedir, download=False):
 
 
 def get_individual_site_info(row):
-    pieces = [x.split("</span>")[0].strip() for x in row.split("<span class=idemfs>")[1:]]
-    name, address, city = pieces[:3]  # faciliity, street address, city
-    urlpiece = pieces[-1]
-    siteid = urlpiece.split("xAIID<matches>`")[1].split("`")[0]
+    infos = list(pageparser.iter_facility_rows("<tr>" + row))
+    siteid, name, address, city = infos[0]  # facility, street address, city
     return siteid, name, address, city
 
 
@@ -1368,12 +3195,13 @@ def get_latest_zip_page(zipcode, zipdir=False, num_back=1):
         return whether_log
     if zipdir is False:
         zipdir = os.path.join(maindir, zipcode)
-    logpages = filter(is_zip_log_file, os.listdir(zipdir))
+    listing = tea_core.get_dated_listing(zipdir)
+    logpages = filter(is_zip_log_file, listing.keys())
     logpages.sort()
     if len(logpages) < num_back:
         return ""
     newest = logpages[-1]
-    path_to_newest = os.path.join(zipdir, newest)
+    path_to_newest = listing[newest]
     zippage = open(path_to_newest).read()
     return zippage
 
@@ -1381,9 +3209,13 @@ def get_latest_zip_page(zipcode, zipdir=False, num_back=1):
 def scan_for_premature_stops(sitedir, tolerance=0.05):
     total = get_latest_total(sitedir)
     total = int(total)
-    pdfs = filter(lambda x: x.endswith(".pdf"), os.listdir(sitedir))
-    if total - (tolerance * total) > len(pdfs):
-        print sitedir, total, len(pdfs)
+    entry = get_manifest_entry(sitedir)
+    if entry is not None and entry.reported_total is not None:
+        downloaded = entry.downloaded
+    else:
+        downloaded = len(tea_core.DirectorySnapshot(sitedir).pdfs)
+    if total - (tolerance * total) > downloaded:
+        print sitedir, total, downloaded
         return True
     else:
         return False
@@ -1442,6 +3274,79 @@ def get_dirs_from_zip(zipcode):
     return dirs
 
 
+def get_blob_store():
+    global _blob_store
+    if _blob_store is None:
+        _blob_store = tea_core.BlobStore(blobdir)
+    return _blob_store
+
+
+def fetch_into_store(docid, url, session=None):
+    """
+    Download a document straight into the blob store, register it under its ECM id, and return its hash.
+    :param docid: str (must be the id in the URL's filename, as parsed from ECM listings)
+    :param url: str
+    :param session: Session
+    :return: str
+    """
+    if docid and pageparser.get_pdf_id(urlparse.urlparse(url).path) != docid:
+        raise ValueError("%s is not the URL of document %s" % (url, docid))
+    store = get_blob_store()
+    if session is None:
+        session = requests.Session()
+    handle, partial_path = tempfile.mkstemp(suffix=".part", dir=store.directory)
+    os.close(handle)
+    try:
+        started = time.time()
+        response = session.get(url, stream=True, timeout=TIMEOUT)
+        response.raise_for_status()
+        with open(partial_path, 'wb') as out_file:
+            shutil.copyfileobj(response.raw, out_file)
+        get_cost_model().record_download(os.path.getsize(partial_path), time.time() - started)
+        digest = store.put_file(partial_path)  # identical bytes already stored are discarded here
+    finally:
+        if os.path.exists(partial_path):  # failed part way; put_file moves or removes it otherwise
+            os.remove(partial_path)
+    if docid:
+        store.register(docid, digest)
+    return digest
+
+
+def get_docid_from_filename(filename):
+    pieces = filename.split("_")
+    if len(pieces) < 2:
+        return ""
+    return pieces[1]
+
+
+def deduplicate_directory(directory):
+    """
+    Move PDFs in a facility directory into the blob store, leaving hardlinks in their place.
+    :param directory: str
+    :return: int (number of files replaced by links; files already linked are not counted)
+    """
+    store = get_blob_store()
+    count = 0
+    for filename in os.listdir(directory):
+        if not filename.endswith(".pdf"):
+            continue
+        filepath = os.path.join(directory, filename)
+        if store.absorb(filepath, key=get_docid_from_filename(filename)):
+            count += 1
+    return count
+
+
+def deduplicate_archive(zips=lakezips):
+    for zipcode in zips:
+        zipdir = os.path.join(maindir, zipcode)
+        if not os.path.isdir(zipdir):
+            continue
+        total = 0
+        for sitedir in get_dirs_from_zip(zipdir):
+            total += deduplicate_directory(sitedir)
+        print zipcode, total
+
+
 def count_files_in_zip(zipcode):
     dirs = get_dirs_from_zip(zipcode)
     total = 0
@@ -1452,7 +3357,11 @@ def count_files_in_zip(zipcode):
     return total
 
 
-def tally_site_activity(facility, sincedate):
+def tally_site_activity(facility, sincedate, index=None):
+    if index is None:
+        index = get_doc_index(facility)
+    if index is not None:
+        return index.tally_since(facility, sincedate)
     activity = 0
     for doc in facility.docs:
         if doc.latest_date > sincedate:
@@ -1461,9 +3370,14 @@ def tally_site_activity(facility, sincedate):
 
 
 def get_sites_with_activity(sitelist, sincedate=datetime.date(2018, 1, 1)):
+    index = None
+    if isinstance(sitelist, FacilityCollection):
+        index = sitelist.doc_index
+        active = index.get_active_since(sincedate + datetime.timedelta(1))
+        sitelist = [x for x in sitelist if x in active]
     sites_by_activity = []
     for site in sitelist:
-        activity = tally_site_activity(site, sincedate)
+        activity = tally_site_activity(site, sincedate, index=index)
         if activity > 0:
             sites_by_activity.append((activity, site))
     sites_by_activity.sort()
@@ -1554,24 +3468,102 @@ def get_total_by_years(directory, years):
 
 
 def get_latest_total(directory):
+    entry = get_manifest_entry(directory)
+    if entry is not None and entry.reported_total is not None:
+        return entry.reported_total
+
     def filter_pages(filename):
         whether_page = False
         if "." not in filename:
-            if not os.path.isdir(os.path.join(directory, filename)):
-                whether_page = True
+            whether_page = True
         return whether_page
-    files = os.listdir(directory)
-    pages = filter(filter_pages, files)
+    snapshot = tea_core.DirectorySnapshot(directory)
+    pages = filter(filter_pages, snapshot.names)
     if not pages:
         return False
     else:
         pages.sort()
         latest = pages[-1]
-        latestcontent = open(os.path.join(directory, latest)).read()
+        latestcontent = snapshot.read(latest)
         total = get_total_from_page(latestcontent)
         return total
 
 
+def pack_log_pages(sitedir, prefix=None, retained=None):
+    """
+    Move a facility directory's loose log pages into <vfc_id>_pages.pack. Pages saved as snapshots (before facility
+    pages were packed instead) are dropped from the snapshot index, and their bodies deleted if nothing else uses them,
+    so that the packed copy replaces the stored one rather than adding to it.
+    :param sitedir: str
+    :param prefix: str (facility id; defaults to the directory name)
+    :param retained: dict (if given, the snapshot dates to keep are added to it for a later SnapshotStore.prune(),
+    instead of pruning now)
+    :return: int (number of pages packed)
+    """
+    if prefix is None:
+        prefix = os.path.basename(os.path.normpath(sitedir))
+    snapshot = tea_core.DirectorySnapshot(sitedir, prefix=prefix)
+    names = snapshot.log_pages & snapshot.loose
+    if not names:
+        return 0
+    packed = tea_core.pack_directory(sitedir, names, prefix + "_pages.pack")
+    store = tea_core.get_snapshot_store()
+    source = os.path.join(os.path.abspath(sitedir), prefix + "_*")
+    dates = store.get_dates(source)
+    if dates:
+        keep = set(dates) - set([snapshot.dates[x] for x in names if x in snapshot.dates])
+        if retained is None:
+            store.prune({source: keep})
+        else:
+            retained[source] = keep
+    return packed
+
+
+def pack_archive(zips=lakezips):
+    """
+    Migration tool: pack the loose log pages of every facility directory in the given ZIPs, then delete the
+    snapshot bodies they replace.
+    :return: int (number of pages packed)
+    """
+    packed = 0
+    retained = {}
+    for zipcode in zips:
+        zipdir = os.path.join(maindir, zipcode)
+        if not os.path.isdir(zipdir):
+            continue
+        for siteid in sorted(os.listdir(zipdir)):
+            sitedir = os.path.join(zipdir, siteid)
+            if os.path.isdir(sitedir):
+                packed += pack_log_pages(sitedir, retained=retained)
+        print zipcode, packed
+    if retained:
+        tea_core.get_snapshot_store().prune(retained)
+    return packed
+
+
+def compact_archive(zips=lakezips, keep_days=90, period="month"):
+    """
+    Retention job: thin ZIP and facility pages older than keep_days out to weekly or monthly checkpoints, after
+    folding each facility's pages into its first-seen record, then drop snapshot bodies no longer used.
+    :return: int (number of snapshot bodies deleted)
+    """
+    cutoff = get_reference_date(keep_days).isoformat()
+    retained = {}
+    for zipcode in zips:
+        zipdir = os.path.join(maindir, zipcode)
+        if not os.path.isdir(zipdir):
+            continue
+        retained.update(tea_core.apply_retention(zipdir, [zipcode + "_*.html"], cutoff, period))
+        for siteid in sorted(os.listdir(zipdir)):
+            sitedir = os.path.join(zipdir, siteid)
+            if not os.path.isdir(sitedir):
+                continue
+            facility = Facility(vfc_id=siteid, directory=sitedir, lazy=True)
+            retained.update(facility.compact_history(cutoff, period))
+        print zipcode
+    return tea_core.get_snapshot_store().prune(retained)
+
+
 def get_total_from_page(page):
     pattern1 = "Number of items found:\s*(\d+)"
     pattern2 = "Items 1-\d+ of (\d+)"
@@ -1586,6 +3578,23 @@ def get_total_from_page(page):
     return total
 
 
+def get_zip_total_from_page(page):
+    matched = re.search("Displaying Facilities \d+ - \d+ of (\d+)", page)
+    if not matched:
+        return 0
+    return int(matched.group(1))
+
+
+def get_zip_page_size_from_page(page):
+    """
+    :return: int (facilities listed on this page, from its "Displaying Facilities N1 - N2 of M" range; 0 if absent)
+    """
+    matched = re.search("Displaying Facilities (\d+) - (\d+) of \d+", page)
+    if not matched:
+        return 0
+    return max(int(matched.group(2)) - int(matched.group(1)) + 1, 0)
+
+
 def get_distance(point1, 
                  point2):
     # ex http://stackoverflow.com/questions/19412462/getting-distance-between-two-points-based-on-latitude-longitude
@@ -1618,6 +3627,11 @@ def get_docs_since(facility, reference_date):
     activity = DocumentCollection()
     if facility.docs.latest_date < reference_date:
         return activity
+    index = get_doc_index(facility)
+    if index is not None:
+        activity.extend(sorted(index.get_facility_docs_since(facility, reference_date)))
+        activity.reverse()
+        return activity
     for doc in facility.docs:
         date = get_doc_date(doc)
         if date >= reference_date:
@@ -1636,10 +3650,25 @@ def is_doc_fresh(doc, today=None, cutoff=1):
         return False
 
 
+def get_doc_link(doc):
+    """
+    Return URL for reading a document: the local document service if configured, otherwise ECM itself.
+    :param doc: Document
+    :return: str
+    """
+    if not docserver_url or not doc.id:
+        return doc.url
+    path = doc.url
+    if path.startswith(idem_settings.ecm_domain):
+        path = path[len(idem_settings.ecm_domain):]
+    link = "%s/doc/%s?path=%s" % (docserver_url.rstrip("/"), doc.id, urllib.quote(path))
+    return link
+
+
 def build_doc_list_item(doc):
     pattern = '\n<li><a href="%s" target="blank">%s</a> (%s), %s</li>'
     boldpattern = '\n<li><b><a href="%s" target="blank">%s</a> (%s)</b>, %s</li>'
-    url = doc.url
+    url = get_doc_link(doc)
     date = tea_core.give_us_date(doc.file_date)
     parenthetical = doc.program + "-" + doc.type
     if doc.size is None:
@@ -1762,7 +3791,7 @@ def facility_to_geojson(facility,
     props = build_json_props(facility, reference_date)
     # 2. get latlong from facility, and if not in facility, from remote service
     point = facility_to_point(facility, for_leaflet)
-    feature = geojson.Feature(geometry=point, properties=props)
+    feature = geojson.Feature(geometry=point, properties=props, id=facility.vfc_id)
     return feature
 
 
@@ -1832,10 +3861,14 @@ def get_page_patiently(url, session=None, timeout=TIMEOUT):
         tries += 1
         if tries > 5:
             break
+        started = time.time()
         result = try_to_get_page(url, session, timeout)
+        elapsed = time.time() - started
         if result is False:
+            get_cost_model().record_request(0, elapsed)
             time.sleep(tries * TIMEOUT)
         else:
+            get_cost_model().record_request(len(result), elapsed)
             page = result
             done = True
     return page
@@ -1848,7 +3881,7 @@ def try_to_get_page(url, session, timeout=TIMEOUT):
         print str(e)
         return False
     else:
-        page = handle.text.encode('utf-8', 'ignore')
+        page = tea_core.get_response_bytes(handle)
         return page
 
 
@@ -1877,8 +3910,30 @@ def get_doc_row_data(row):
     return rowdata
 
 
+def get_page_fingerprint(page):
+    """
+    Hash of what a results page says about documents (ids, links, listed fields and total), leaving out the rest of
+    the markup, which carries timestamps and session tokens that change on every fetch.
+    :param page: str
+    :return: str ("" if the page lists no documents)
+    """
+    rows = ["\t".join([x.fileid, x.relative_url] + x.fields) for x in pageparser.iter_doc_rows(page)]
+    if not rows:
+        rows = ["\t".join(x) for x in pageparser.get_old_style_rows(page)]
+    if not rows:
+        return ""
+    hasher = hashlib.sha1()
+    hasher.update(str(get_total_from_page(page)) + "\n")
+    hasher.update("\n".join(rows))
+    return hasher.hexdigest()
+
+
 def build_document_from_row(row, facility, crawl_date=None):
     data = get_doc_row_data(row)
+    return build_document_from_rowdata(data, facility, crawl_date=crawl_date)
+
+
+def build_document_from_rowdata(data, facility, crawl_date=None):
     url, fileid, month, date, year, program, doctype, size = data
     file_date = datetime.date(year, month, date)
     newdoc = Document(facility=facility,
@@ -1932,13 +3987,454 @@ def save_active_sites_as_json(collection, lookback=7, filepath=None, also_save=T
     return result
 
 
-def do_cycle(zips=lakezips):
+def do_cycle(zips=lakezips, max_requests=None, max_seconds=None):
     cycler = ZipCycler(zips=zips)
+    cycler.max_requests = max_requests
+    cycler.max_seconds = max_seconds
+    cycler.cycle()
+
+
+def refresh_now(vfc_ids=(), zips=(), lookback=7):
+    """
+    Refresh particular facilities or whole ZIPs right away, regardless of the revisit schedule, then patch just
+    their lines in the location dump and their features in the latest map, and regenerate the local directories
+    they fall in.
+    :param vfc_ids: list of str
+    :param zips: list of str (ZIP listing is re-read as well, to pick up new facilities)
+    :param lookback: int
+    :return: list of Facility
+    """
+    scheduler = get_scheduler()
+    wanted = dict([(x, None) for x in zips])  # ZIP -> set of ids, or None for every facility in it
+    for vfc_id in vfc_ids:
+        entry = scheduler.entries.get(vfc_id)
+        if entry is None:  # not scheduled yet; look in the ZIP data
+            facility = find_facility(vfc_id)
+            if facility is None:
+                print "Unknown facility %s" % vfc_id
+                continue
+            entry = scheduler.add_new([facility])[0]
+        if entry.zip in wanted and wanted[entry.zip] is None:
+            continue
+        wanted.setdefault(entry.zip, set()).add(vfc_id)
+    cycler = ZipCycler(zips=sorted(wanted.keys()), directory=get_refresh_directory())
+    cycler.journal.finish()  # never resume pages left over from an earlier refresh
+    refreshed = []
+    for zipcode in cycler.zips:
+        ids = wanted[zipcode]
+        updater = ZipUpdater(zipcode, load_tsv=True, lazy=True)  # stubs; only the facilities refreshed are loaded
+        if ids is None:
+            updater.update_info()
+        for facility in updater.facilities:
+            if ids is None or facility.vfc_id in ids:
+                cycler.update_facility(facility)
+                refreshed.append(facility)
+        updater.save_tsv(savedocs=False)
+    save_manifests()
+    scheduler.save()
+    cycler.costs.save()
+    cycler.journal.finish()
+    patch_location_dump(refreshed)
+    if patch_json_features(refreshed, get_reference_date(lookback)):
+        tea_core.timestamp_directory(idem_settings.websitedir)
+        tea_core.update_local_directories_containing([x.latlong for x in refreshed if x.latlong])
+    return refreshed
+
+
+def find_facility(vfc_id, zips=None):
+    """
+    Look a facility up in the stored ZIP data, e.g. one the revisit schedule doesn't know yet.
+    :param vfc_id: str
+    :param zips: list (defaults to every Indiana ZIP)
+    :return: Facility (a stub) or None
+    """
+    if use_store:
+        zipcode = get_store().get_zip(vfc_id)
+        zips = [zipcode] if zipcode else []
+    elif zips is None:
+        zips = idem_settings.indiana_zips
+    for zipcode in zips:
+        if not use_store and not os.path.exists(os.path.join(maindir, zipcode, zipcode + ".tsv")):
+            continue
+        updater = ZipUpdater(zipcode, load_tsv=True, lazy=True)
+        if vfc_id in updater.facilities.iddic:
+            return updater.facilities.iddic[vfc_id]
+    return None
+
+
+def get_refresh_directory():
+    directory = os.path.join(maindir, "refresh")
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    return directory
+
+
+def patch_location_dump(facilities, filepath=latlong_filepath):
+    """
+    Rewrite the location lines of the given facilities, leaving all others as they are.
+    """
+    lines = collections.OrderedDict()
+    if os.path.exists(filepath):
+        for line in open(filepath):
+            if "\t" in line:
+                lines[line.split("\t")[0]] = line
+    for facility in facilities:
+        lines[facility.vfc_id] = ZipCollection.generate_facility_line(facility) + "\n"
+    tea_core.write_text_to_file("".join(lines.values()), filepath)
+
+
+def patch_json_features(facilities, reference_date, filepath=latest_json_path):
+    """
+    Replace the given facilities' features in a saved map layer, dropping any that are no longer active.
+    :param facilities: list of Facility
+    :param reference_date: datetime.date
+    :param filepath: str
+    :return: str (path)
+    """
+    if not os.path.exists(filepath):
+        return None
+    ids = set([x.vfc_id for x in facilities])
+    names = set([(x.vfc_name, x.vfc_address) for x in facilities])  # layers saved before features carried ids
+
+    def is_replaced(feature):
+        if feature.get("id") is not None:
+            return feature["id"] in ids
+        properties = feature.get("properties", {})
+        return (properties.get("name"), properties.get("address")) in names
+
+    jsontext = open(filepath).read().split(" = ", 1)[1]
+    features = [x for x in geojson.loads(jsontext).features if not is_replaced(x)]
+    for facility in get_sites_with_activity(facilities, reference_date):
+        features.append(facility_to_geojson(facility, reference_date=reference_date))
+    result = write_usable_json(geojson.FeatureCollection(features), filepath)
+    return result
+
+
+def split_into_shards(zips, shard_count, costs=None, scheduler=None):
+    """
+    Divide ZIPs among shards so that each gets a similar share of the observed crawl time, largest ZIPs first.
+    :param zips: list
+    :param shard_count: int
+    :return: list of lists
+    """
+    if costs is None:
+        costs = get_cost_model()
+    if scheduler is None:
+        scheduler = get_scheduler()
+    weights = collections.defaultdict(float)
+    for entry in scheduler.entries.values():
+        weights[entry.zip] += costs.estimate(entry.vfc_id)[1]
+    shards = [[] for x in range(shard_count)]
+    loads = [0.0] * shard_count
+    for zipcode in sorted(zips, key=lambda x: weights.get(x, costs.default_seconds), reverse=True):
+        lightest = loads.index(min(loads))
+        shards[lightest].append(zipcode)
+        loads[lightest] += weights.get(zipcode, costs.default_seconds)
+    shards = [sorted(x) for x in shards if x]
+    return shards
+
+
+def get_shard_directory(number):
+    directory = os.path.join(maindir, "shards", "shard_%d" % number)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    return directory
+
+
+def use_private_state(directory):
+    """
+    Point this process's schedule and cost model at copies in its own directory, so that parallel workers
+    don't overwrite each other's files; the copies are folded back in by merge_crawl_state().
+    :param directory: str
+    """
+    global _scheduler, _cost_model
+    _scheduler = RevisitScheduler()
+    _scheduler.path = os.path.join(directory, "schedule.tsv")
+    _cost_model = CostModel()
+    _cost_model.path = os.path.join(directory, "costs.tsv")
+
+
+def merge_crawl_state(directory, zips, scheduler=None, costs=None):
+    """
+    Fold a worker's schedule and cost entries for the given ZIPs, and only those, into the main ones (caller saves).
+    :param directory: str
+    :param zips: list
+    """
+    if scheduler is None:
+        scheduler = get_scheduler()
+    if costs is None:
+        costs = get_cost_model()
+    worker_scheduler = RevisitScheduler(path=os.path.join(directory, "schedule.tsv"))
+    keys = set([costs.zip_key(x) for x in zips])  # the worker's copies of other ZIPs' costs are stale
+    for vfc_id, entry in worker_scheduler.entries.items():
+        if entry.zip in zips:
+            scheduler.entries[vfc_id] = entry
+            keys.add(vfc_id)
+    for zipcode in zips:
+        if zipcode in worker_scheduler.zip_refreshes:
+            scheduler.record_zip_refresh(zipcode, worker_scheduler.zip_refreshes[zipcode])
+    worker_costs = CostModel(path=os.path.join(directory, "costs.tsv"))
+    for key in keys & set(worker_costs.entries.keys()):
+        costs.entries[key] = worker_costs.entries[key]
+
+
+def run_shard(arguments):
+    """
+    Worker for a sharded crawl: cycle through one shard's ZIPs, then write that shard's partial outputs (schedule,
+    costs, facility TSV, location dump, GeoJSON layer) to its own directory for merge_shards() to combine.
+    :param arguments: tuple (shard number, list of ZIPs, lookback days)
+    :return: tuple (shard directory, list of ZIPs)
+    """
+    number, zips, lookback = arguments
+    directory = get_shard_directory(number)
+    use_private_state(directory)
+    cycler = ZipCycler(zips=zips, directory=directory)
     cycler.cycle()
+    collection = setup_collection(zips=zips)
+    collection.facilities.save_tsv(path=os.path.join(directory, "facilities.tsv"), savedocs=False)
+    collection.dump_latlongs(os.path.join(directory, "facilitydump.txt"))
+    json_obj = active_sites_to_geojson(collection, get_reference_date(lookback))
+    write_usable_json(json_obj, os.path.join(directory, "idem.json"))
+    return directory, zips
+
+
+def merge_shards(results, lookback=7):
+    """
+    Combine the partial outputs of sharded workers into the usual statewide files. A shard that left no outputs is
+    skipped, keeping the main schedule and costs for its ZIPs; a facility listed by more than one shard is kept
+    once, as the last shard has it.
+    :param results: list of (shard directory, list of ZIPs)
+    :return: str (path of merged JSON)
+    """
+    scheduler = get_scheduler()
+    costs = get_cost_model()
+    facility_lines = collections.OrderedDict()
+    location_lines = {}
+    if os.path.exists(latlong_filepath):
+        for line in open(latlong_filepath):
+            if "\t" in line:
+                location_lines[line.split("\t")[0]] = line
+    features = collections.OrderedDict()
+    outputs = ["facilities.tsv", "facilitydump.txt", "idem.json"]
+    for directory, zips in results:
+        if not all([os.path.exists(os.path.join(directory, x)) for x in outputs]):
+            print "Shard %s left no outputs; skipping ZIPs %s" % (directory, ", ".join(zips))
+            continue
+        merge_crawl_state(directory, zips, scheduler, costs)
+        for line in open(os.path.join(directory, "facilities.tsv")).read().split("\n")[1:]:
+            if line.strip():
+                facility_lines[line.split("\t")[0]] = line
+        for line in open(os.path.join(directory, "facilitydump.txt")):
+            if "\t" in line:
+                location_lines[line.split("\t")[0]] = line
+        jsontext = open(os.path.join(directory, "idem.json")).read().split(" = ", 1)[1]
+        for feature in geojson.loads(jsontext).features:
+            features[feature.id] = feature
+    scheduler.save()
+    costs.save()
+    header = "\t".join(Facility.attribute_sequence)
+    facility_tsv = header + "\n" + "\n".join(facility_lines.values()) + "\n"
+    facilities_filename = "facilities_%s.tsv" % datetime.date.today().isoformat()
+    tea_core.write_text_to_file(facility_tsv, os.path.join(maindir, facilities_filename))
+    tea_core.write_text_to_file("".join([location_lines[x] for x in sorted(location_lines.keys())]),
+                                latlong_filepath)
+    json_obj = geojson.FeatureCollection(features.values())
+    result = write_usable_json(json_obj, get_json_filepath())
+    write_usable_json(json_obj, latest_json_path)
+    tea_core.timestamp_directory(idem_settings.websitedir)
+    return result
+
+
+def do_sharded_cycle(zips=idem_settings.indiana_zips, processes=None, lookback=7):
+    """
+    Statewide refresh across worker processes, one shard of ZIPs per process, followed by a merge.
+    :param zips: list
+    :param processes: int (defaults to number of cores)
+    :param lookback: int
+    :return: str (path of merged JSON)
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    shards = split_into_shards(zips, processes)
+    pool = multiprocessing.Pool(len(shards))
+    try:
+        results = pool.map(run_shard, [(number, shard, lookback) for number, shard in enumerate(shards)])
+    finally:
+        pool.close()
+        pool.join()
+    result = merge_shards(results, lookback=lookback)
+    return result
+
+
+def get_worker_directory(owner):
+    directory = os.path.join(maindir, "workers", owner)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    return directory
+
+
+def fill_work_queue(zips=idem_settings.indiana_zips, path=queue_path, fresh=False):
+    """
+    Queue ZIPs for queue workers, heaviest first so that stragglers come at the start rather than the end.
+    :param zips: list
+    :param path: str
+    :param fresh: bool (True requeues ZIPs already done in an earlier round)
+    :return: WorkQueue
+    """
+    queue = workqueue.WorkQueue(path)
+    costs = get_cost_model()
+    weights = collections.defaultdict(float)
+    for entry in get_scheduler().entries.values():
+        weights[entry.zip] += costs.estimate(entry.vfc_id)[1]
+    for zipcode in zips:
+        priority = int(weights.get(zipcode, costs.default_seconds))
+        if fresh:
+            queue.reset("zip", zipcode, priority)
+        else:
+            queue.add("zip", zipcode, priority)
+    return queue
+
+
+def run_queue_worker(path=queue_path, owner=None, max_tasks=None):
+    """
+    Claim ZIPs from the shared queue and cycle through each until none are left. Any number of these can run,
+    on one host or several sharing maindir; a worker that dies leaves its ZIP to be reclaimed once the lease lapses.
+    :param path: str
+    :param owner: str (defaults to host and process id)
+    :return: list of ZIPs completed
+    """
+    if owner is None:
+        owner = workqueue.get_worker_name()
+    directory = get_worker_directory(owner)
+    use_private_state(directory)
+    cycler = ZipCycler(zips=[], directory=directory)
 
+    def handle(task):
+        cycler.zips = [task.key]
+        cycler.stop_event = task.lost
+        new = cycler.cycle()
+        return len(new)
 
-def setup_collection(zips=lakezips, from_tsv=True):
-    collection = ZipCollection(zips=zips, whether_download=False, load_tsv=from_tsv)
+    return workqueue.run_worker(path, handle, kind="zip", owner=owner, max_tasks=max_tasks)
+
+
+def merge_work_queue(path=queue_path, lookback=7):
+    """
+    After the queue has drained, fold every worker's schedule and costs back in and rebuild the statewide outputs.
+    :param path: str
+    :param lookback: int
+    :return: str (path of JSON)
+    """
+    queue = workqueue.WorkQueue(path)
+    scheduler = get_scheduler()
+    costs = get_cost_model()
+    zips = []
+    for owner, done in queue.completed_by("zip").items():
+        merge_crawl_state(get_worker_directory(owner), done, scheduler, costs)
+        zips.extend(done)
+    queue.close()
+    scheduler.save()
+    costs.save()
+    collection = setup_collection(zips=sorted(zips))
+    facilities_filename = "facilities_%s.tsv" % datetime.date.today().isoformat()
+    collection.facilities.save_tsv(path=os.path.join(maindir, facilities_filename), savedocs=False)
+    collection.dump_latlongs()
+    return save_active_sites_as_json(collection, lookback=lookback)
+
+
+def do_queued_cycle(zips=idem_settings.indiana_zips, processes=None, lookback=7, path=queue_path):
+    """
+    Local run of the queue-based crawl: fill the queue, run worker processes against it, then merge.
+    Workers on other hosts can join by calling run_queue_worker() with the same queue path.
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    fill_work_queue(zips, path=path, fresh=True).close()
+    pool = multiprocessing.Pool(processes)
+    try:
+        pool.map(run_queue_worker, [path] * processes)
+    finally:
+        pool.close()
+        pool.join()
+    return merge_work_queue(path, lookback=lookback)
+
+
+def read_zip_records(zipcode):
+    """
+    Worker for load_collection_in_parallel(): parse a ZIP's facility TSV and its facilities' docs TSVs into records.
+    :param zipcode: str
+    :return: tuple (zipcode, list of (facility record, list of document records))
+    """
+    path = os.path.join(maindir, zipcode, zipcode + ".tsv")
+    records = []
+    if not os.path.exists(path):
+        return zipcode, records
+    for line in open(path).read().split("\n")[1:]:
+        if not line.strip():
+            continue
+        facility = Facility(tsv=line, lazy=True)
+        records.append((facility.to_record(), [x.to_record() for x in facility.docs]))
+    return zipcode, records
+
+
+def facility_from_record(record, parent):
+    facility_record, doc_records = record
+    facility = Facility(lazy=True)
+    facility.from_record(facility_record)
+    facility.parent = parent
+    facility.docs_in_tsv = True
+    facility.page = ""
+    docs = []
+    for doc_record in doc_records:
+        doc = Document()
+        doc.from_record(doc_record)
+        docs.append(doc)
+    facility.docs = DocumentCollection(docs)
+    facility.logged_rows = facility.get_doc_rows()
+    return facility
+
+
+def compact_doc_logs(zips=lakezips):
+    """
+    Rewrite every facility's docs TSV in full and in order; run now and then, e.g. weekly, to fold in the appends.
+    """
+    for zipcode in zips:
+        if not os.path.exists(os.path.join(maindir, zipcode, zipcode + ".tsv")):
+            continue
+        updater = ZipUpdater(zipcode, load_tsv=True, load_facilities=False)
+        updater.facilities.save_docs(compact=True)
+
+
+def load_collection_in_parallel(zips=lakezips, processes=None, **kwargs):
+    """
+    Cold start from TSVs with the parsing spread over a process pool; the parent only assembles the results.
+    :param zips: list
+    :param processes: int (defaults to number of cores)
+    :return: ZipCollection
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    collection = ZipCollection(zips=[], **kwargs)
+    collection.zips = zips
+    pool = multiprocessing.Pool(processes)
+    try:
+        for zipcode, records in pool.imap(read_zip_records, zips):
+            updater = ZipUpdater(zipcode, load_facilities=False, whether_download=False)
+            for record in records:
+                updater.facilities.append(facility_from_record(record, updater))
+            collection.add_updater(updater)
+    finally:
+        pool.close()
+        pool.join()
+    return collection
+
+
+def setup_collection(zips=lakezips, from_tsv=True, lazy=False, processes=None):
+    if processes is None and multiprocessing.current_process().daemon:  # pool workers can't start pools
+        processes = 1
+    if from_tsv and not lazy and processes != 1 and not use_store:  # the parallel loader reads the TSVs
+        return load_collection_in_parallel(zips=zips, processes=processes, whether_download=False)
+    collection = ZipCollection(zips=zips, whether_download=False, load_tsv=from_tsv, lazy=lazy)
     if from_tsv is False:
         collection.reload_latlongs()
     return collection
@@ -1948,10 +4444,18 @@ def do_cron():
     # first, cycle through VFC for new files
     do_cycle()
     collection = setup_collection()
+    if on_demand:
+        import docserver
+        docserver.prefetch_fresh_docs(collection)
     save_active_sites_as_json(collection)
     tea_core.do_cron()
     return collection
 
 
 if __name__ == "__main__":
-    do_cron()
+    if len(sys.argv) > 1:  # e.g. "python idem.py 46312 12345": refresh these ZIPs and facility ids now
+        arguments = sys.argv[1:]
+        refresh_now(vfc_ids=[x for x in arguments if x not in idem_settings.indiana_zips],
+                    zips=[x for x in arguments if x in idem_settings.indiana_zips])
+    else:
+        do_cron()
@@ -84,6 +84,11 @@ innddir = os.path.join(maindir, "INND")
 
 google_maps_key = ""
 
+docserver_url = ""  # e.g. "http://localhost:8088"; leave blank to link straight to ECM
+docserver_port = 8088
+use_sqlite_store = False  # keep facilities and documents in maindir/facilities.sqlite instead of TSVs
+use_known_doc_index = False  # index every document id seen in maindir/known_docs.sqlite, to skip known rows
+
 wp_password = ""
 wp_user = ""
 wp_url = ""
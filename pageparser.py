@@ -0,0 +1,250 @@
+import re
+
+import idem_settings
+
+# Single-pass parsing of ECM results pages. Every scan moves forward through the page and nothing backtracks, so
+# time is linear in the length of the page however malformed it is.
+
+date_pattern = re.compile("^(\d+)/(\d+)/(\d{4})$")
+digits_pattern = re.compile("^\d+$")
+# a tag can't run past the next "<", so a failed match gives up at the next tag and no character is rescanned
+tag_pattern = re.compile("<(/?)([A-Za-z][A-Za-z0-9]*)([^<>]*)>")
+
+
+def iter_tags(page):
+    """
+    Yield (whether closing, lowercase name, attribute text, start, end) for each tag in page, in order.
+    :param page: str
+    :return: generator
+    """
+    for matched in tag_pattern.finditer(page):
+        closing, name, attributes = matched.groups()
+        yield bool(closing), name.lower(), attributes.strip(), matched.start(), matched.end()
+
+
+def get_attribute(attributes, name):
+    """
+    :param attributes: str (attribute text of a tag)
+    :param name: str
+    :return: str or None
+    """
+    needle = name + '="'
+    start = attributes.find(needle)
+    if start == -1:
+        return None
+    start += len(needle)
+    end = attributes.find('"', start)
+    if end == -1:
+        return None
+    return attributes[start:end]
+
+
+def get_pdf_id(href):
+    """
+    Trailing digits of a link to a PDF, e.g. "12345" for /cs/groups/doc/12345.pdf
+    """
+    if not href.endswith(".pdf"):
+        return ""
+    start = end = len(href) - 4
+    while start > 0 and href[start - 1].isdigit():
+        start -= 1
+    return href[start:end]
+
+
+class DocRow(object):
+    """
+    What a document row of a facility results page says.
+    """
+
+    def __init__(self):
+        self.valid = False
+        self.fileid = ""
+        self.relative_url = ""
+        self.fields = []
+        self.texts = []
+
+    def take_link(self, href):
+        fileid = get_pdf_id(href)
+        if not fileid:
+            return
+        if not self.fileid:
+            self.fileid = fileid
+        if not self.relative_url and href.startswith("/cs/") and len(href) - len(fileid) - 4 > 5:
+            self.relative_url = href
+
+    def to_rowdata(self):
+        """
+        Same tuple as get_doc_row_data() in idem: (url, id, month, date, year, program, type, size)
+        :return: tuple or False
+        """
+        if len(self.fields) != 5:
+            print "Error!"
+            return False
+        datestring, program, doctype, public, size = self.fields
+        matched = date_pattern.match(datestring)
+        if not matched:
+            print "Error!"
+            return False
+        month, date, year = [int(x) for x in matched.groups()]
+        url = ""
+        fileid = ""
+        if self.relative_url:
+            url = idem_settings.ecm_domain + self.relative_url
+            fileid = get_pdf_id(self.relative_url)
+        return url, fileid, month, date, year, program, doctype, size
+
+    def to_old_style_rowdata(self):
+        """
+        Tuple for the pre-Aug 2018 layout, in the order Document.from_oldstyle_row() reads it, or None.
+        """
+        if not self.relative_url or not 7 <= len(self.fileid) <= 9:
+            return None
+        dates = [date_pattern.match(x) for x in self.texts]
+        dates = [x for x in dates if x]
+        if not dates or len(self.fields) < 3 or not digits_pattern.match(self.fields[1]):
+            return None
+        month, date, year = dates[0].groups()
+        program, size, doctype = self.fields[:3]
+        return self.relative_url, self.fileid, month, date, year, program, doctype, size
+
+
+def iter_doc_rows(page):
+    """
+    Yield a DocRow for each row of a facility results page that holds a document link. This is the hot path, so
+    rather than going tag by tag it jumps between the few markers it needs with str.find, always moving forward.
+    :param page: str
+    :return: generator
+    """
+    field_marker = 'nowrap="nowrap">'
+    start = page.find("<tr")
+    while start != -1:
+        row_end = page.find("<tr", start + 3)
+        if row_end == -1:
+            row_end = len(page)
+        if page.find("xuiListContentCell", start, row_end) != -1:
+            row = DocRow()
+            cursor = start
+            while not row.fileid:
+                cursor = page.find('.pdf"', cursor, row_end)
+                if cursor == -1:
+                    break
+                row.fileid = get_pdf_id(page[max(start, cursor - 20):cursor + 4])
+                cursor += 5
+            cursor = start
+            while not row.relative_url:
+                cursor = page.find('href="/cs/', cursor, row_end)
+                if cursor == -1:
+                    break
+                cursor += 6
+                closing = page.find('"', cursor, row_end)
+                if closing == -1:
+                    break
+                row.take_link(page[cursor:closing])
+            cursor = page.find(field_marker, start, row_end)
+            while cursor != -1:
+                cursor += len(field_marker)
+                closing = page.find("</div>", cursor, row_end)
+                if closing == -1:
+                    break
+                field = page[cursor:closing]
+                if "\n" not in field:
+                    row.fields.append(field)
+                cursor = page.find(field_marker, closing, row_end)
+            if row.fileid:
+                yield row
+        start = row_end if row_end < len(page) else -1
+
+
+def iter_old_style_rows(page):
+    """
+    Yield a DocRow for each row in the pre-Aug 2018 layout: a plain <tr>, no list cell class.
+    :param page: str
+    :return: generator
+    """
+    row = None
+    field_start = None
+    previous_end = 0
+    for closing, name, attributes, start, end in iter_tags(page):
+        if row is not None and field_start is None and start > previous_end:
+            row.texts.append(page[previous_end:start].strip())
+        previous_end = end
+        if closing:
+            if name == "div" and field_start is not None and row is not None:
+                field = page[field_start:start]
+                if "\n" not in field:
+                    row.fields.append(field)
+                field_start = None
+            continue
+        if name == "tr":
+            if row is not None and row.valid and row.fileid:
+                yield row
+            row = DocRow()
+            row.valid = not attributes
+            field_start = None
+            continue
+        if row is None or not attributes:
+            continue
+        if "xuiListContentCell" in attributes:
+            row.valid = False
+        if "href=" in attributes:
+            href = get_attribute(attributes, "href")
+            if href:
+                row.take_link(href)
+        if attributes.endswith('nowrap="nowrap"'):
+            field_start = end
+    if row is not None and row.valid and row.fileid:
+        yield row
+
+
+def get_old_style_rows(page):
+    rows = [x.to_old_style_rowdata() for x in iter_old_style_rows(page)]
+    return [x for x in rows if x]
+
+
+def iter_facility_rows(page):
+    """
+    Yield (vfc_id, name, address, city) for each facility row of a ZIP search results page.
+    :param page: str
+    :return: generator
+    """
+    pieces = None
+    piece_start = None
+    for closing, name, attributes, start, end in iter_tags(page):
+        if name == "tr" and not closing and not attributes:
+            if pieces:
+                info = get_facility_info(pieces)
+                if info:
+                    yield info
+            pieces = []
+            piece_start = None
+        elif pieces is None or name != "span":
+            continue
+        elif not closing and attributes == "class=idemfs":
+            piece_start = end
+        elif closing and piece_start is not None:
+            pieces.append(page[piece_start:start].strip())
+            piece_start = None
+    if pieces:
+        info = get_facility_info(pieces)
+        if info:
+            yield info
+
+
+def get_facility_info(pieces):
+    """
+    :param pieces: list of str (contents of a row's idemfs spans)
+    :return: tuple (vfc_id, name, address, city) or None
+    """
+    if len(pieces) < 3:
+        return None
+    marker = "xAIID<matches>`"
+    urlpiece = pieces[-1]
+    start = urlpiece.find(marker)
+    if start == -1:
+        return None
+    start += len(marker)
+    end = urlpiece.find("`", start)
+    if end == -1:
+        end = len(urlpiece)
+    name, address, city = pieces[:3]
+    return urlpiece[start:end], name, address, city
@@ -267,7 +267,7 @@ class PermitUpdater:
         :return: HTML as str
         """
         page = urllib2.urlopen(self.main_url).read()
-        write_text_to_file(page, self.page_path)
+        tea_core.save_snapshot(page, self.page_path)
         return page
 
     def compare_permits(self, newpage, oldpage):
@@ -678,6 +678,16 @@ def build_popup(permit):
     return popup
 
 
+def compact_permit_pages(keep_days=90, period="month"):
+    """
+    Thin saved permit pages older than keep_days out to weekly or monthly checkpoints; only the latest is compared.
+    """
+    cutoff = (datetime.date.today() - datetime.timedelta(keep_days)).isoformat()
+    source = "*_" + PermitUpdater.main_url.split("/")[-1]
+    retained = tea_core.apply_retention(permitdir, [source], cutoff, period)
+    return tea_core.get_snapshot_store().prune(retained)
+
+
 def daily_permit_check():
     updater = PermitUpdater()
     updater.do_daily_permit_check()
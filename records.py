@@ -33,7 +33,7 @@ class Fetcher:
                 "State": "IN",
                 "StartDate": "",
                 "EndDate": ""}
-        self.page = self.session.post(self.url, data=data).text.encode("utf-8", "ignore")
+        self.page = tea_core.get_response_bytes(self.session.post(self.url, data=data))
         pieces = self.break_page_into_pieces()
         pieces = set(pieces)
         self.pieces = pieces
@@ -50,13 +50,14 @@ class Fetcher:
     def fetch_all(self):
         newpieces = self.fetch_result_page()
         self.pieces |= set(newpieces)
-        self.pages = self.page
+        pages = [self.page]
         top_page_number = get_top_page_number(self.page)
         for i in range(1, top_page_number+1):
             time.sleep(1)
             newpieces = self.fetch_result_page(i)
-            self.pages += self.page
+            pages.append(self.page)
             self.pieces |= set(newpieces)
+        self.pages = "".join(pages)  # once, rather than copying everything so far for every page
 
     def fetch_until_date(self, until):
         pass
@@ -1,15 +1,29 @@
 import datetime
+import fcntl
 import geojson  # pip install geojson
+import hashlib
 import idem_settings
+import math
 import os
 import re
 import requests
 import shapefile  # pip install pyshp
+import shutil
 from shapely.geometry import mapping, Polygon, Point, MultiPoint  # pip install shapely
+import struct
+import threading
 import time
 import urllib
 import urllib2
 import utm  # pip install utm
+import zlib
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir  # pip install scandir
+    except ImportError:
+        scandir = None
 
 
 DEFAULT_SHORT_WAIT = 0.3
@@ -19,6 +33,9 @@ TIMEOUT = 100
 RETRY_LIMIT = 10
 NUM_COORD_DIGITS = 3
 DEFAULT_BUFFER = 0.015
+non_ascii_pattern = re.compile("[\x80-\xff]")
+snapshotdir = os.path.join(idem_settings.maindir, "Snapshots")  # daily pages, see SnapshotStore
+_snapshot_store = None
 
 
 class Thing(object):
@@ -41,6 +58,17 @@ class Thing(object):
             value = pieces[index]
             setattr(self, attribute, value)
 
+    def to_record(self):
+        """
+        Attribute values as a plain tuple, which is much cheaper to pickle between processes than the object.
+        :return: tuple
+        """
+        return tuple([getattr(self, x, None) for x in self.attribute_sequence])
+
+    def from_record(self, record):
+        for attribute, value in zip(self.attribute_sequence, record):
+            setattr(self, attribute, value)
+
     def to_tsv(self, callback=None):
         tsv = ""
         for attribute in self.attribute_sequence:
@@ -332,6 +360,751 @@ class Document(object):
         pass
 
 
+class FileLock(object):
+    """
+    Advisory lock on a file for a with block: shared locks may be held together, an exclusive lock waits for all
+    of them and keeps out new ones.
+    """
+
+    def __init__(self, path, exclusive=False):
+        self.path = path
+        self.exclusive = exclusive
+        self.handle = None
+
+    def __enter__(self):
+        self.handle = open(self.path, "a")
+        fcntl.flock(self.handle.fileno(), fcntl.LOCK_EX if self.exclusive else fcntl.LOCK_SH)
+        return self
+
+    def __exit__(self, *exception):
+        fcntl.flock(self.handle.fileno(), fcntl.LOCK_UN)
+        self.handle.close()
+        self.handle = None
+
+
+class BlobStore(object):
+    """
+    Content-addressed file store: each distinct file body is kept once, under its SHA-1 hash, and is linked into
+    the directories that need it. An append-only index maps external keys (e.g. document ids) to hashes.
+    """
+    index_filename = "index.tsv"
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.keys = {}
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.index_path = os.path.join(directory, self.index_filename)
+        self.load_index()
+
+    def load_index(self):
+        self.keys = {}
+        if not os.path.exists(self.index_path):
+            return self.keys
+        for line in open(self.index_path):
+            if "\t" not in line:
+                continue
+            key, digest = line.strip().split("\t")[:2]
+            self.keys[key] = digest
+        return self.keys
+
+    def path_for(self, digest):
+        return os.path.join(self.directory, digest[:2], digest[2:])
+
+    def has(self, digest):
+        return os.path.exists(self.path_for(digest))
+
+    def lookup(self, key):
+        """
+        Return hash stored for key, or None if the key is unknown or its blob has gone missing.
+        :param key: str
+        :return: str
+        """
+        digest = self.keys.get(key)
+        if digest and self.has(digest):
+            return digest
+        return None
+
+    def register(self, key, digest):
+        if self.keys.get(key) == digest:
+            return
+        self.keys[key] = digest
+        handle = open(self.index_path, "a")
+        with handle:
+            handle.write("%s\t%s\n" % (key, digest))
+
+    def put_file(self, path, digest=None):
+        """
+        Move file at path into the store, or discard it if identical content is already stored.
+        :param path: str
+        :param digest: str (hash of content, if already known)
+        :return: str (hash of content)
+        """
+        if digest is None:
+            digest = hash_file(path)
+        destination = self.path_for(digest)
+        if os.path.exists(destination):
+            os.remove(path)
+            return digest
+        subdirectory = os.path.dirname(destination)
+        if not os.path.isdir(subdirectory):
+            os.mkdir(subdirectory)
+        shutil.move(path, destination)
+        return digest
+
+    def link(self, digest, target):
+        """
+        Make stored content available at target path without copying it.
+        :param digest: str
+        :param target: str
+        :return: str
+        """
+        if os.path.lexists(target):
+            os.remove(target)
+        source = self.path_for(digest)
+        try:
+            os.link(source, target)
+        except OSError:  # e.g. store and archive on different filesystems
+            os.symlink(os.path.abspath(source), target)
+        return target
+
+    def link_key(self, key, target):
+        """
+        Link content stored for key to target path; return False if the key is not stored.
+        :param key: str
+        :param target: str
+        :return: bool
+        """
+        digest = self.lookup(key)
+        if digest is None:
+            return False
+        if not os.path.exists(target):
+            self.link(digest, target)
+        return True
+
+    def absorb(self, path, key=None):
+        """
+        Take an existing file into the store and replace it with a link to the stored copy.
+        :param path: str
+        :param key: str
+        :return: bool (whether the file was replaced; False if it was already a link to the store)
+        """
+        if os.path.islink(path):
+            return False
+        digest = hash_file(path)
+        stored = self.path_for(digest)
+        replaced = not os.path.exists(stored) or os.stat(stored).st_ino != os.stat(path).st_ino
+        if replaced:
+            self.put_file(path, digest=digest)
+            self.link(digest, path)
+        if key:
+            self.register(key, digest)
+        return replaced
+
+
+class SnapshotStore(BlobStore):
+    """
+    Store for pages fetched every day that seldom change: each distinct body is kept once, under its hash, and linked
+    to the dated path it was saved as. A dated index maps (source, date) to the hash of that day's body, where the
+    source is the dated path with its date replaced by "*", e.g. /data/46312/46312_*.html. Each directory's sources
+    have an index file of their own under indexes/, so a lookup reads only the index of the directory it is about,
+    and re-reads it only when another process has appended to that file.
+    """
+    date_pattern = re.compile("\d{4}-\d{2}-\d{2}")
+    index_dirname = "indexes"
+    lock_filename = "lock"
+
+    def load_index(self):
+        self.lock_path = os.path.join(self.directory, self.lock_filename)
+        self.keys = {}
+        self.sources = {}  # source -> {isodate: hash}, for the directories read so far
+        self.directories = {}  # directory -> set of sources in it
+        self.index_sizes = {}  # directory -> size of its index file when last read
+        self.index_directory = os.path.join(self.directory, self.index_dirname)
+        if not os.path.isdir(self.index_directory):
+            os.mkdir(self.index_directory)
+        return self.sources
+
+    def lock(self, exclusive=False):
+        """
+        Saves hold the store's lock shared; prune() holds it exclusively, so that no body it finds unreferenced is
+        being saved as it deletes it.
+        """
+        return FileLock(self.lock_path, exclusive=exclusive)
+
+    def get_index_path(self, directory):
+        return os.path.join(self.index_directory, hashlib.sha1(directory).hexdigest() + ".tsv")
+
+    def add_entry(self, source, date, digest):
+        if source not in self.sources:
+            self.sources[source] = {}
+            self.directories.setdefault(os.path.dirname(source), set()).add(source)
+        self.sources[source][date] = digest
+
+    def load_directory(self, directory):
+        for source in self.directories.pop(directory, ()):
+            self.sources.pop(source, None)
+        path = self.get_index_path(directory)
+        text = ""
+        if os.path.exists(path):
+            handle = open(path)
+            with handle:
+                text = handle.read()
+        self.index_sizes[directory] = len(text)
+        for line in text.split("\n")[:-1]:  # skip any partial last line
+            pieces = line.split("\t")
+            if len(pieces) != 3:
+                continue
+            self.add_entry(*pieces)
+
+    def refresh(self, directory):
+        """
+        Read a directory's index if it hasn't been read yet, or if another process has appended to it since.
+        :param directory: str (absolute path)
+        """
+        path = self.get_index_path(directory)
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        if self.index_sizes.get(directory) != size:
+            self.load_directory(directory)
+
+    @classmethod
+    def split_path(cls, path):
+        """
+        :param path: str
+        :return: tuple (source, isodate), or (None, None) if the filename has no date
+        """
+        path = os.path.abspath(path)
+        directory, filename = os.path.split(path)
+        matched = cls.date_pattern.search(filename)
+        if not matched:
+            return None, None
+        source = os.path.join(directory, filename[:matched.start()] + "*" + filename[matched.end():])
+        return source, matched.group(0)
+
+    def register(self, source, date, digest):
+        directory = os.path.dirname(source)
+        self.refresh(directory)
+        if self.sources.get(source, {}).get(date) == digest:
+            return
+        self.add_entry(source, date, digest)
+        line = "%s\t%s\t%s\n" % (source, date, digest)
+        path = self.get_index_path(directory)
+        handle = open(path, "a")
+        with handle:
+            handle.write(line)
+        if os.path.getsize(path) == self.index_sizes.get(directory, 0) + len(line):  # else someone else wrote too
+            self.index_sizes[directory] = os.path.getsize(path)
+
+    def put_text(self, text):
+        digest = hashlib.sha1(text).hexdigest()
+        destination = self.path_for(digest)
+        if not os.path.exists(destination):
+            subdirectory = os.path.dirname(destination)
+            if not os.path.isdir(subdirectory):
+                os.mkdir(subdirectory)
+            write_text_atomically(text, destination)
+        return digest
+
+    def save(self, text, path):
+        """
+        Keep text as the snapshot at a dated path.
+        :param text: str
+        :param path: str (filename must contain an ISO date)
+        :return: str (hash of text)
+        """
+        source, date = self.split_path(path)
+        if source is None:
+            raise ValueError("No date in %s" % path)
+        with self.lock():
+            digest = self.put_text(text)
+            self.register(source, date, digest)
+            self.link(digest, path)
+        return digest
+
+    def prune(self, retained):
+        """
+        Forget snapshots of the given sources from dates not retained, then delete bodies that nothing refers to.
+        Saves in other processes wait while this runs.
+        :param retained: dict of source -> set of ISO dates to keep
+        :return: int (number of bodies deleted)
+        """
+        with self.lock(exclusive=True):
+            return self.prune_unlocked(retained)
+
+    def prune_unlocked(self, retained):
+        by_directory = {}
+        for source, dates in retained.items():
+            by_directory.setdefault(os.path.dirname(source), {})[source] = dates
+        for directory, directory_retained in by_directory.items():
+            self.refresh(directory)
+            for source, dates in directory_retained.items():
+                if source in self.sources:
+                    self.sources[source] = dict([x for x in self.sources[source].items() if x[0] in dates])
+            lines = []
+            for source in sorted(self.directories.get(directory, ())):
+                for date, digest in sorted(self.sources[source].items()):
+                    lines.append("%s\t%s\t%s\n" % (source, date, digest))
+            text = "".join(lines)
+            write_text_atomically(text, self.get_index_path(directory))
+            self.index_sizes[directory] = len(text)
+        referenced = self.get_referenced()
+        deleted = 0
+        for subdirectory in os.listdir(self.directory):
+            subpath = os.path.join(self.directory, subdirectory)
+            if len(subdirectory) != 2 or not os.path.isdir(subpath):
+                continue
+            for filename in os.listdir(subpath):
+                if subdirectory + filename not in referenced:
+                    os.remove(os.path.join(subpath, filename))
+                    deleted += 1
+        return deleted
+
+    def get_referenced(self):
+        """
+        :return: set of the hashes in every directory's index
+        """
+        referenced = set()
+        for filename in os.listdir(self.index_directory):
+            if not filename.endswith(".tsv"):
+                continue
+            for line in open(os.path.join(self.index_directory, filename)).read().split("\n")[:-1]:
+                pieces = line.split("\t")
+                if len(pieces) == 3:
+                    referenced.add(pieces[2])
+        return referenced
+
+    def get_dates(self, source):
+        self.refresh(os.path.dirname(source))
+        return sorted(self.sources.get(source, {}).keys())
+
+    def get_path(self, source, date):
+        """
+        :return: str (path of stored body), or None if nothing is stored for that source and date
+        """
+        self.refresh(os.path.dirname(source))
+        digest = self.sources.get(source, {}).get(date)
+        if digest and self.has(digest):
+            return self.path_for(digest)
+        return None
+
+    def list_directory(self, directory):
+        """
+        Dated files recorded for a directory, whether or not they are still there.
+        :param directory: str
+        :return: dict of filename -> path to read it from
+        """
+        directory = os.path.abspath(directory)
+        self.refresh(directory)
+        listing = {}
+        for source in self.directories.get(directory, ()):
+            for date in self.sources[source]:
+                filename = os.path.basename(source).replace("*", date, 1)
+                path = os.path.join(directory, filename)
+                if not os.path.exists(path):
+                    path = self.get_path(source, date)
+                if path:
+                    listing[filename] = path
+        return listing
+
+
+class Journal(object):
+    """
+    Append-only record of completed work. Each line is flushed to disk as it is written, so an interrupted run can
+    pick up from the last recorded step. Given a run date, the journal starts with it, and a journal left by a run
+    on any other date is set aside rather than resumed.
+    """
+    run_kind = "run"
+
+    def __init__(self, path, run_date=None):
+        self.path = path
+        self.run_date = run_date
+        self.started = None  # ISO date of the run the journal belongs to
+        self.done = {}
+        self.load()
+        if run_date is not None and self.started is not None and self.started != run_date.isoformat():
+            print "Setting aside journal from %s" % self.started
+            self.finish()
+
+    def __len__(self):
+        return sum([len(x) for x in self.done.values()])
+
+    def load(self):
+        self.done = {}
+        self.started = None
+        if not os.path.exists(self.path):
+            return
+        for line in open(self.path):
+            if not line.endswith("\n"):  # partial line from an interrupted write
+                continue
+            pieces = line[:-1].split("\t")
+            if len(pieces) != 4:
+                continue
+            timestamp, kind, key, detail = pieces
+            if self.started is None:  # journals without a run line date from their first step
+                self.started = timestamp[:10]
+            if kind == self.run_kind:
+                self.started = key
+                continue
+            self.done.setdefault(kind, {})[key] = detail
+
+    def record(self, kind, key, detail=""):
+        now = datetime.datetime.now().isoformat()
+        line = ""
+        if self.started is None:
+            run_date = self.run_date.isoformat() if self.run_date is not None else now[:10]
+            line = "\t".join([now, self.run_kind, run_date, ""]) + "\n"
+            self.started = run_date
+        line += "\t".join([now, kind, key, str(detail)]) + "\n"
+        handle = open(self.path, "a")
+        with handle:
+            handle.write(line)
+            handle.flush()
+            os.fsync(handle.fileno())
+        self.done.setdefault(kind, {})[key] = str(detail)
+
+    def is_done(self, kind, key):
+        return key in self.done.get(kind, {})
+
+    def get(self, kind, key, default=None):
+        return self.done.get(kind, {}).get(key, default)
+
+    def finish(self):
+        """
+        Close out a completed run; the journal is kept alongside as .last for inspection.
+        """
+        if os.path.exists(self.path):
+            os.rename(self.path, self.path + ".last")
+        self.done = {}
+        self.started = None
+
+
+class RateLimiter(object):
+    """
+    Space out calls by at least min_interval seconds, even when they come from several threads.
+    """
+
+    def __init__(self, min_interval=DEFAULT_WAIT):
+        self.min_interval = min_interval
+        self.lock = threading.Lock()
+        self.next_time = 0
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.min_interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class DirectorySnapshot(object):
+    """
+    A single listing of a site directory, sorted into log pages, PDFs and TSVs, with the ISO date in each name.
+    Code that writes into the directory calls add(), so the snapshot stays current without listing again.
+    """
+    date_pattern = re.compile("\d\d\d\d-\d\d-\d\d")
+
+    def __init__(self, directory, prefix=None):
+        self.directory = directory
+        if prefix is None:
+            prefix = os.path.split(directory)[-1]
+        self.prefix = prefix
+        self.refresh()
+
+    def refresh(self):
+        self.names = set()
+        self.log_pages = set()
+        self.pdfs = set()
+        self.tsvs = set()
+        self.dates = {}
+        self.loose = set()
+        self.packs = {}  # name of packed page -> PackFile
+        if not self.directory or not os.path.isdir(self.directory):
+            return
+        if scandir is None:
+            names = os.listdir(self.directory)
+        else:
+            names = [x.name for x in scandir(self.directory) if x.is_file()]
+        for name in names:
+            self.add(name)
+        for name in names:
+            if name.endswith(PackFile.suffix + ".idx"):  # the index outlives the data file it first named
+                pack = PackFile(os.path.join(self.directory, name[:-len(".idx")]))
+                for packed_name in pack.entries:
+                    self.packs[packed_name] = pack
+                    self.names.add(packed_name)
+                    self.classify(packed_name)
+
+    def add(self, name):
+        self.names.add(name)
+        self.loose.add(name)
+        self.classify(name)
+
+    def classify(self, name):
+        if name.endswith(".pdf"):
+            self.pdfs.add(name)
+        elif name.endswith(".tsv"):
+            self.tsvs.add(name)
+        elif name.startswith(self.prefix) and "." not in name:
+            self.log_pages.add(name)
+        datecatcher = self.date_pattern.search(name)
+        if datecatcher is not None:
+            self.dates[name] = datecatcher.group(0)
+
+    def remove(self, name):
+        """
+        Note a file's removal; a page that is also packed stays listed.
+        """
+        self.loose.discard(name)
+        if name in self.packs:
+            return
+        for group in (self.names, self.log_pages, self.pdfs, self.tsvs):
+            group.discard(name)
+        self.dates.pop(name, None)
+
+    def read(self, name):
+        """
+        Content of a file or packed page; a loose file wins over a packed copy of the same name.
+        """
+        if name in self.loose or name not in self.packs:
+            return open(os.path.join(self.directory, name)).read()
+        return self.packs[name].read(name)
+
+    def discard(self, names):
+        """
+        Delete files and packed pages for good, rewriting any packs that held them.
+        :param names: iterable of filenames
+        """
+        names = set(names)
+        for pack in set([self.packs[x] for x in names if x in self.packs]):
+            pack.rewrite([x for x in pack.entries if x not in names])
+        for name in names & self.loose:
+            os.remove(os.path.join(self.directory, name))
+        self.refresh()
+
+    def stamp(self, name):
+        """
+        :return: str that changes whenever the content read for name might have
+        """
+        if name in self.loose or name not in self.packs:
+            stat = os.stat(os.path.join(self.directory, name))
+            return "%d:%d" % (int(stat.st_mtime), stat.st_size)
+        return self.packs[name].stamp(name)
+
+    def latest_log_page(self):
+        if not self.log_pages:
+            return None
+        return max(self.log_pages)
+
+    def latest_date(self, names):
+        """
+        :param names: iterable of filenames
+        :return: str (ISO date) or None
+        """
+        dates = [self.dates[x] for x in names if x in self.dates]
+        if not dates:
+            return None
+        return max(dates)
+
+
+class PackFile(object):
+    """
+    Compressed archive of a directory's pages in two files. name.pack holds zlib-compressed bodies, appended one
+    after another. name.pack.idx lists each page's name, offset, length and hash. Any page is one seek and one read
+    away, and identical bodies are written once. Both files only grow; a later index line for a name replaces an
+    earlier one. A rewrite puts the bodies in a new data file, name.pack.<n>, named by a header line in the index.
+    """
+    suffix = ".pack"
+    header = "#data"
+
+    def __init__(self, path):
+        self.path = path
+        self.index_path = path + ".idx"
+        self.data_path = path  # where the bodies are; moved by rewrite()
+        self.entries = {}  # name -> (offset, length, hash)
+        self.digests = {}  # hash -> (offset, length)
+        self.load()
+
+    def load(self):
+        self.entries = {}
+        self.digests = {}
+        self.data_path = self.path
+        if not os.path.exists(self.index_path):
+            return
+        lines = open(self.index_path).read().split("\n")[:-1]  # skip any partial last line
+        if lines and lines[0].startswith(self.header + "\t"):
+            self.data_path = os.path.join(os.path.dirname(self.path), lines[0].split("\t")[1])
+            lines = lines[1:]
+        if not os.path.exists(self.data_path):
+            return
+        pack_size = os.path.getsize(self.data_path)
+        for line in lines:
+            pieces = line.split("\t")
+            if len(pieces) != 4:
+                continue
+            name, offset, length, digest = pieces
+            offset, length = int(offset), int(length)
+            if offset + length > pack_size:  # record lost in a crash
+                continue
+            self.entries[name] = (offset, length, digest)
+            self.digests[digest] = (offset, length)
+
+    def read(self, name):
+        offset, length, digest = self.entries[name]
+        handle = open(self.data_path, "rb")
+        with handle:
+            handle.seek(offset)
+            data = handle.read(length)
+        return zlib.decompress(data)
+
+    def stamp(self, name):
+        offset, length, digest = self.entries[name]
+        return "pack:" + digest
+
+    def add_many(self, pages):
+        """
+        Append pages, writing the bodies before the index lines that point at them.
+        :param pages: iterable of (name, text)
+        """
+        lines = []
+        pack = open(self.data_path, "ab")
+        with pack:
+            offset = os.path.getsize(self.data_path)
+            for name, text in pages:
+                digest = hashlib.sha1(text).hexdigest()
+                if digest not in self.digests:
+                    data = zlib.compress(text, 6)
+                    pack.write(data)
+                    self.digests[digest] = (offset, len(data))
+                    offset += len(data)
+                record_offset, length = self.digests[digest]
+                self.entries[name] = (record_offset, length, digest)
+                lines.append("%s\t%d\t%d\t%s\n" % (name, record_offset, length, digest))
+            pack.flush()
+            os.fsync(pack.fileno())
+        index = open(self.index_path, "a")
+        with index:
+            index.write("".join(lines))
+
+    def add(self, name, text):
+        self.add_many([(name, text)])
+
+    def rewrite(self, names):
+        """
+        Replace the pack with one holding only the named pages. The bodies go to a new data file, and a single rename
+        of the index switches readers from the old data file to the new one, so a crash at any point leaves one
+        consistent pair. Data files left over from earlier rewrites are then deleted.
+        :param names: iterable of page names to keep
+        """
+        pages = [(x, self.read(x)) for x in sorted(names)]
+        generation = 1
+        while os.path.exists("%s.%d" % (self.path, generation)):
+            generation += 1
+        compacted = PackFile(self.path + ".tmp")
+        if os.path.exists(compacted.index_path):
+            os.remove(compacted.index_path)
+        compacted.data_path = "%s.%d" % (self.path, generation)
+        compacted.add_many(pages)
+        header = "%s\t%s\n" % (self.header, os.path.basename(compacted.data_path))
+        write_text_atomically(header + open(compacted.index_path).read(), self.index_path)
+        os.remove(compacted.index_path)
+        directory, filename = os.path.split(self.path)
+        for name in os.listdir(directory):
+            stale = name == filename or (name.startswith(filename + ".") and name[len(filename) + 1:].isdigit())
+            if stale and os.path.join(directory, name) != compacted.data_path:
+                os.remove(os.path.join(directory, name))
+        self.load()
+
+
+def pack_directory(directory, names, pack_name, keep_loose=()):
+    """
+    Move pages from loose files into a directory's packfile.
+    :param directory: str
+    :param names: iterable of filenames to pack
+    :param pack_name: str (filename of the packfile, ending in .pack)
+    :param keep_loose: filenames to pack but leave in place as well
+    :return: int (number of pages packed)
+    """
+    pack = PackFile(os.path.join(directory, pack_name))
+    names = sorted([x for x in names if os.path.isfile(os.path.join(directory, x))])
+    pack.add_many([(x, open(os.path.join(directory, x)).read()) for x in names])
+    for name in names:
+        if name not in keep_loose:
+            os.remove(os.path.join(directory, name))
+    return len(names)
+
+
+class BloomFilter(object):
+    """
+    Fixed-size bit array answering "have I seen this key?" with no false negatives and, up to capacity, about
+    error_rate false positives. A miss is certain, so callers only need to look further on a hit.
+    """
+
+    def __init__(self, capacity=1000000, error_rate=0.01):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, int(round(float(self.size) / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0  # keys added, counting repeats
+
+    def positions(self, key):
+        first, second = struct.unpack("<QQ", hashlib.md5(key).digest())
+        return [(first + i * second) % self.size for i in range(self.hash_count)]
+
+    def add(self, key):
+        for position in self.positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        for position in self.positions(key):
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def is_full(self):
+        return self.count > self.capacity
+
+    def save(self, path, label=""):
+        """
+        :param label: str (kept in the header, for callers to tell whether the filter is stale)
+        """
+        header = "%d\t%s\t%d\t%s\n" % (self.capacity, repr(self.error_rate), self.count, label)
+        write_text_atomically(header + str(self.bits), path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        :return: tuple (BloomFilter, label) or (None, None) if the file is missing or damaged
+        """
+        if not os.path.exists(path):
+            return None, None
+        content = open(path, "rb").read()
+        header, _, bits = content.partition("\n")
+        try:
+            capacity, error_rate, count, label = header.split("\t")
+            bloom = cls(capacity=int(capacity), error_rate=float(error_rate))
+        except ValueError:
+            return None, None
+        if len(bits) != len(bloom.bits):
+            return None, None
+        bloom.bits = bytearray(bits)
+        bloom.count = int(count)
+        return bloom, label
+
+
+def hash_file(path, blocksize=65536):
+    hasher = hashlib.sha1()
+    handle = open(path, "rb")
+    with handle:
+        block = handle.read(blocksize)
+        while block:
+            hasher.update(block)
+            block = handle.read(blocksize)
+    return hasher.hexdigest()
+
+
 def get_previous_file_in_directory(directory,
                                    pattern=".*(\d{4}-\d{2}-\d{2})",
                                    reference_date=datetime.date.today().isoformat()):
@@ -340,8 +1113,8 @@ def get_previous_file_in_directory(directory,
         return re.match(pattern, file_in_directory)
     if not isinstance(reference_date, basestring):
         reference_date = reference_date
-    files = os.listdir(directory)
-    files = [x for x in files if is_dated_file(x)]
+    listing = get_dated_listing(directory)
+    files = [x for x in listing if is_dated_file(x)]
     dated_files = []
     for filename in files:
         date = re.search(pattern, filename).group(1)
@@ -350,10 +1123,115 @@ def get_previous_file_in_directory(directory,
     dated_files.reverse()
     for date, filename in dated_files:  # starting from most recent
         if date < reference_date:
-            filepath = os.path.join(directory, filename)
+            filepath = listing[filename]
             return filepath
 
 
+def choose_checkpoints(dates, cutoff, period="month"):
+    """
+    Dates kept by a retention policy: all from cutoff on, the latest, and the earliest in each week or month before.
+    :param dates: iterable of ISO date strings
+    :param cutoff: str (ISO date)
+    :param period: "week" or "month"
+    :return: set
+    """
+    dates = sorted(set(dates))
+    keep = set([x for x in dates if x >= cutoff])
+    if dates:
+        keep.add(dates[-1])
+    periods = set()
+    for date in dates:
+        if date >= cutoff:
+            break
+        if period == "week":
+            key = datetime.datetime.strptime(date, "%Y-%m-%d").isocalendar()[:2]
+        elif period == "month":
+            key = date[:7]
+        else:
+            raise ValueError(period)
+        if key not in periods:
+            periods.add(key)
+            keep.add(date)
+    return keep
+
+
+def apply_retention(directory, sources, cutoff, period="month"):
+    """
+    Delete dated files in directory other than the checkpoints chosen for each source.
+    :param directory: str
+    :param sources: list of filenames with "*" for the date, e.g. ["46312_*.html"]
+    :param cutoff: str (ISO date)
+    :param period: "week" or "month"
+    :return: dict of source path -> set of dates kept, for SnapshotStore.prune()
+    """
+    store = get_snapshot_store()
+    names = os.listdir(directory)
+    retained = {}
+    for pattern in sources:
+        prefix, suffix = pattern.split("*", 1)
+        source = os.path.join(os.path.abspath(directory), pattern)
+        dated = {}
+        for name in names:
+            if name.startswith(prefix) and name.endswith(suffix) and len(name) == len(pattern) + 9:
+                date = name[len(prefix):len(prefix) + 10]
+                if SnapshotStore.date_pattern.match(date):
+                    dated[date] = name
+        keep = choose_checkpoints(set(dated.keys()) | set(store.get_dates(source)), cutoff, period)
+        for date, name in dated.items():
+            if date not in keep:
+                os.remove(os.path.join(directory, name))
+        retained[source] = keep
+    return retained
+
+
+def get_response_bytes(response):
+    """
+    Body of a requests response as UTF-8 bytes. A body declared as UTF-8, or that is plain ASCII whatever it is
+    declared as, is returned as received, with no decoding to unicode and encoding back. An unknown declared
+    encoding falls back to the one guessed from the body, and failing that the body is returned as received.
+    :param response: requests.Response
+    :return: str
+    """
+    content = response.content
+    encoding = (response.encoding or "utf-8").lower().replace("_", "-")
+    if encoding in ("utf-8", "utf8", "ascii", "us-ascii") or not non_ascii_pattern.search(content):
+        return content
+    for candidate in (encoding, getattr(response, "apparent_encoding", None)):
+        if not candidate:
+            continue
+        try:
+            return content.decode(candidate, "ignore").encode("utf-8", "ignore")
+        except LookupError:
+            continue
+    return content
+
+
+def get_dated_listing(directory):
+    """
+    Files in directory plus snapshots recorded for it that have since been removed.
+    :param directory: str
+    :return: dict of filename -> path to read it from
+    """
+    listing = get_snapshot_store().list_directory(directory)
+    for filename in os.listdir(directory):
+        listing[filename] = os.path.join(directory, filename)
+    return listing
+
+
+def get_snapshot_store():
+    global _snapshot_store
+    if _snapshot_store is None:
+        _snapshot_store = SnapshotStore(snapshotdir)
+    return _snapshot_store
+
+
+def save_snapshot(text, path):
+    """
+    Save a daily page, keeping its body only once however many days it comes back unchanged.
+    """
+    return get_snapshot_store().save(text, path)
+
+
 """Hypergeneric functions"""
 
 
@@ -848,6 +1726,28 @@ def update_all_local_directories(root=idem_settings.websitedir):
         update_local_directory(directory, indexfile, timefile)
 
 
+def update_local_directories_containing(latlongs, root=idem_settings.websitedir, buff=DEFAULT_BUFFER):
+    """
+    Regenerate only the local directories whose buffered polygon takes in any of the given points.
+    :param latlongs: list of (latitude, longitude)
+    :return: list of directories updated
+    """
+    points = [Point(longitude, latitude) for latitude, longitude in latlongs]
+    if not points:
+        return []
+    indexfile, timefile = get_root_files(root)
+    updated = []
+    for directory in filter_local_directories(root):
+        coords = extract_coords_from_polygon_js(os.path.join(directory, "polygon.js"))
+        if not coords:
+            continue
+        area = Polygon(coords).buffer(buff)
+        if any([area.contains(x) for x in points]):
+            update_local_directory(directory, indexfile, timefile)
+            updated.append(directory)
+    return updated
+
+
 def get_daily_filepath(suffix, date=None, directory=idem_settings.maindir, doctype="permits"):
     if date is None:
         date = datetime.date.today()
@@ -869,4 +1769,17 @@ if __name__ == "__main__":
 def write_text_to_file(text, path):
     handle = open(path, "w")
     with handle:
-        handle.write(text)
\ No newline at end of file
+        handle.write(text)
+
+
+def write_text_atomically(text, path):
+    """
+    Replace file contents so that readers (and a crash) see either the old file or the new one, never half of each.
+    """
+    temppath = path + ".tmp"
+    handle = open(temppath, "w")
+    with handle:
+        handle.write(text)
+        handle.flush()
+        os.fsync(handle.fileno())
+    os.rename(temppath, path)
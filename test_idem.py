@@ -1,8 +1,27 @@
 import datetime
 import idem
+import os
+import pageparser
+import shutil
+import tempfile
 import unittest
 
 
+def build_row(docid, datestring="01/02/2019"):
+    row = '<tr class="row"><td class="xuiListContentCell"><a href="/cs/groups/doc/%s.pdf">%s</a>' % (docid, docid)
+    for value in [datestring, "OAQ", "Permit", "Public", "1234"]:
+        row += '<div nowrap="nowrap">%s</div>' % value
+    row += "</td></tr>\n"
+    return row
+
+
+def build_page(docids):
+    page = "<html><table><tr><th>Header</th></tr>\n"
+    page += "".join([build_row(x) for x in docids])
+    page += "</table>Number of items found: %d</html>" % len(docids)
+    return page
+
+
 class DocumentTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -140,5 +159,892 @@ class FacilityCollectionTestCase(unittest.TestCase):
         self.assertRaises(TypeError, idem.FacilityCollection, [self.bad_item])
 
 
+class FacilityPageTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.facility = idem.Facility(vfc_id="100", directory=self.directory)
+        self.facility.docs.extend(self.facility.docs_from_page(build_page(["103", "102"])))
+        self.page = build_page(["106", "105", "104", "103", "102"])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_iter_doc_rows_matches_split(self):
+        rows = [x for x in self.page.split("<tr")[1:] if "xuiListContentCell" in x]
+        self.assertEqual([x.fileid for x in pageparser.iter_doc_rows(self.page)],
+                         [pageparser.get_pdf_id(x[:x.index('.pdf"') + 4]) for x in rows])
+
+    def test_read_new_docs_stops_at_known(self):
+        docs, reached_known = self.facility.read_new_docs_from_page(self.page)
+        self.assertTrue(reached_known)
+        self.assertEqual(sorted(docs.ids), ["104", "105", "106"])
+
+    def test_read_new_docs_reports_all_new(self):
+        docs, reached_known = self.facility.read_new_docs_from_page(build_page(["108", "107"]))
+        self.assertFalse(reached_known)
+        self.assertEqual(len(docs), 2)
+
+
+class LazyFacilityTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.sitedir = os.path.join(self.directory, "100")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_stub_touches_nothing_until_used(self):
+        facility = idem.Facility(vfc_id="100", directory=self.sitedir, vfc_name="Argle", lazy=True)
+        self.assertFalse(os.path.exists(self.sitedir))
+        self.assertEqual(facility._docs, None)
+        self.assertEqual(len(facility.docs), 0)
+        self.assertEqual(facility.page, "")
+
+    def test_stub_loads_docs_from_tsv_on_access(self):
+        facility = idem.Facility(vfc_id="100", directory=self.sitedir)
+        facility.docs.extend(facility.docs_from_page(build_page(["102", "101"]), crawl_date=datetime.date(2019, 1, 3)))
+        facility.save_docs_to_tsv()
+        stub = idem.Facility(tsv=facility.to_tsv(), lazy=True)
+        self.assertEqual(stub._docs, None)
+        self.assertEqual(sorted(stub.docs.ids), ["101", "102"])
+
+
+class ParallelLoadTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.maindir = idem.maindir
+        idem.maindir = self.directory
+        updater = idem.ZipUpdater("46312", load_facilities=False)
+        for vfc_id in ["100", "200"]:
+            facility = idem.Facility(vfc_id=vfc_id, parent=updater, vfc_name="Argle " + vfc_id)
+            page = build_page([vfc_id + "2", vfc_id + "1"])
+            facility.docs.extend(facility.docs_from_page(page, crawl_date=datetime.date(2019, 1, 3)))
+            updater.facilities.append(facility)
+        updater.save_tsv()
+
+    def tearDown(self):
+        idem.maindir = self.maindir
+        shutil.rmtree(self.directory)
+
+    def describe(self, collection):
+        return sorted([(x.vfc_id, x.vfc_name, x.directory, sorted([(y.id, y.crawl_date) for y in x.docs]))
+                       for x in collection.facilities])
+
+    def test_parallel_load_matches_sequential(self):
+        sequential = idem.ZipCollection(zips=["46312"], load_tsv=True, offline=True)
+        parallel = idem.load_collection_in_parallel(zips=["46312"], processes=2, offline=True)
+        self.assertEqual(self.describe(parallel), self.describe(sequential))
+        self.assertEqual(len(self.describe(parallel)), 2)
+
+
+class FacilityStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.maindir = idem.maindir
+        idem.maindir = self.directory
+        self.store = idem.FacilityStore(os.path.join(self.directory, "facilities.sqlite"))
+        for zipcode, vfc_id in [("46312", "100"), ("46320", "200")]:
+            updater = idem.ZipUpdater(zipcode, load_facilities=False)
+            facility = idem.Facility(vfc_id=vfc_id, parent=updater, vfc_name="Argle " + vfc_id)
+            facility.latlong = (41.5, -87.4)
+            page = build_page([vfc_id + "2", vfc_id + "1"])
+            facility.docs.extend(facility.docs_from_page(page, crawl_date=datetime.date(2019, 1, 3)))
+            updater.facilities.append(facility)
+            updater.save_tsv()
+
+    def tearDown(self):
+        self.store.close()
+        idem.maindir = self.maindir
+        shutil.rmtree(self.directory)
+
+    def describe(self, facilities):
+        return sorted([(x.vfc_id, x.vfc_name, x.zip, x.latlong, sorted([(y.filename, y.crawl_date) for y in x.docs]))
+                       for x in facilities])
+
+    def test_import_round_trips(self):
+        self.assertEqual(self.store.import_zips(["46312", "46320"]), 2)
+        from_tsv = idem.ZipUpdater("46312", load_tsv=True, load_facilities=False)
+        from_store = self.store.load_zip("46312")
+        self.assertEqual(self.describe(from_store), self.describe(from_tsv.facilities))
+
+    def test_docs_since_in_zips(self):
+        self.store.import_zips(["46312", "46320"])
+        docs = self.store.get_docs_since(datetime.date(2000, 1, 1), zips=["46320"])
+        self.assertEqual(sorted([x.id for x in docs]), ["2001", "2002"])
+        self.assertEqual(set([x.facility_id for x in docs]), set(["200"]))
+        self.assertEqual(self.store.get_docs_since(datetime.date(2019, 1, 4), field="crawl_date"), [])
+
+    def test_facilities_from_store_are_not_dirty(self):
+        self.store.import_zips(["46312"])
+        facility = self.store.load_zip("46312")[0]
+        self.assertFalse(facility.docs_dirty)
+
+    def test_non_ascii_names_round_trip(self):
+        self.store.import_zips(["46312"])
+        facility = self.store.load_zip("46312")[0]
+        facility.vfc_name = "Caf\xc3\xa9 Argle"
+        self.store.save_facilities([facility])
+        reloaded = self.store.load_zip("46312")[0]
+        self.assertEqual(reloaded.vfc_name, "Caf\xc3\xa9 Argle")
+        self.assertTrue(type(reloaded.vfc_id) is str)
+
+    def test_resave_replaces_docs(self):
+        self.store.import_zips(["46312"])
+        facility = self.store.load_zip("46312")[0]
+        facility.docs = idem.DocumentCollection(list(facility.docs)[:1])
+        self.store.save_facilities([facility])
+        self.assertEqual(len(self.store.load_zip("46312")[0].docs), 1)
+
+    def use_store(self):
+        saved = idem.use_store, idem._store
+        idem.use_store, idem._store = True, self.store
+
+        def restore():
+            idem.use_store, idem._store = saved
+        self.addCleanup(restore)
+
+    def test_store_replaces_tsv(self):
+        self.store.import_zips(["46312"])
+        self.use_store()
+        tsv_path = os.path.join(self.directory, "46312", "46312.tsv")
+        before = open(tsv_path).read()
+        updater = idem.ZipUpdater("46312", load_tsv=True, load_facilities=False)
+        facility = updater.facilities[0]
+        facility.vfc_name = "Bargle"
+        facility.docs.extend(facility.docs_from_page(build_page(["1003"]), crawl_date=datetime.date(2019, 1, 4)))
+        updater.save_tsv()
+        self.assertEqual(open(tsv_path).read(), before)
+        from_store = self.store.load_zip("46312")[0]
+        self.assertEqual(from_store.vfc_name, "Bargle")
+        self.assertEqual(sorted([x.id for x in from_store.docs]), ["1001", "1002", "1003"])
+
+    def test_collection_loads_what_was_saved_to_store(self):
+        self.store.import_zips(["46312"])
+        self.use_store()
+        updater = idem.ZipUpdater("46312", load_tsv=True, load_facilities=False)
+        facility = updater.facilities[0]
+        facility.docs.extend(facility.docs_from_page(build_page(["1003"]), crawl_date=datetime.date(2019, 1, 4)))
+        updater.save_tsv()
+        collection = idem.setup_collection(zips=["46312"], processes=2)
+        self.assertEqual(sorted(collection.facilities.iddic["100"].docs.ids), ["1001", "1002", "1003"])
+
+    def test_facility_gone_from_zip_is_deleted(self):
+        self.store.import_zips(["46312"])
+        self.use_store()
+        updater = idem.ZipUpdater("46312", load_tsv=True, load_facilities=False)
+        updater.facilities.append(idem.Facility(vfc_id="101", parent=updater, vfc_name="Argle 101"))
+        updater.save_tsv()
+        updater = idem.ZipUpdater("46312", load_tsv=True, load_facilities=False)
+        updater.facilities = idem.FacilityCollection([x for x in updater.facilities if x.vfc_id != "100"])
+        updater.save_tsv()
+        self.assertEqual([x.vfc_id for x in self.store.load_zip("46312")], ["101"])
+        self.assertEqual(self.store.load_docs("100"), [])
+
+
+class DocLogTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.maindir = idem.maindir
+        idem.maindir = self.directory
+        updater = idem.ZipUpdater("46312", load_facilities=False)
+        facility = idem.Facility(vfc_id="100", parent=updater)
+        page = build_page(["1002", "1001"])
+        facility.docs.extend(facility.docs_from_page(page, crawl_date=datetime.date(2019, 1, 3)))
+        updater.facilities.append(facility)
+        updater.save_tsv()
+        self.docs_path = facility.docs_path
+        self.updater = idem.ZipUpdater("46312", load_tsv=True, load_facilities=False)
+        self.facility = self.updater.facilities[0]
+
+    def tearDown(self):
+        idem.maindir = self.maindir
+        shutil.rmtree(self.directory)
+
+    def add_doc(self, docid):
+        page = build_page([docid])
+        self.facility.docs.extend(self.facility.docs_from_page(page, crawl_date=datetime.date(2019, 2, 1)))
+
+    def reload(self):
+        return idem.ZipUpdater("46312", load_tsv=True, load_facilities=False).facilities[0]
+
+    def test_unchanged_zip_writes_nothing(self):
+        os.remove(self.docs_path)
+        os.remove(self.updater.tsv_path)
+        self.updater.save_tsv(savedocs=True)
+        self.assertFalse(os.path.exists(self.docs_path))
+        self.assertFalse(os.path.exists(self.updater.tsv_path))
+
+    def test_new_docs_are_appended(self):
+        before = open(self.docs_path).read()
+        self.add_doc("1003")
+        self.updater.save_tsv(savedocs=True)
+        after = open(self.docs_path).read()
+        self.assertTrue(after.startswith(before))
+        self.assertEqual(len(after.splitlines()), len(before.splitlines()) + 1)
+        self.assertEqual(sorted(self.reload().docs.ids), ["1001", "1002", "1003"])
+
+    def test_changed_doc_is_appended(self):
+        doc = [x for x in self.facility.docs if x.id == "1001"][0]
+        doc.path = "/argle/1001.pdf"
+        self.assertTrue(self.facility.docs_dirty)
+        self.assertEqual(self.facility.save_docs_to_tsv(), [doc])
+        reloaded = [x for x in self.reload().docs if x.id == "1001"][0]
+        self.assertEqual(reloaded.path, "/argle/1001.pdf")
+
+    def test_torn_append_is_dropped_and_compacted(self):
+        open(self.docs_path, "a").write("1003\thttp://argle")
+        facility = self.reload()
+        self.assertEqual(len(facility.docs), 2)
+        self.assertTrue(facility.docs_dirty)
+        facility.save_docs_to_tsv()
+        self.assertTrue(open(self.docs_path).read().endswith("\n"))
+
+    def test_compaction_restores_order(self):
+        self.add_doc("1003")
+        self.facility.save_docs_to_tsv()
+        idem.compact_doc_logs(["46312"])
+        docs = list(self.reload().docs)
+        self.assertEqual(docs, sorted(docs))
+        self.assertFalse(self.reload().docs_dirty)
+
+
+class PackedPagesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.directory = os.path.join(self.root, "100")
+        os.mkdir(self.directory)
+        self.saved_store = idem.tea_core._snapshot_store
+        self.store = idem.tea_core.SnapshotStore(os.path.join(self.root, "snapshots"))
+        idem.tea_core._snapshot_store = self.store
+        self.facility = idem.Facility(vfc_id="100", directory=self.directory)
+        for date, docids in [("2019-01-01", ["101"]), ("2019-01-02", ["102", "101"])]:
+            open(os.path.join(self.directory, "100_" + date), "w").write(build_page(docids))
+
+    def tearDown(self):
+        idem.tea_core._snapshot_store = self.saved_store
+        shutil.rmtree(self.root)
+
+    def get_disk_usage(self):
+        inodes = {}
+        for root, directories, filenames in os.walk(self.root):
+            for filename in filenames:
+                stat = os.stat(os.path.join(root, filename))
+                inodes[stat.st_ino] = stat.st_size
+        return sum(inodes.values())
+
+    def describe(self, docs):
+        return sorted([(x.id, x.crawl_date) for x in docs])
+
+    def test_reads_are_transparent(self):
+        facility = idem.Facility(vfc_id="100", directory=self.directory)
+        before = self.describe(facility.docs)
+        self.assertEqual(facility.pack_pages(), 2)
+        self.assertEqual(os.listdir(self.directory).count("100_2019-01-01"), 0)
+        packed = idem.Facility(vfc_id="100", directory=self.directory)
+        self.assertEqual(self.describe(packed.docs), before)
+        self.assertEqual(packed.get_latest_page(), build_page(["102", "101"]))
+        self.assertEqual(idem.get_latest_total(self.directory), 2)
+
+    def test_packing_snapshots_frees_their_bodies(self):
+        sitedir = os.path.join(self.root, "200")
+        os.mkdir(sitedir)
+        for day in range(1, 11):
+            docids = [str(2000 + x) for x in range(day * 10, 0, -1)]
+            idem.tea_core.save_snapshot(build_page(docids), os.path.join(sitedir, "200_2019-01-%02d" % day))
+        before = self.get_disk_usage()
+        self.assertEqual(idem.pack_log_pages(sitedir), 10)
+        self.assertTrue(self.get_disk_usage() < before / 2)
+        self.assertEqual(self.store.get_dates(os.path.join(sitedir, "200_*")), [])
+        self.assertEqual(idem.Facility(vfc_id="200", directory=sitedir).get_latest_page().count(".pdf"), 100)
+
+
+class RetentionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.saved_store = idem.tea_core._snapshot_store
+        idem.tea_core._snapshot_store = idem.tea_core.SnapshotStore(os.path.join(self.directory, "snapshots"))
+        self.sitedir = os.path.join(self.directory, "100")
+        os.mkdir(self.sitedir)
+        pages = [("2019-01-01", ["101"]), ("2019-01-02", ["101"]), ("2019-01-09", ["102", "101"]),
+                 ("2019-02-01", ["103", "102", "101"]), ("2019-03-01", ["103", "102", "101"])]
+        for date, docids in pages:
+            idem.tea_core.save_snapshot(build_page(docids), os.path.join(self.sitedir, "100_" + date))
+
+    def tearDown(self):
+        idem.tea_core._snapshot_store = self.saved_store
+        shutil.rmtree(self.directory)
+
+    def describe(self, facility):
+        return sorted([(x.id, x.crawl_date) for x in facility.docs])
+
+    def test_first_seen_dates_survive_compaction(self):
+        before = self.describe(idem.Facility(vfc_id="100", directory=self.sitedir))
+        facility = idem.Facility(vfc_id="100", directory=self.sitedir, lazy=True)
+        retained = facility.compact_history("2019-02-15", period="month")
+        self.assertEqual(sorted(facility.snapshot.log_pages), ["100_2019-01-01", "100_2019-02-01", "100_2019-03-01"])
+        self.assertEqual(self.describe(idem.Facility(vfc_id="100", directory=self.sitedir)), before)
+        store = idem.tea_core.get_snapshot_store()
+        self.assertEqual(store.prune(retained), 1)  # only the 2019-01-09 body was unique to a dropped page
+        self.assertEqual(store.get_dates(retained.keys()[0]), ["2019-01-01", "2019-02-01", "2019-03-01"])
+
+    def test_weekly_checkpoints(self):
+        dates = ["2019-01-01", "2019-01-02", "2019-01-09", "2019-02-01", "2019-03-01"]
+        kept = idem.tea_core.choose_checkpoints(dates, "2019-02-15", period="week")
+        self.assertEqual(sorted(kept), ["2019-01-01", "2019-01-09", "2019-02-01", "2019-03-01"])
+
+
+class DocumentIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.facilities = idem.FacilityCollection()
+        for vfc_id, days in [("100", [1, 30]), ("200", [3, 4, 60]), ("300", [90])]:
+            facility = idem.Facility(vfc_id=vfc_id, lazy=True)
+            facility.docs = idem.DocumentCollection([self.make_doc(vfc_id, x) for x in days])
+            self.facilities.append(facility)
+        self.today = datetime.date(2019, 6, 1)
+
+    def make_doc(self, vfc_id, days_ago, crawl_days_ago=None):
+        file_date = datetime.date(2019, 6, 1) - datetime.timedelta(days_ago)
+        crawl_date = file_date
+        if crawl_days_ago is not None:
+            crawl_date = datetime.date(2019, 6, 1) - datetime.timedelta(crawl_days_ago)
+        return idem.Document(id=vfc_id + str(days_ago), file_date=file_date, crawl_date=crawl_date)
+
+    def scan(self, sincedate):
+        return idem.get_sites_with_activity(list(self.facilities), sincedate)
+
+    def test_active_sites_match_scan(self):
+        for days in [0, 2, 5, 45, 100]:
+            sincedate = self.today - datetime.timedelta(days)
+            self.assertEqual(idem.get_sites_with_activity(self.facilities, sincedate), self.scan(sincedate))
+
+    def test_docs_in_range(self):
+        collection = idem.ZipCollection(zips=[], offline=True)
+        collection.facilities = self.facilities
+        found = collection.get_all_docs_in_range(self.today - datetime.timedelta(30), self.today)
+        self.assertEqual(sorted([(x.vfc_id, sorted(y.ids)) for x, y in found.items()]),
+                         [("100", ["1001", "10030"]), ("200", ["2003", "2004"])])
+
+    def test_later_additions_are_indexed(self):
+        self.facilities.doc_index
+        facility = self.facilities.iddic["300"]
+        facility.docs.append(self.make_doc("300", 100, crawl_days_ago=2))
+        sincedate = self.today - datetime.timedelta(5)
+        self.assertEqual(idem.tally_site_activity(facility, sincedate), 1)
+        self.assertEqual([x.id for x in idem.get_docs_since(facility, sincedate)], ["300100"])
+        facility.docs = idem.DocumentCollection([self.make_doc("300", 1)])
+        self.assertEqual([x.id for x in idem.get_docs_since(facility, sincedate)], ["3001"])
+
+    def test_replacing_docs_touches_only_that_facility(self):
+        index = self.facilities.doc_index
+        before = [(x.vfc_id, y.id) for x, y in index.get_docs() if x.vfc_id != "200"]
+        facility = self.facilities.iddic["200"]
+        facility.docs = idem.DocumentCollection([self.make_doc("200", 2)])
+        after = index.get_docs()
+        self.assertEqual([(x.vfc_id, y.id) for x, y in after if x.vfc_id != "200"], before)
+        self.assertEqual([y.id for x, y in after if x.vfc_id == "200"], ["2002"])
+        self.assertEqual(len(index.docs), len(index.by_file_date))
+
+
+class KnownDocIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.index = idem.KnownDocIndex(os.path.join(self.directory, "known_docs.sqlite"))
+        self.saved = idem._known_docs, idem.use_known_docs
+        idem._known_docs, idem.use_known_docs = self.index, True
+
+    def tearDown(self):
+        idem._known_docs, idem.use_known_docs = self.saved
+        self.index.close()
+        shutil.rmtree(self.directory)
+
+    def test_known_ids_are_confirmed(self):
+        self.index.add_docs("100", ["101", "102"])
+        self.assertTrue(self.index.is_known("101", "100"))
+        self.assertFalse(self.index.is_known("101", "200"))
+        self.assertEqual(self.index.get_known_ids(["102", "103"]), set(["102"]))
+
+    def test_filter_survives_reload(self):
+        self.index.add_docs("100", ["101"])
+        self.index.save()
+        reloaded = idem.KnownDocIndex(self.index.path)
+        self.assertFalse(reloaded.bloom_dirty)
+        self.assertTrue(reloaded.is_known("101"))
+        reloaded.close()
+
+    def test_rows_from_other_processes_are_absorbed(self):
+        other = idem.KnownDocIndex(self.index.path)
+        self.index.add_docs("100", ["101"])
+        other.add_docs("200", ["201"])
+        self.index.save()
+        reloaded = idem.KnownDocIndex(self.index.path)
+        self.assertTrue(reloaded.is_known("201", "200"))
+        self.assertTrue(self.index.is_known("201", "200"))
+        other.close()
+        reloaded.close()
+
+    def test_cross_facility_duplicates(self):
+        self.index.add_docs("100", ["101", "102"])
+        self.index.add_docs("200", ["102"])
+        self.assertEqual(self.index.get_duplicates(), {"102": ["100", "200"]})
+
+    def test_stub_reads_new_rows_without_loading_docs(self):
+        sitedir = os.path.join(self.directory, "100")
+        facility = idem.Facility(vfc_id="100", directory=sitedir)
+        facility.docs.extend(facility.docs_from_page(build_page(["102", "101"]), crawl_date=datetime.date(2019, 1, 3)))
+        facility.save_docs_to_tsv()
+        stub = idem.Facility(tsv=facility.to_tsv(), lazy=True)
+        docs, reached_known = stub.read_new_docs_from_page(build_page(["104", "103", "102", "101"]))
+        self.assertTrue(reached_known)
+        self.assertEqual([x.id for x in docs], ["104", "103"])
+        self.assertTrue(stub.has_docs())
+        self.assertEqual(stub._docs, None)
+
+
+class FailingResponse(object):
+
+    def raise_for_status(self):
+        raise IOError("503")
+
+
+class FailingSession(object):
+
+    def get(self, url, **kwargs):
+        return FailingResponse()
+
+
+class FetchIntoStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.saved_store = idem._blob_store
+        idem._blob_store = idem.tea_core.BlobStore(self.directory)
+
+    def tearDown(self):
+        idem._blob_store = self.saved_store
+        shutil.rmtree(self.directory)
+
+    def test_url_must_name_the_document(self):
+        url = "https://ecm.example.com/cs/groups/doc/80012345.pdf"
+        self.assertRaises(ValueError, idem.fetch_into_store, "80099999", url, session=FailingSession())
+
+    def test_failed_fetch_leaves_no_partial_file(self):
+        url = "https://ecm.example.com/cs/groups/doc/80012345.pdf"
+        self.assertRaises(IOError, idem.fetch_into_store, "80012345", url, session=FailingSession())
+        self.assertEqual([x for x in os.listdir(self.directory) if x.endswith(".part")], [])
+
+
+class PageFingerprintTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.wait = idem.tea_core.DEFAULT_WAIT
+        idem.tea_core.DEFAULT_WAIT = 0
+        self.facility = idem.Facility(vfc_id="100", directory=self.directory)
+        self.facility.docs.extend(self.facility.docs_from_page(build_page(["102", "101"])))
+        self.saved = []
+        self.facility.save_page = lambda: self.saved.append(self.facility.page)
+
+    def tearDown(self):
+        idem.tea_core.DEFAULT_WAIT = self.wait
+        shutil.rmtree(self.directory)
+
+    def check(self, page):
+        self.facility.retrieve_page_patiently = lambda url: page
+        return self.facility.check_for_new_docs_incrementally()
+
+    def test_volatile_markup_is_ignored(self):
+        page = build_page(["102", "101"])
+        self.assertEqual(idem.get_page_fingerprint(page),
+                         idem.get_page_fingerprint(page.replace("<html>", '<html><input value="token1">')))
+
+    def test_unchanged_page_is_not_parsed_or_saved(self):
+        self.check(build_page(["103", "102"]))
+        self.assertEqual(self.check(build_page(["103", "102"]) + "<!-- 12:00 -->"), [])
+        self.assertEqual(len(self.saved), 1)
+        self.assertTrue(self.facility.page_unchanged)
+
+    def test_changed_page_is_parsed(self):
+        self.check(build_page(["103", "102"]))
+        self.assertEqual([x.id for x in self.check(build_page(["104", "103"]))], ["104"])
+
+    def test_truncated_probe_is_not_saved(self):
+        page = build_page(["103", "102"]).replace("found: 2", "found: 50")
+        self.assertEqual([x.id for x in self.check(page)], ["103"])
+        self.assertEqual(self.saved, [])
+
+
+class PageParserTestCase(unittest.TestCase):
+
+    def test_rows_match_regex_parse(self):
+        page = build_page(["106", "105"])
+        rows = [idem.get_doc_row_data(x) for x in page.split("<tr")[1:] if "xuiListContentCell" in x]
+        self.assertEqual([x.to_rowdata() for x in pageparser.iter_doc_rows(page)], rows)
+
+    def test_new_layout_is_not_old_style(self):
+        self.assertEqual(pageparser.get_old_style_rows(build_page(["1234567"])), [])
+
+    def test_old_style_row(self):
+        row = '<tr><td><a href="/cs/groups/doc/1234567.pdf">x</a></td><td>01/02/2018</td>' \
+              '<td><div nowrap="nowrap">OAQ</div><div nowrap="nowrap">321</div><div nowrap="nowrap">Permit</div></td>'
+        self.assertEqual(pageparser.get_old_style_rows(row),
+                         [("/cs/groups/doc/1234567.pdf", "1234567", "01", "02", "2018", "OAQ", "Permit", "321")])
+
+    def test_facility_row(self):
+        row = "<span class=idemfs>Argle Co</span><span class=idemfs>1 Main St</span><span class=idemfs>Gary</span>" \
+              "<span class=idemfs><a href='?QueryText=xAIID<matches>`12345`'>docs</a></span>"
+        self.assertEqual(idem.get_individual_site_info(row), ("12345", "Argle Co", "1 Main St", "Gary"))
+
+    def test_malformed_page_is_handled(self):
+        page = '<tr><td class="xuiListContentCell"><a href="/cs/1.pdf"><div nowrap="nowrap">' * 20000
+        self.assertEqual(list(pageparser.iter_doc_rows(page))[0].fields, [])
+
+
+class PageCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        open(os.path.join(self.directory, "100_2019-01-02"), "w").write(build_page(["101"]))
+        open(os.path.join(self.directory, "100_2019-01-03"), "w").write(build_page(["102", "101"]))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def get_crawl_dates(self):
+        facility = idem.Facility(vfc_id="100", directory=self.directory)
+        return dict([(x.id, x.crawl_date.isoformat()) for x in facility.docs])
+
+    def test_cached_pages_give_same_docs(self):
+        first = self.get_crawl_dates()
+        self.assertTrue(os.path.exists(os.path.join(self.directory, "100_pages.tsv")))
+        self.assertEqual(self.get_crawl_dates(), first)
+        self.assertEqual(first, {"101": "2019-01-02", "102": "2019-01-03"})
+
+    def test_each_doc_is_cached_once(self):
+        self.get_crawl_dates()
+        lines = open(os.path.join(self.directory, "100_pages.tsv")).read().splitlines()
+        self.assertEqual(len(lines), 2)
+
+    def test_change_to_earlier_page_reaches_later_pages(self):
+        self.get_crawl_dates()
+        open(os.path.join(self.directory, "100_2019-01-02"), "w").write(build_page(["102", "101"]))
+        self.assertEqual(self.get_crawl_dates(), {"101": "2019-01-02", "102": "2019-01-02"})
+
+    def test_changed_page_is_parsed_again(self):
+        self.get_crawl_dates()
+        open(os.path.join(self.directory, "100_2019-01-02"), "w").write(build_page(["101", "100"]))
+        self.assertEqual(self.get_crawl_dates()["100"], "2019-01-02")
+
+
+class ResultPagerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.pager = idem.ResultPager("http://example.com/?q=1", page_size=500)
+
+    def test_page_url_has_row_range(self):
+        url = self.pager.build_page_url(3)
+        self.assertTrue(url.endswith("&PageNumber=3&StartRow=1001&EndRow=1500"))
+
+    def test_page_count_rounds_up(self):
+        self.pager.total = 1001
+        self.assertEqual(self.pager.count_pages(), 3)
+
+    def test_zip_total_read_from_page(self):
+        self.assertEqual(idem.get_zip_total_from_page("Displaying Facilities 1 - 500 of 734"), 734)
+
+    def test_zip_pages_follow_server_page_size(self):
+        pager = idem.ResultPager("http://example.com/?q=1", get_total=idem.get_zip_total_from_page, row_params=False,
+                                 get_page_size=idem.get_zip_page_size_from_page, workers=1)
+        fetched = []
+
+        def fetch_page(number):
+            fetched.append(number)
+            return "Displaying Facilities %d - %d of 450" % ((number - 1) * 200 + 1, min(number * 200, 450))
+        pager.fetch_page = fetch_page
+        self.assertEqual(len(pager.fetch_all()), 3)
+        self.assertEqual(fetched, [1, 2, 3])
+
+
+class RevisitSchedulerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.scheduler = idem.RevisitScheduler(path=os.path.join(self.directory, "schedule.tsv"))
+        self.today = datetime.date(2019, 6, 1)
+        self.busy = self.make_entry("100", rate=0.5, days_ago=3)
+        self.quiet = self.make_entry("200", rate=0.001, days_ago=3)
+        self.unseen = self.make_entry("300", rate=0.001, days_ago=None)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_entry(self, vfc_id, rate, days_ago):
+        entry = idem.ScheduleEntry()
+        entry.vfc_id = vfc_id
+        entry.zip = "46312"
+        entry.rate = rate
+        if days_ago is not None:
+            entry.last_check = self.today - datetime.timedelta(days_ago)
+        self.scheduler.entries[vfc_id] = entry
+        return entry
+
+    def test_busy_facility_is_due_before_quiet_one(self):
+        self.assertTrue(self.busy.is_due(self.today))
+        self.assertFalse(self.quiet.is_due(self.today))
+
+    def test_pick_without_budget_takes_only_due(self):
+        chosen = self.scheduler.pick(today=self.today)
+        self.assertEqual(chosen["46312"], set(["100", "300"]))
+
+    def test_pick_respects_budget(self):
+        chosen = self.scheduler.pick(budget=1, today=self.today)
+        self.assertEqual(chosen["46312"], set(["300"]))
+
+    def test_schedule_survives_reload(self):
+        self.scheduler.save()
+        reloaded = idem.RevisitScheduler(path=self.scheduler.path)
+        self.assertEqual(reloaded.entries["100"].last_check, self.busy.last_check)
+        self.assertAlmostEqual(reloaded.entries["100"].rate, 0.5)
+
+    def test_change_rate_counts_distinct_dates(self):
+        docs = [idem.Document(id=str(x), crawl_date=datetime.date(2019, 5, 1)) for x in range(10)]
+        one_day = idem.estimate_change_rate(docs, today=self.today)
+        docs.append(idem.Document(id="11", crawl_date=datetime.date(2019, 5, 2)))
+        two_days = idem.estimate_change_rate(docs, today=self.today)
+        self.assertLess(one_day, two_days)
+
+
+class CrawlPlannerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.scheduler = idem.RevisitScheduler(path=os.path.join(self.directory, "schedule.tsv"))
+        self.costs = idem.CostModel(path=os.path.join(self.directory, "costs.tsv"))
+        for vfc_id, zipcode, requests in [("100", "46312", 1), ("200", "46312", 4), ("300", "46320", 1)]:
+            entry = idem.ScheduleEntry()
+            entry.vfc_id = vfc_id
+            entry.zip = zipcode
+            self.scheduler.entries[vfc_id] = entry
+            cost = self.costs.get_entry(vfc_id)
+            cost.visits = 1
+            cost.requests = requests
+            cost.seconds = 10.0 * requests
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_plan(self, **limits):
+        planner = idem.CrawlPlanner(scheduler=self.scheduler, costs=self.costs, **limits)
+        return planner.plan(zips=["46320", "46312"])
+
+    def test_unlimited_plan_takes_everything_due(self):
+        plan = self.make_plan()
+        self.assertEqual(plan.zips, ["46320", "46312"])
+        self.assertFalse(plan.deferred)
+
+    def test_request_budget_defers_expensive_facility(self):
+        plan = self.make_plan(max_requests=3)
+        self.assertEqual([x[0] for x in plan.deferred], ["200"])
+        self.assertEqual(plan.estimated_requests, 2)
+
+    def test_time_budget_is_honored(self):
+        plan = self.make_plan(max_seconds=15)
+        self.assertEqual(plan.estimated_seconds, 10.0)
+
+    def test_shards_balance_observed_time(self):
+        shards = idem.split_into_shards(["46312", "46320", "46394"], 2, costs=self.costs, scheduler=self.scheduler)
+        self.assertEqual(shards, [["46312"], ["46320", "46394"]])
+
+    def test_costs_survive_reload(self):
+        self.costs.save()
+        reloaded = idem.CostModel(path=self.costs.path)
+        self.assertEqual(reloaded.estimate("200"), (4.0, 40.0))
+
+    def test_new_facility_is_scheduled_and_admitted(self):
+        plan = self.make_plan(max_requests=10)
+        facilities = [idem.Facility(vfc_id=x, zip="46312", lazy=True) for x in ["100", "400"]]
+        added = self.scheduler.add_new(facilities)
+        self.assertEqual([x.vfc_id for x in added], ["400"])
+        self.assertTrue(self.scheduler.entries["400"].is_due(datetime.date(2019, 6, 1)))
+        self.assertFalse(plan.allows("46312", "400"))
+        self.assertTrue(plan.admit("46312", "400"))
+        self.assertTrue(plan.allows("46312", "400"))
+
+    def test_plan_counts_requests_against_given_costs(self):
+        plan = self.make_plan(max_requests=2)
+        self.assertTrue(plan.has_room())
+        self.costs.record_request(100)
+        self.costs.record_request(100)
+        self.assertFalse(plan.has_room())
+
+    def test_request_time_is_recorded(self):
+        self.costs.start("100")
+        self.costs.record_request(100, 1.5)
+        self.costs.stop()
+        self.costs.save()
+        reloaded = idem.CostModel(path=self.costs.path)
+        self.assertEqual(reloaded.get_entry("100").request_seconds, 1.5)
+
+
+class MergeShardsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.saved = (idem.maindir, idem.latlong_filepath, idem.latest_json_path, idem.idem_settings.maindir,
+                      idem.idem_settings.websitedir, idem._scheduler, idem._cost_model)
+        websitedir = os.path.join(self.directory, "web")
+        os.mkdir(websitedir)
+        idem.maindir = idem.idem_settings.maindir = self.directory
+        idem.idem_settings.websitedir = websitedir
+        idem.latlong_filepath = os.path.join(self.directory, "facilitydump.txt")
+        idem.latest_json_path = os.path.join(websitedir, "latest_vfc.json")
+        idem._scheduler = idem.RevisitScheduler(path=os.path.join(self.directory, "schedule.tsv"))
+        idem._cost_model = idem.CostModel(path=os.path.join(self.directory, "costs.tsv"))
+        idem._scheduler.entries["400"] = self.make_entry("400", "46394", 0.5)
+
+    def tearDown(self):
+        (idem.maindir, idem.latlong_filepath, idem.latest_json_path, idem.idem_settings.maindir,
+         idem.idem_settings.websitedir, idem._scheduler, idem._cost_model) = self.saved
+        shutil.rmtree(self.directory)
+
+    @staticmethod
+    def make_entry(vfc_id, zipcode, rate):
+        entry = idem.ScheduleEntry()
+        entry.vfc_id = vfc_id
+        entry.zip = zipcode
+        entry.rate = rate
+        return entry
+
+    def make_shard(self, name, facilities, visits=None):
+        directory = os.path.join(self.directory, name)
+        os.mkdir(directory)
+        scheduler = idem.RevisitScheduler(path=os.path.join(directory, "schedule.tsv"))
+        collection = idem.FacilityCollection()
+        for vfc_id, zipcode, vfc_name in facilities:
+            facility = idem.Facility(vfc_id=vfc_id, zip=zipcode, vfc_name=vfc_name, lazy=True)
+            facility.latlong = (41.5, -87.4)
+            collection.append(facility)
+            scheduler.entries[vfc_id] = self.make_entry(vfc_id, zipcode, 0.1)
+        scheduler.save()
+        costs = idem.CostModel(path=os.path.join(directory, "costs.tsv"))
+        for key, count in (visits or {}).items():
+            costs.get_entry(key).visits = count
+        costs.save()
+        open(os.path.join(directory, "facilities.tsv"), "w").write(collection.to_tsv())
+        open(os.path.join(directory, "facilitydump.txt"), "w").write(
+            "".join(["%s\t%s\t41.5\t-87.4\t\n" % (x[0], x[2]) for x in facilities]))
+        features = [idem.geojson.Feature(id=x[0], properties={"name": x[2]}) for x in facilities]
+        idem.write_usable_json(idem.geojson.FeatureCollection(features), os.path.join(directory, "idem.json"))
+        return directory
+
+    def test_shards_merge_with_conflicts_and_a_missing_shard(self):
+        first = self.make_shard("0", [("100", "46312", "Argle"), ("300", "46312", "Old")])
+        second = self.make_shard("1", [("200", "46320", "Bargle"), ("300", "46320", "New")])
+        missing = os.path.join(self.directory, "2")
+        os.mkdir(missing)
+        idem.merge_shards([(first, ["46312"]), (second, ["46320"]), (missing, ["46394"])])
+        path = os.path.join(self.directory, "facilities_%s.tsv" % datetime.date.today().isoformat())
+        merged = [idem.Facility(tsv=x, lazy=True) for x in open(path).read().split("\n")[1:] if x.strip()]
+        self.assertEqual(sorted([(x.vfc_id, x.vfc_name) for x in merged]),
+                         [("100", "Argle"), ("200", "Bargle"), ("300", "New")])
+        schedule = idem.RevisitScheduler(path=os.path.join(self.directory, "schedule.tsv"))
+        self.assertEqual(sorted([(x, y.zip) for x, y in schedule.entries.items()]),
+                         [("100", "46312"), ("200", "46320"), ("300", "46320"), ("400", "46394")])
+        self.assertEqual(schedule.entries["400"].rate, 0.5)
+        jsontext = open(idem.latest_json_path).read().split(" = ", 1)[1]
+        self.assertEqual(sorted([x.id for x in idem.geojson.loads(jsontext).features]), ["100", "200", "300"])
+
+    def test_shards_merge_only_their_own_costs(self):
+        first = self.make_shard("0", [("100", "46312", "Argle")], visits={"100": 6, "200": 1, "zip_46312": 2})
+        second = self.make_shard("1", [("200", "46320", "Bargle")], visits={"100": 1, "200": 4, "zip_46312": 1})
+        idem.merge_shards([(first, ["46312"]), (second, ["46320"])])
+        costs = idem.CostModel(path=os.path.join(self.directory, "costs.tsv"))
+        self.assertEqual([costs.entries[x].visits for x in ["100", "200", "zip_46312"]], [6, 4, 2])
+
+
+class RefreshTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.facility = idem.Facility(vfc_id="100", vfc_name="Argle", directory=self.directory)
+        self.facility.latlong = (41.6, -87.4)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_unscheduled_facility_is_found_in_zip_data(self):
+        maindir = idem.maindir
+        idem.maindir = self.directory
+        try:
+            updater = idem.ZipUpdater("46312", load_facilities=False)
+            updater.facilities.append(idem.Facility(vfc_id="100", parent=updater, vfc_name="Argle"))
+            updater.save_tsv()
+            found = idem.find_facility("100", zips=["46320", "46312"])
+            self.assertEqual((found.vfc_id, found.zip, found._docs), ("100", "46312", None))
+            self.assertEqual(idem.find_facility("200", zips=["46312"]), None)
+        finally:
+            idem.maindir = maindir
+
+    def test_location_dump_patches_only_given_facility(self):
+        path = os.path.join(self.directory, "facilitydump.txt")
+        open(path, "w").write("100\tOld\t\t\t\n200\tBargle\t41.5\t-87.3\t\n")
+        idem.patch_location_dump([self.facility], filepath=path)
+        lines = open(path).read().split("\n")
+        self.assertEqual(lines[0], "100\tArgle\t41.6\t-87.4\t")
+        self.assertEqual(lines[1], "200\tBargle\t41.5\t-87.3\t")
+
+    def test_inactive_facility_is_dropped_from_layer(self):
+        path = os.path.join(self.directory, "latest.json")
+        features = [idem.geojson.Feature(id=x, properties={}) for x in ["100", "200"]]
+        idem.write_usable_json(idem.geojson.FeatureCollection(features), path)
+        idem.patch_json_features([self.facility], datetime.date(2019, 1, 1), filepath=path)
+        jsontext = open(path).read().split(" = ", 1)[1]
+        self.assertEqual([x["id"] for x in idem.geojson.loads(jsontext).features], ["200"])
+
+
+class ManifestTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.facility = idem.Facility(vfc_id="100", directory=os.path.join(self.directory, "100"))
+        self.facility.last_check = datetime.date(2019, 1, 5)
+        self.facility.page = build_page(["102", "101"])
+        self.facility.docs.extend(self.facility.docs_from_page(self.facility.page))
+        idem.get_manifest(self.directory).record(self.facility)
+        idem.save_manifests()
+
+    def tearDown(self):
+        idem._manifests.clear()
+        shutil.rmtree(self.directory)
+
+    def test_metadata_read_from_manifest(self):
+        self.assertEqual(idem.get_latest_total(self.facility.directory), 2)
+        self.assertEqual(idem.get_last_scan_date(self.facility.directory), datetime.date(2019, 1, 5))
+
+    def test_manifest_survives_reload(self):
+        entry = idem.Manifest(self.directory).get("100")
+        self.assertEqual(entry.last_new_file, datetime.date(2019, 1, 2))
+        self.assertEqual(entry.downloaded, 0)
+
+    def test_records_are_saved_together(self):
+        other = idem.Facility(vfc_id="200", directory=os.path.join(self.directory, "200"))
+        other.last_check = datetime.date(2019, 1, 6)
+        idem.get_manifest(self.directory).record(other)
+        self.assertEqual(idem.Manifest(self.directory).get("200"), None)
+        idem.save_manifests()
+        self.assertEqual(idem.Manifest(self.directory).get("200").last_check, datetime.date(2019, 1, 6))
+
+    def test_premature_stop_detected_from_manifest(self):
+        self.assertTrue(idem.scan_for_premature_stops(self.facility.directory))
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
@@ -0,0 +1,298 @@
+import datetime
+import fcntl
+import os
+import shutil
+import tempfile
+import tea_core
+import unittest
+
+
+class BlobStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = tea_core.BlobStore(os.path.join(self.directory, "blobs"))
+        self.path1 = self.write_file("first.pdf", "argle")
+        self.path2 = self.write_file("second.pdf", "argle")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_file(self, filename, content):
+        path = os.path.join(self.directory, filename)
+        open(path, "w").write(content)
+        return path
+
+    def test_identical_files_share_digest(self):
+        digest1 = self.store.put_file(self.path1)
+        digest2 = self.store.put_file(self.path2)
+        self.assertEqual(digest1, digest2)
+        self.assertFalse(os.path.exists(self.path2))
+
+    def test_unknown_key_is_not_linked(self):
+        self.assertFalse(self.store.link_key("101", self.path1 + ".copy"))
+
+    def test_registered_key_is_linked(self):
+        digest = self.store.put_file(self.path1)
+        self.store.register("101", digest)
+        self.assertTrue(self.store.link_key("101", self.path1))
+        self.assertEqual(open(self.path1).read(), "argle")
+
+    def test_index_survives_reload(self):
+        digest = self.store.put_file(self.path1)
+        self.store.register("101", digest)
+        reloaded = tea_core.BlobStore(self.store.directory)
+        self.assertEqual(reloaded.lookup("101"), digest)
+
+    def test_absorb_replaces_file_with_link(self):
+        self.assertTrue(self.store.absorb(self.path1, key="101"))
+        self.assertTrue(self.store.absorb(self.path2, key="102"))
+        self.assertEqual(os.stat(self.path1).st_ino, os.stat(self.path2).st_ino)
+        self.assertFalse(self.store.absorb(self.path1, key="101"))
+        self.assertEqual(self.store.lookup("101"), tea_core.hash_file(self.path1))
+
+
+class SnapshotStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = tea_core.SnapshotStore(os.path.join(self.directory, "snapshots"))
+        self.saved_store = tea_core._snapshot_store
+        tea_core._snapshot_store = self.store
+        self.path1 = os.path.join(self.directory, "46312_2019-01-01.html")
+        self.path2 = os.path.join(self.directory, "46312_2019-01-02.html")
+
+    def tearDown(self):
+        tea_core._snapshot_store = self.saved_store
+        shutil.rmtree(self.directory)
+
+    def test_unchanged_page_is_stored_once(self):
+        digest1 = self.store.save("argle", self.path1)
+        digest2 = self.store.save("argle", self.path2)
+        self.assertEqual(digest1, digest2)
+        self.assertEqual(os.stat(self.path1).st_ino, os.stat(self.path2).st_ino)
+
+    def test_index_survives_reload(self):
+        self.store.save("argle", self.path1)
+        self.store.save("bargle", self.path2)
+        reloaded = tea_core.SnapshotStore(self.store.directory)
+        source = os.path.join(self.directory, "46312_*.html")
+        self.assertEqual(reloaded.get_dates(source), ["2019-01-01", "2019-01-02"])
+        self.assertEqual(open(reloaded.get_path(source, "2019-01-02")).read(), "bargle")
+
+    def test_prune_is_kept_out_while_saving(self):
+        with self.store.lock():
+            handle = open(self.store.lock_path)
+            self.assertRaises(IOError, fcntl.flock, handle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            handle.close()
+
+    def test_lookups_read_only_their_directory(self):
+        other = os.path.join(self.directory, "46320")
+        os.mkdir(other)
+        self.store.save("argle", self.path1)
+        self.store.save("bargle", os.path.join(other, "46320_2019-01-01.html"))
+        reloaded = tea_core.SnapshotStore(self.store.directory)
+        self.assertEqual(reloaded.get_dates(os.path.join(other, "46320_*.html")), ["2019-01-01"])
+        self.assertEqual(reloaded.sources.keys(), [os.path.join(other, "46320_*.html")])
+
+    def test_previous_file_found_through_index(self):
+        tea_core.save_snapshot("argle", self.path1)
+        tea_core.save_snapshot("bargle", self.path2)
+        os.remove(self.path1)
+        previous = tea_core.get_previous_file_in_directory(self.directory, reference_date="2019-01-02")
+        self.assertEqual(open(previous).read(), "argle")
+
+
+class PackFileTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for name, content in [("100_2019-01-01", "argle"), ("100_2019-01-02", "argle"), ("100_2019-01-03", "bargle")]:
+            open(os.path.join(self.directory, name), "w").write(content)
+        self.names = ["100_2019-01-01", "100_2019-01-02", "100_2019-01-03"]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_packed_pages_read_back(self):
+        tea_core.pack_directory(self.directory, self.names, "100_pages.pack")
+        pack = tea_core.PackFile(os.path.join(self.directory, "100_pages.pack"))
+        self.assertEqual(pack.read("100_2019-01-03"), "bargle")
+        self.assertEqual(pack.entries["100_2019-01-01"][:2], pack.entries["100_2019-01-02"][:2])
+
+    def test_snapshot_reads_packed_pages(self):
+        tea_core.pack_directory(self.directory, self.names, "100_pages.pack")
+        self.assertFalse(os.path.exists(os.path.join(self.directory, "100_2019-01-01")))
+        snapshot = tea_core.DirectorySnapshot(self.directory, prefix="100")
+        self.assertEqual(snapshot.latest_log_page(), "100_2019-01-03")
+        self.assertEqual(snapshot.read("100_2019-01-01"), "argle")
+
+    def test_rewrite_switches_data_file(self):
+        tea_core.pack_directory(self.directory, self.names, "100_pages.pack")
+        path = os.path.join(self.directory, "100_pages.pack")
+        open(path + ".1", "w").write("left by a crashed rewrite")
+        pack = tea_core.PackFile(path)
+        self.assertEqual(pack.read("100_2019-01-01"), "argle")
+        pack.rewrite(["100_2019-01-03"])
+        self.assertEqual(sorted(os.listdir(self.directory)), ["100_pages.pack.2", "100_pages.pack.idx"])
+        reloaded = tea_core.PackFile(path)
+        self.assertEqual(sorted(reloaded.entries.keys()), ["100_2019-01-03"])
+        self.assertEqual(reloaded.read("100_2019-01-03"), "bargle")
+        snapshot = tea_core.DirectorySnapshot(self.directory, prefix="100")
+        self.assertEqual(snapshot.read("100_2019-01-03"), "bargle")
+
+    def test_torn_record_is_ignored(self):
+        tea_core.pack_directory(self.directory, self.names[:1], "100_pages.pack")
+        path = os.path.join(self.directory, "100_pages.pack")
+        open(path + ".idx", "a").write("100_2019-01-04\t%d\t50\tabc\n" % os.path.getsize(path))
+        self.assertEqual(sorted(tea_core.PackFile(path).entries.keys()), ["100_2019-01-01"])
+
+
+class BloomFilterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.bloom = tea_core.BloomFilter(capacity=1000)
+        for number in range(1000):
+            self.bloom.add(str(number))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_no_false_negatives(self):
+        self.assertTrue(all(str(x) in self.bloom for x in range(1000)))
+
+    def test_false_positives_are_rare(self):
+        false_positives = len([1 for x in range(1000, 11000) if str(x) in self.bloom])
+        self.assertTrue(false_positives < 300)
+
+    def test_filter_survives_reload(self):
+        path = os.path.join(self.directory, "ids.bloom")
+        self.bloom.save(path, label="1000")
+        reloaded, label = tea_core.BloomFilter.load(path)
+        self.assertEqual(label, "1000")
+        self.assertEqual(reloaded.bits, self.bloom.bits)
+        self.assertEqual(tea_core.BloomFilter.load(path + ".missing"), (None, None))
+
+
+class LocalDirectoryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        open(os.path.join(self.root, "index.html"), "w").write("<html></html>")
+        open(os.path.join(self.root, "timestamp.js"), "w").write("var timestamp = '1/2/2019';")
+        for name, (lat, lon) in [("gary", (41.6, -87.3)), ("elsewhere", (39.8, -86.2))]:
+            os.mkdir(os.path.join(self.root, name))
+            corners = [(lat - 0.1, lon - 0.1), (lat - 0.1, lon + 0.1), (lat + 0.1, lon + 0.1), (lat + 0.1, lon - 0.1)]
+            coords = ", ".join(["[%f, %f]" % x for x in corners])
+            open(os.path.join(self.root, name, "polygon.js"), "w").write("var coords = [%s];\n" % coords)
+        self.jsonpath = os.path.join(self.root, "latest_vfc.json")
+        feature = '{"type": "Feature", "geometry": {"type": "Point", "coordinates": [-87.3, 41.6]}, "properties": {}}'
+        open(self.jsonpath, "w").write('var vfc = {"type": "FeatureCollection", "features": [%s]}' % feature)
+        self.get_json_paths = tea_core.get_json_paths
+        tea_core.get_json_paths = lambda: [self.jsonpath]
+
+    def tearDown(self):
+        tea_core.get_json_paths = self.get_json_paths
+        shutil.rmtree(self.root)
+
+    def test_only_localities_with_points_are_updated(self):
+        updated = tea_core.update_local_directories_containing([(41.61, -87.31)], root=self.root)
+        self.assertEqual(updated, [os.path.join(self.root, "gary")])
+        self.assertTrue(os.path.exists(os.path.join(self.root, "gary", "latest_vfc.json")))
+        self.assertFalse(os.path.exists(os.path.join(self.root, "elsewhere", "latest_vfc.json")))
+
+
+class FakeResponse(object):
+
+    def __init__(self, content, encoding, apparent_encoding=None):
+        self.content = content
+        self.encoding = encoding
+        self.apparent_encoding = apparent_encoding
+
+
+class ResponseBytesTestCase(unittest.TestCase):
+
+    def test_ascii_is_passed_through(self):
+        content = "<html>argle</html>"
+        self.assertTrue(tea_core.get_response_bytes(FakeResponse(content, "ISO-8859-1")) is content)
+
+    def test_utf8_is_passed_through(self):
+        content = u"<html>caf\xe9</html>".encode("utf-8")
+        self.assertTrue(tea_core.get_response_bytes(FakeResponse(content, "utf-8")) is content)
+
+    def test_other_encodings_become_utf8(self):
+        content = u"<html>caf\xe9</html>".encode("latin-1")
+        result = tea_core.get_response_bytes(FakeResponse(content, "ISO-8859-1"))
+        self.assertEqual(result, u"<html>caf\xe9</html>".encode("utf-8"))
+
+    def test_unknown_encoding_falls_back(self):
+        content = u"<html>caf\xe9</html>".encode("latin-1")
+        result = tea_core.get_response_bytes(FakeResponse(content, "x-bogus", "ISO-8859-1"))
+        self.assertEqual(result, u"<html>caf\xe9</html>".encode("utf-8"))
+        self.assertTrue(tea_core.get_response_bytes(FakeResponse(content, "x-bogus")) is content)
+
+
+class JournalTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "journal.tsv")
+        self.journal = tea_core.Journal(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_records_survive_reload(self):
+        self.journal.record("facility", "100", "2019-01-01")
+        reloaded = tea_core.Journal(self.path)
+        self.assertTrue(reloaded.is_done("facility", "100"))
+        self.assertEqual(reloaded.get("facility", "100"), "2019-01-01")
+
+    def test_partial_line_is_ignored(self):
+        self.journal.record("zip", "46312")
+        open(self.path, "a").write("2019-01-01T00:00:00\tzip\t463")
+        reloaded = tea_core.Journal(self.path)
+        self.assertEqual(len(reloaded), 1)
+
+    def test_journal_from_another_day_is_set_aside(self):
+        journal = tea_core.Journal(self.path, run_date=datetime.date(2019, 1, 1))
+        journal.record("zip", "46312")
+        self.assertEqual(len(tea_core.Journal(self.path, run_date=datetime.date(2019, 1, 1))), 1)
+        self.assertEqual(len(tea_core.Journal(self.path, run_date=datetime.date(2019, 1, 2))), 0)
+        self.assertTrue(os.path.exists(self.path + ".last"))
+
+    def test_finish_starts_fresh(self):
+        self.journal.record("zip", "46312")
+        self.journal.finish()
+        self.assertEqual(len(tea_core.Journal(self.path)), 0)
+        self.assertTrue(os.path.exists(self.path + ".last"))
+
+
+class DirectorySnapshotTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for filename in ["100_2019-01-02", "100_2019-01-05", "100.tsv", "2019-01-03_101.pdf"]:
+            open(os.path.join(self.directory, filename), "w").write("argle")
+        self.snapshot = tea_core.DirectorySnapshot(self.directory, prefix="100")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_entries_are_classified(self):
+        self.assertEqual(self.snapshot.log_pages, set(["100_2019-01-02", "100_2019-01-05"]))
+        self.assertEqual(self.snapshot.pdfs, set(["2019-01-03_101.pdf"]))
+        self.assertEqual(self.snapshot.tsvs, set(["100.tsv"]))
+
+    def test_added_page_becomes_latest(self):
+        self.snapshot.add("100_2019-02-01")
+        self.assertEqual(self.snapshot.latest_log_page(), "100_2019-02-01")
+        self.assertEqual(self.snapshot.latest_date(self.snapshot.names), "2019-02-01")
+
+    def test_missing_directory_is_empty(self):
+        self.assertEqual(tea_core.DirectorySnapshot("").names, set())
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,108 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+import workqueue
+
+
+def record_task(task):
+    handle = open(os.path.join(os.path.dirname(task.owner), task.key), "a")
+    with handle:
+        handle.write(task.owner + "\n")
+    return task.key
+
+
+def fail_task(task):
+    raise ValueError("argle")
+
+
+def work(arguments):
+    path, owner = arguments
+    return workqueue.run_worker(path, record_task, owner=owner)
+
+
+class WorkQueueTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "queue.sqlite")
+        self.queue = workqueue.WorkQueue(self.path, lease_seconds=60)
+        self.queue.add_many("zip", ["46312", "46320", "46394"])
+
+    def tearDown(self):
+        self.queue.close()
+        shutil.rmtree(self.directory)
+
+    def test_claimed_task_is_not_reclaimed(self):
+        first = self.queue.claim("a")
+        second = self.queue.claim("b")
+        self.assertNotEqual(first.key, second.key)
+
+    def test_expired_lease_is_reclaimed(self):
+        self.queue.lease_seconds = -1
+        first = self.queue.claim("a", kind="zip")
+        self.queue.lease_seconds = 60
+        keys = [self.queue.claim("b").key for x in range(3)]
+        self.assertTrue(first.key in keys)
+        self.assertFalse(self.queue.heartbeat(first))
+
+    def test_complete_is_idempotent(self):
+        task = self.queue.claim("a")
+        self.assertTrue(self.queue.complete(task))
+        self.assertFalse(self.queue.complete(task))
+        self.assertEqual(self.queue.counts()["done"], 1)
+
+    def test_lapsed_worker_cannot_complete_reassigned_task(self):
+        self.queue.add("page", "100")
+        self.queue.lease_seconds = -1
+        first = self.queue.claim("a", kind="page")
+        self.queue.lease_seconds = 60
+        second = self.queue.claim("b", kind="page")
+        self.assertEqual(second.key, first.key)
+        self.assertFalse(self.queue.complete(first))
+        self.assertTrue(self.queue.complete(second))
+        self.assertEqual(self.queue.completed_by("page"), {"b": ["100"]})
+
+    def test_failing_task_is_given_up(self):
+        completed = workqueue.run_worker(self.path, fail_task, owner="a", max_attempts=2)
+        self.assertEqual(completed, [])
+        self.assertEqual(self.queue.counts(), {"failed": 3})
+        self.queue.reset("zip", "46312")
+        self.assertEqual(self.queue.claim("b").key, "46312")
+
+    def test_lapsed_lease_is_failed_after_max_attempts(self):
+        self.queue.max_attempts = 1
+        self.queue.lease_seconds = -1
+        self.queue.claim("a", kind="zip")
+        self.queue.lease_seconds = 60
+        keys = [self.queue.claim("b").key for x in range(2)]
+        self.assertEqual(self.queue.claim("b"), None)
+        self.assertEqual(self.queue.counts(), {"leased": 2, "failed": 1})
+        self.assertEqual(len(set(keys)), 2)
+
+    def test_heartbeat_flags_lost_lease(self):
+        task = self.queue.claim("a")
+        self.queue.reset(task.kind, task.key)
+        heartbeat = workqueue.Heartbeat(self.path, task, lease_seconds=0.3)
+        heartbeat.start()
+        heartbeat.join(5)
+        self.assertTrue(task.lease_lost())
+
+    def test_processes_share_queue(self):
+        self.queue.add_many("zip", [str(x) for x in range(47000, 47030)])
+        owners = [os.path.join(self.directory, "worker%d" % x) for x in range(4)]
+        pool = multiprocessing.Pool(len(owners))
+        try:
+            results = pool.map(work, [(self.path, owner) for owner in owners])
+        finally:
+            pool.close()
+            pool.join()
+        completed = sum(results, [])
+        self.assertEqual(len(completed), 33)
+        self.assertEqual(len(set(completed)), 33)
+        self.assertEqual(self.queue.counts(), {"done": 33})
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,255 @@
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+# Shared queue of crawl tasks (e.g. ZIPs) for several crawler processes or hosts. Tasks are claimed under a lease that
+# the worker renews with heartbeats; a task whose lease lapses (crashed worker) is handed to the next claimant.
+# A task that has been claimed max_attempts times without completing is marked failed and no longer handed out.
+# SQLite locking needs a filesystem with working POSIX locks, which rules out some network mounts.
+
+DEFAULT_LEASE = 600  # seconds
+DEFAULT_MAX_ATTEMPTS = 3
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+schema = """
+CREATE TABLE IF NOT EXISTS tasks (
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    state TEXT NOT NULL DEFAULT 'pending',
+    owner TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    completed REAL,
+    result TEXT,
+    PRIMARY KEY (kind, key)
+);
+CREATE INDEX IF NOT EXISTS tasks_by_state ON tasks (state, priority, lease_expires);
+"""
+
+
+class Task:
+
+    def __init__(self, kind, key, owner, attempts=0):
+        self.kind = kind
+        self.key = key
+        self.owner = owner
+        self.attempts = attempts
+        self.lost = threading.Event()  # set by Heartbeat once another worker has taken the task over
+
+    def lease_lost(self):
+        return self.lost.is_set()
+
+    def __repr__(self):
+        return "Task(%s, %s)" % (self.kind, self.key)
+
+
+class WorkQueue:
+
+    def __init__(self, path, lease_seconds=DEFAULT_LEASE, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.connection.executescript(schema)
+
+    def add(self, kind, key, priority=0):
+        """
+        Queue a task; re-adding a task that is already queued, leased or done has no effect.
+        """
+        self.connection.execute("INSERT OR IGNORE INTO tasks (kind, key, priority) VALUES (?, ?, ?)",
+                                (kind, key, priority))
+
+    def add_many(self, kind, keys, priority=0):
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            for key in keys:
+                self.add(kind, key, priority)
+        except Exception:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
+
+    def reset(self, kind, key, priority=None):
+        """
+        Make a task (done, failed or not) available to be claimed again, e.g. to force a refresh.
+        """
+        self.add(kind, key, priority or 0)
+        if priority is None:
+            self.connection.execute("UPDATE tasks SET state = ?, owner = NULL, lease_expires = NULL, attempts = 0 "
+                                    "WHERE kind = ? AND key = ?", (PENDING, kind, key))
+        else:
+            self.connection.execute("UPDATE tasks SET state = ?, owner = NULL, lease_expires = NULL, attempts = 0, "
+                                    "priority = ? WHERE kind = ? AND key = ?", (PENDING, priority, kind, key))
+
+    def claim(self, owner, kind=None):
+        """
+        Lease the highest-priority available task to owner, or return None if there is nothing to do.
+        :param owner: str
+        :param kind: str (optional restriction)
+        :return: Task
+        """
+        now = time.time()
+        query = "SELECT kind, key, attempts FROM tasks " \
+                "WHERE (state = ? OR (state = ? AND lease_expires < ?)) AND attempts < ?"
+        parameters = [PENDING, LEASED, now, self.max_attempts]
+        if kind is not None:
+            query += " AND kind = ?"
+            parameters.append(kind)
+        query += " ORDER BY priority DESC, attempts, key LIMIT 1"
+        self.connection.execute("BEGIN IMMEDIATE")  # take the write lock before reading, so no one else claims it
+        try:
+            # workers keep dying on these, so stop handing them out
+            self.connection.execute("UPDATE tasks SET state = ?, owner = NULL, lease_expires = NULL "
+                                    "WHERE state = ? AND lease_expires < ? AND attempts >= ?",
+                                    (FAILED, LEASED, now, self.max_attempts))
+            row = self.connection.execute(query, parameters).fetchone()
+            if row is None:
+                self.connection.execute("COMMIT")
+                return None
+            task_kind, key, attempts = row
+            self.connection.execute("UPDATE tasks SET state = ?, owner = ?, lease_expires = ?, attempts = ? "
+                                    "WHERE kind = ? AND key = ?",
+                                    (LEASED, owner, now + self.lease_seconds, attempts + 1, task_kind, key))
+        except Exception:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
+        return Task(task_kind, key, owner, attempts + 1)
+
+    def heartbeat(self, task):
+        """
+        Extend the lease on a task; returns False if the lease has been lost to another worker.
+        """
+        cursor = self.connection.execute("UPDATE tasks SET lease_expires = ? "
+                                         "WHERE kind = ? AND key = ? AND owner = ? AND state = ?",
+                                         (time.time() + self.lease_seconds, task.kind, task.key, task.owner, LEASED))
+        return cursor.rowcount == 1
+
+    def complete(self, task, result=""):
+        """
+        Mark task done, if it is still leased to the task's owner. Completing a task that is already done, or that
+        was handed to another worker after this one's lease lapsed, changes nothing and returns False.
+        :return: bool (whether the task was marked done)
+        """
+        cursor = self.connection.execute("UPDATE tasks SET state = ?, completed = ?, result = ?, lease_expires = NULL "
+                                         "WHERE kind = ? AND key = ? AND owner = ? AND state = ?",
+                                         (DONE, time.time(), str(result), task.kind, task.key, task.owner, LEASED))
+        return cursor.rowcount == 1
+
+    def release(self, task):
+        """
+        Give a task back without completing it, e.g. after an error.
+        """
+        self.connection.execute("UPDATE tasks SET state = ?, owner = NULL, lease_expires = NULL "
+                                "WHERE kind = ? AND key = ? AND owner = ? AND state = ?",
+                                (PENDING, task.kind, task.key, task.owner, LEASED))
+
+    def fail(self, task, error=""):
+        """
+        Give a task back after an error; once it has used up max_attempts it is marked failed instead.
+        :return: bool (whether the task is now failed for good)
+        """
+        state = FAILED if task.attempts >= self.max_attempts else PENDING
+        self.connection.execute("UPDATE tasks SET state = ?, owner = NULL, lease_expires = NULL, result = ? "
+                                "WHERE kind = ? AND key = ? AND owner = ? AND state = ?",
+                                (state, str(error), task.kind, task.key, task.owner, LEASED))
+        return state == FAILED
+
+    def counts(self):
+        rows = self.connection.execute("SELECT state, COUNT(*) FROM tasks GROUP BY state").fetchall()
+        return dict(rows)
+
+    def completed_by(self, kind=None):
+        """
+        :return: dict of owner -> list of keys completed by that owner
+        """
+        query = "SELECT owner, key FROM tasks WHERE state = ?"
+        parameters = [DONE]
+        if kind is not None:
+            query += " AND kind = ?"
+            parameters.append(kind)
+        done = {}
+        for owner, key in self.connection.execute(query, parameters):
+            done.setdefault(owner, []).append(key)
+        return done
+
+    def close(self):
+        self.connection.close()
+
+
+class Heartbeat(threading.Thread):
+    """
+    Keep renewing a task's lease in the background while the worker is busy with it.
+    """
+
+    def __init__(self, path, task, lease_seconds=DEFAULT_LEASE):
+        super(Heartbeat, self).__init__()
+        self.daemon = True
+        self.path = path
+        self.task = task
+        self.lease_seconds = lease_seconds
+        self.stopped = threading.Event()
+        self.lost = False
+
+    def run(self):
+        queue = WorkQueue(self.path, lease_seconds=self.lease_seconds)  # connections can't cross threads
+        interval = self.lease_seconds / 3.0
+        while not self.stopped.wait(interval):
+            if not queue.heartbeat(self.task):
+                self.lost = True
+                self.task.lost.set()
+                break
+        queue.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def get_worker_name():
+    return "%s-%d" % (socket.gethostname(), os.getpid())
+
+
+def run_worker(path, handler, kind=None, owner=None, lease_seconds=DEFAULT_LEASE, max_tasks=None,
+               max_attempts=DEFAULT_MAX_ATTEMPTS):
+    """
+    Claim and process tasks until the queue has none left (or max_tasks is reached).
+    :param path: path of queue file
+    :param handler: function taking a Task and returning a result string; a long-running handler should stop early
+    once task.lease_lost() is true, as the task has been handed to another worker
+    :param kind: str (optional restriction)
+    :param owner: str (defaults to host and process id)
+    :return: list of keys completed
+    """
+    if owner is None:
+        owner = get_worker_name()
+    queue = WorkQueue(path, lease_seconds=lease_seconds, max_attempts=max_attempts)
+    completed = []
+    while max_tasks is None or len(completed) < max_tasks:
+        task = queue.claim(owner, kind=kind)
+        if task is None:
+            break
+        heartbeat = Heartbeat(path, task, lease_seconds=lease_seconds)
+        heartbeat.start()
+        try:
+            result = handler(task)
+        except Exception, e:
+            print "%s failed: %s" % (task, str(e))
+            heartbeat.stop()
+            if queue.fail(task, e):
+                print "%s failed %d times; giving up on it" % (task, task.attempts)
+            continue
+        heartbeat.stop()
+        if heartbeat.lost:  # another worker has it now; its result is the one that counts
+            print "%s lost its lease" % task
+            continue
+        if queue.complete(task, result):
+            completed.append(task.key)
+    queue.close()
+    return completed